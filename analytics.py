@@ -0,0 +1,231 @@
+
+from grading import get_scheme
+from storage import execute_values
+
+# Profile fields that decide which aggregate rows a student's marks count towards
+COHORT_FIELDS = ('college', 'year_scheme')
+
+MARK_COLUMNS = 'subject_code, college, scheme, total, max_marks, grade_points'
+
+
+def create_tables(cur):
+    # marks keeps one row per student and subject; the two aggregate tables are
+    # adjusted by the difference on every card instead of recomputed from marks
+    cur.execute('ALTER TABLE marks ADD COLUMN IF NOT EXISTS card_id INTEGER')
+    cur.execute('ALTER TABLE marks ADD COLUMN IF NOT EXISTS max_marks INTEGER')
+    cur.execute('ALTER TABLE marks ADD COLUMN IF NOT EXISTS grade_points INTEGER')
+    cur.execute('ALTER TABLE marks ADD COLUMN IF NOT EXISTS college TEXT')
+    cur.execute('ALTER TABLE marks ADD COLUMN IF NOT EXISTS scheme TEXT')
+    cur.execute('CREATE INDEX IF NOT EXISTS marks_user_subject ON marks (user_id, subject_code)')
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS subject_stats (
+            subject_code TEXT,
+            college TEXT,
+            scheme TEXT,
+            students INTEGER DEFAULT 0,
+            percentage_sum DOUBLE PRECISION DEFAULT 0,
+            passed INTEGER DEFAULT 0,
+            PRIMARY KEY (subject_code, college, scheme)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS subject_grade_counts (
+            subject_code TEXT,
+            college TEXT,
+            scheme TEXT,
+            grade_points INTEGER,
+            students INTEGER DEFAULT 0,
+            PRIMARY KEY (subject_code, college, scheme, grade_points)
+        )
+    """)
+
+
+def cohort(college, year_scheme):
+    return (college or '').strip().lower(), get_scheme(year_scheme).name
+
+
+def percentage(total, max_marks):
+    return total * 100 / (max_marks or 100)
+
+
+def deltas(removed, added):
+    # removed and added are (subject_code, college, scheme, total, max_marks, grade_points)
+    # rows; returns the changes to apply to subject_stats and subject_grade_counts
+    stats = {}
+    grades = {}
+    for rows, sign in ((removed, -1), (added, 1)):
+        for code, college, scheme, total, max_marks, points in rows:
+            key = (code, college, scheme)
+            students, percentage_sum, passed = stats.get(key, (0, 0.0, 0))
+            stats[key] = (students + sign, percentage_sum + sign * percentage(total, max_marks), passed + sign * (points > 0))
+            grades[key + (points,)] = grades.get(key + (points,), 0) + sign
+    # Sorted so concurrent uploads lock the aggregate rows in the same order
+    return (sorted(key + value for key, value in stats.items() if value != (0, 0.0, 0)),
+            sorted(key + (count,) for key, count in grades.items() if count))
+
+
+def mark_rows(user_id, card_id, sgpa, subjects, college, scheme):
+    # A subject listed twice on one card counts once, the last row wins
+    latest = {subject.code: subject for subject in subjects}
+    return [(user_id, card_id, subject.code, subject.name, subject.internal, subject.external,
+             subject.internal + subject.external, subject.max_marks, subject.grade_points, subject.credits,
+             sgpa, college, scheme) for subject in latest.values()]
+
+
+def counted(rows):
+    # The aggregate-relevant columns of mark_rows() output, in deltas() order
+    return [(code, college, scheme, total, max_marks, points)
+            for _, _, code, _, _, _, total, max_marks, points, _, _, college, scheme in rows]
+
+
+def apply_deltas(cur, stats, grades):
+    if stats:
+        execute_values(cur, '''
+            INSERT INTO subject_stats (subject_code, college, scheme, students, percentage_sum, passed) VALUES %s
+            ON CONFLICT (subject_code, college, scheme) DO UPDATE SET
+                students = subject_stats.students + EXCLUDED.students,
+                percentage_sum = subject_stats.percentage_sum + EXCLUDED.percentage_sum,
+                passed = subject_stats.passed + EXCLUDED.passed
+        ''', stats)
+    if grades:
+        execute_values(cur, '''
+            INSERT INTO subject_grade_counts (subject_code, college, scheme, grade_points, students) VALUES %s
+            ON CONFLICT (subject_code, college, scheme, grade_points) DO UPDATE SET
+                students = subject_grade_counts.students + EXCLUDED.students
+        ''', grades)
+
+
+def record_card(cur, user_id, card_id, sgpa, subjects):
+    # A new card replaces the student's earlier marks for the same subjects,
+    # e.g. after a revaluation, so each student counts once per subject
+    cur.execute('SELECT college, year_scheme FROM users WHERE user_id = %s', (user_id,))
+    college, scheme = cohort(*(cur.fetchone() or (None, None)))
+    rows = mark_rows(user_id, card_id, sgpa, subjects, college, scheme)
+    if not rows:
+        return
+    cur.execute(f'DELETE FROM marks WHERE user_id = %s AND subject_code = ANY(%s) RETURNING {MARK_COLUMNS}',
+                (user_id, [row[2] for row in rows]))
+    # Rows written before grade points were stored were never counted
+    removed = [row for row in cur.fetchall() if row[5] is not None]
+    execute_values(cur, '''
+        INSERT INTO marks (user_id, card_id, subject_code, subject_name, internal_marks, external_marks, total,
+                           max_marks, grade_points, credits, sgpa, college, scheme) VALUES %s
+    ''', rows)
+    apply_deltas(cur, *deltas(removed, counted(rows)))
+
+
+def move_student(cur, user_id):
+    # After a college or scheme change the student's marks count towards the new cohort
+    cur.execute('SELECT college, year_scheme FROM users WHERE user_id = %s', (user_id,))
+    college, scheme = cohort(*(cur.fetchone() or (None, None)))
+    cur.execute(f'SELECT {MARK_COLUMNS} FROM marks WHERE user_id = %s AND grade_points IS NOT NULL '
+                'AND (college, scheme) IS DISTINCT FROM (%s, %s)', (user_id, college, scheme))
+    removed = cur.fetchall()
+    if not removed:
+        return
+    cur.execute('UPDATE marks SET college = %s, scheme = %s WHERE user_id = %s AND grade_points IS NOT NULL',
+                (college, scheme, user_id))
+    moved = [(code, college, scheme, total, max_marks, points) for code, _, _, total, max_marks, points in removed]
+    apply_deltas(cur, *deltas(removed, moved))
+
+
+async def apply_deltas_async(conn, stats, grades):
+    await conn.executemany('''
+        INSERT INTO subject_stats (subject_code, college, scheme, students, percentage_sum, passed)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (subject_code, college, scheme) DO UPDATE SET
+            students = subject_stats.students + EXCLUDED.students,
+            percentage_sum = subject_stats.percentage_sum + EXCLUDED.percentage_sum,
+            passed = subject_stats.passed + EXCLUDED.passed
+    ''', stats)
+    await conn.executemany('''
+        INSERT INTO subject_grade_counts (subject_code, college, scheme, grade_points, students)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (subject_code, college, scheme, grade_points) DO UPDATE SET
+            students = subject_grade_counts.students + EXCLUDED.students
+    ''', grades)
+
+
+async def record_card_async(conn, user_id, card_id, sgpa, subjects):
+    row = await conn.fetchrow('SELECT college, year_scheme FROM users WHERE user_id = $1', user_id)
+    college, scheme = cohort(*(row or (None, None)))
+    rows = mark_rows(user_id, card_id, sgpa, subjects, college, scheme)
+    if not rows:
+        return
+    removed = await conn.fetch(f'DELETE FROM marks WHERE user_id = $1 AND subject_code = ANY($2::text[]) RETURNING {MARK_COLUMNS}',
+                               user_id, [row[2] for row in rows])
+    await conn.executemany('''
+        INSERT INTO marks (user_id, card_id, subject_code, subject_name, internal_marks, external_marks, total,
+                           max_marks, grade_points, credits, sgpa, college, scheme)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
+    ''', rows)
+    removed = [tuple(row) for row in removed if row['grade_points'] is not None]
+    await apply_deltas_async(conn, *deltas(removed, counted(rows)))
+
+
+async def move_student_async(conn, user_id):
+    row = await conn.fetchrow('SELECT college, year_scheme FROM users WHERE user_id = $1', user_id)
+    college, scheme = cohort(*(row or (None, None)))
+    removed = await conn.fetch(f'SELECT {MARK_COLUMNS} FROM marks WHERE user_id = $1 AND grade_points IS NOT NULL '
+                               'AND (college, scheme) IS DISTINCT FROM ($2, $3)', user_id, college, scheme)
+    if not removed:
+        return
+    await conn.execute('UPDATE marks SET college = $1, scheme = $2 WHERE user_id = $3 AND grade_points IS NOT NULL',
+                       college, scheme, user_id)
+    removed = [tuple(row) for row in removed]
+    moved = [(code, college, scheme, total, max_marks, points) for code, _, _, total, max_marks, points in removed]
+    await apply_deltas_async(conn, *deltas(removed, moved))
+
+
+SUBJECT_STATS_QUERY = 'SELECT college, scheme, students, percentage_sum, passed FROM subject_stats WHERE subject_code = {0} AND students > 0'
+GRADE_COUNTS_QUERY = ('SELECT college, scheme, grade_points, students FROM subject_grade_counts '
+                      'WHERE subject_code = {0} AND students > 0')
+MY_SUBJECTS_QUERY = '''
+    SELECT m.subject_code, m.subject_name, m.total, m.max_marks, m.grade_points, s.students, s.percentage_sum
+    FROM marks m
+    LEFT JOIN subject_stats s ON s.subject_code = m.subject_code AND s.college = m.college AND s.scheme = m.scheme
+    WHERE m.user_id = {0} AND m.grade_points IS NOT NULL
+    ORDER BY m.subject_code
+'''
+
+
+def format_subject_stats(code, stats, grades, college, year_scheme):
+    # stats and grades are the SUBJECT_STATS_QUERY and GRADE_COUNTS_QUERY rows for
+    # every college and scheme; the student's own cohort is shown first
+    if not stats:
+        return f'No marks have been recorded for {code} yet.'
+    own = cohort(college, year_scheme)
+    lines = [f'{code} statistics']
+    for label, rows in ((f'{(college or "").strip() or "No college"}, {own[1]} scheme',
+                         [row for row in stats if (row[0], row[1]) == own]),
+                        ('All colleges', stats)):
+        students = sum(row[2] for row in rows)
+        if not students:
+            lines.append(f'{label}: no students yet')
+            continue
+        average = sum(row[3] for row in rows) / students
+        passed = sum(row[4] for row in rows)
+        lines.append(f'{label}: {students} students, average {average:.1f}%, pass rate {passed * 100 / students:.0f}%')
+    own_grades = [row for row in grades if (row[0], row[1]) == own] or grades
+    distribution = {}
+    for _, _, points, students in own_grades:
+        distribution[points] = distribution.get(points, 0) + students
+    total = sum(distribution.values())
+    lines.append('Grade points' + (' in your cohort:' if own_grades is not grades else ' across all colleges:'))
+    for points in sorted(distribution, reverse=True):
+        lines.append(f'  {points:>2}: {distribution[points]} ({distribution[points] * 100 / total:.0f}%)')
+    return '\n'.join(lines)
+
+
+def format_my_subjects(rows):
+    if not rows:
+        return 'No subject marks recorded yet. Upload your marks card using /upload_markscard_pdf.'
+    lines = ['Your subjects against the average in your college and scheme:']
+    for code, name, total, max_marks, points, students, percentage_sum in rows:
+        mine = percentage(total, max_marks)
+        line = f'{code} {name or ""}'.rstrip() + f': {mine:.0f}% (grade point {points})'
+        if students:
+            average = percentage_sum / students
+            line += f', average {average:.0f}% ({mine - average:+.0f}) over {students} students'
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,1152 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import partial
+from uuid import uuid4
+
+import asyncpg
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+import psycopg2
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import bot as threaded
+import bulk
+import feedback
+import layout
+import lifecycle
+import metrics
+import partitions
+import export
+import ranking
+import analytics
+import scratch
+import storage
+import updates
+from bot import (states, user_sessions, init_session, hash_password, check_password, fetch_job_opportunities,
+                 START_DESCRIPTION, start_markup, menu_markup, update_profile_markup, startup_phase, startup_report)
+from dispatcher import CHAT_UPDATE_FIELDS, chat_key
+from layout import UnrecognizedLayoutError
+from marks import analyze_marks, convert_pdf_to_excel
+from reports import render_report
+from scratch import ScratchQuotaExceeded
+from updates import idempotent_async as idempotent
+
+# Threads for the CPU-bound work: Aspose conversions, bcrypt and ReportLab
+CPU_WORKERS = int(os.getenv('CPU_WORKERS', str(os.cpu_count() or 4)))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+
+# This runtime is partial: it has no broadcasts (/broadcast, /broadcast_status
+# and /broadcast_cancel are refused). Run the threaded runtime where those are
+# needed.
+
+# Created by create_app(); importing this module has no side effects
+DATABASE_URL = None
+BOT_TOKEN = None
+ADMIN_CHAT_IDS = set()
+db = None
+bot = None
+scheduler = None
+cpu = None
+feedback_buffer = None
+
+
+class ChatLocks:
+    # One lock per chat with updates in flight, dropped again when the chat
+    # goes idle; each entry counts the updates waiting for or holding its lock
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, chat_id):
+        entry = self._locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat_id]
+
+    def pending(self):
+        return sum(entry[1] for entry in self._locks.values())
+
+    def stats(self, top=10):
+        lengths = sorted(((entry[1], chat_id) for chat_id, entry in self._locks.items()), reverse=True)
+        return {
+            'chats': len(lengths),
+            'pending': sum(length for length, _ in lengths),
+            'busiest': [(chat_id, length) for length, chat_id in lengths[:top]],
+        }
+
+
+class AsyncCampusBot(AsyncTeleBot):
+    # The asyncio counterpart of dispatcher.CampusBot: updates from one chat are
+    # handled in order, redelivered updates are skipped and the offset is
+    # persisted. As in updates.IdempotentTeleBot, an update only counts as
+    # processed once its handlers have finished.
+    is_async = True
+
+    def __init__(self, token, update_store, **kwargs):
+        super().__init__(token, **kwargs)
+        self.update_store = update_store
+        self.chat_locks = ChatLocks()
+        self._recent = set()
+        self.last_update_id = 0
+        self._in_flight = set()
+        self._polled_stale = False
+        self._progress = asyncio.Event()
+        # Message or callback object -> the update it came in, for updates.handling()
+        self._update_of = {}
+        # Batches being handled; shutdown waits for them
+        self.batches = set()
+        self.accepting = True
+
+    async def load_offset(self):
+        last_update_id = await self.update_store.last_update_id()
+        if last_update_id:
+            self.last_update_id = last_update_id
+            self.offset = last_update_id + 1
+
+    async def close_session(self):
+        # Stopping polling closes the shared HTTP session, which the batches
+        # still draining need; shutdown() closes it once they are done
+        if self.accepting:
+            await super().close_session()
+
+    async def get_updates(self, offset=None, *args, **kwargs):
+        # Telegram forgets every update below the offset it is polled with
+        if self._in_flight and offset is not None and offset > 0:
+            if self._polled_stale:
+                self._progress.clear()
+                try:
+                    await asyncio.wait_for(self._progress.wait(), updates.IN_FLIGHT_POLL_WAIT)
+                except asyncio.TimeoutError:
+                    pass
+            offset = min([offset] + list(self._in_flight))
+        result = await super().get_updates(offset, *args, **kwargs)
+        self._polled_stale = bool(result) and all(
+            update.update_id in self._in_flight or update.update_id in self._recent for update in result)
+        # polling() hands the batch to a task and polls again straight away, so
+        # the ids are taken here; ones already taken come back while the offset
+        # waits for them and are dropped
+        result = [update for update in result if update.update_id not in self._in_flight]
+        self._in_flight.update(update.update_id for update in result)
+        return result
+
+    async def process_new_updates(self, new_updates):
+        # A batch that arrives after shutdown began is left unrecorded, so the
+        # next process fetches it again
+        if not new_updates or not self.accepting:
+            return
+        task = asyncio.current_task()
+        self.batches.add(task)
+        try:
+            await self._process_batch(new_updates)
+        finally:
+            self.batches.discard(task)
+
+    async def _process_batch(self, new_updates):
+        ids = [update.update_id for update in new_updates]
+        fresh_ids = []
+        try:
+            unknown = [update_id for update_id in ids if update_id not in self._recent]
+            seen = (set(ids) - set(unknown)) | (await self.update_store.seen(unknown) if unknown else set())
+            fresh = [update for update in new_updates if update.update_id not in seen]
+            if seen:
+                updates.UPDATES_SKIPPED.inc(len(seen))
+            fresh_ids = [update.update_id for update in fresh]
+            self.last_update_id = max(self.last_update_id, max(ids))
+            for update in fresh:
+                for field in CHAT_UPDATE_FIELDS:
+                    obj = getattr(update, field, None)
+                    if obj is not None:
+                        self._update_of[id(obj)] = update.update_id
+            await super().process_new_updates(fresh)
+        finally:
+            for update in new_updates:
+                for field in CHAT_UPDATE_FIELDS:
+                    self._update_of.pop(id(getattr(update, field, None)), None)
+            self._in_flight.difference_update(ids)
+            self._recent.update(fresh_ids)
+            if len(self._recent) > 10000:
+                self._recent = set(sorted(self._recent)[-1000:])
+            self._progress.set()
+            if fresh_ids:
+                # Everything up to the oldest unfinished update is done
+                offset = min(self._in_flight) - 1 if self._in_flight else self.last_update_id
+                await self.update_store.record(fresh_ids, offset)
+
+    async def _run_middlewares_and_handlers(self, message, handlers, middlewares, update_type):
+        # Filters read user_sessions too, so they run under the chat's lock as well
+        chat_id = chat_key(message)
+        with updates.handling(self._update_of.get(id(message))):
+            if chat_id is None:
+                return await super()._run_middlewares_and_handlers(message, handlers, middlewares, update_type)
+            async with self.chat_locks.hold(chat_id):
+                return await super()._run_middlewares_and_handlers(message, handlers, middlewares, update_type)
+
+
+async def live_since(conn, table):
+    # bot.live_since() for asyncpg
+    return partitions.live_since(table, await conn.fetchval(partitions.RESTORED_SINCE_QUERY.format('$1'), table))
+
+
+def run_cpu(func, *args):
+    return asyncio.get_running_loop().run_in_executor(cpu, partial(func, *args))
+
+
+async def download_file(file_id):
+    # Shares the aiohttp session telebot uses for Bot API calls
+    file_info = await bot.get_file(file_id)
+    file_url = (asyncio_helper.FILE_URL or 'https://api.telegram.org/file/bot{0}/{1}').format(BOT_TOKEN, file_info.file_path)
+    session = await asyncio_helper.session_manager.get_session()
+    with metrics.TELEGRAM_API_SECONDS.time(method='downloadFile'):
+        async with session.get(file_url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+
+async def handle_start(message):
+    init_session(message.chat.id)
+
+    with open('start.jpg', 'rb') as image:
+        await bot.send_photo(message.chat.id, image, caption="Welcome to the Student Bot!")
+
+    await bot.send_message(message.chat.id, START_DESCRIPTION)
+    await bot.send_message(message.chat.id, 'Use the button below to navigate the menu:', reply_markup=start_markup())
+
+
+async def handle_menu(message):
+    await bot.send_message(message.chat.id, 'Use the menu below to navigate:', reply_markup=menu_markup())
+
+
+async def handle_query(call):
+    chat_id = call.message.chat.id
+    user_id = user_sessions[chat_id]['userId']
+
+    if call.data == 'register':
+        if user_id:
+            await bot.send_message(chat_id, 'Please logout first using /logout before registering a new account.')
+        else:
+            await handle_register(call.message)
+    elif call.data == 'login':
+        if user_id:
+            await bot.send_message(chat_id, 'Please logout first using /logout before logging in.')
+        else:
+            await handle_login(call.message)
+    elif call.data in MENU_ACTIONS:
+        await MENU_ACTIONS[call.data](call.message)
+
+
+async def handle_register(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    if user_sessions[chat_id]['userId']:
+        await bot.send_message(chat_id, 'Please logout first using /logout before registering a new account.')
+        return
+    user_sessions[chat_id]['state'] = states['USERNAME']
+    await bot.send_message(chat_id, 'Enter your username:')
+
+
+async def handle_login(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    if user_sessions[chat_id]['userId']:
+        await bot.send_message(chat_id, 'Please logout first using /logout before logging in.')
+        return
+    user_sessions[chat_id]['state'] = states['LOGIN_USERNAME']
+    await bot.send_message(chat_id, 'Enter your username:')
+
+
+async def logged_in_user(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    user_id = user_sessions[chat_id]['userId']
+    if user_id is None:
+        await bot.send_message(chat_id, 'Please login first using /login.')
+    return user_id
+
+
+async def handle_sgpa(message):
+    chat_id = message.chat.id
+    user_id = await logged_in_user(message)
+    if user_id is None:
+        return
+    try:
+        sgpa = await db.fetchval('SELECT sgpa FROM users WHERE user_id = $1', user_id)
+    except Exception as e:
+        await bot.send_message(chat_id, f'Error fetching SGPA: {e}')
+        return
+    if sgpa is not None:
+        await bot.send_message(chat_id, f'Your SGPA is: {sgpa:.2f}')
+    else:
+        await bot.send_message(chat_id, 'No SGPA records found. Please upload your marks card using /upload_markscard_pdf.')
+
+
+async def handle_cgpa(message):
+    chat_id = message.chat.id
+    user_id = await logged_in_user(message)
+    if user_id is None:
+        return
+    try:
+        rows = await db.fetch('SELECT sgpa FROM users WHERE user_id = $1', user_id)
+        sgpa_values = [row['sgpa'] for row in rows]
+        if not sgpa_values:
+            await bot.send_message(chat_id, 'No SGPA records found. Please upload your marks card using /upload_markscard_pdf.')
+            return
+        cgpa = sum(sgpa_values) / len(sgpa_values)
+        try:
+            await db.execute('UPDATE users SET cgpa = $1 WHERE user_id = $2', cgpa, user_id)
+        except Exception as e:
+            await bot.send_message(chat_id, f'Error updating CGPA: {e}')
+        await bot.send_message(chat_id, f'Your CGPA is: {cgpa:.2f}')
+    except Exception as e:
+        await bot.send_message(chat_id, f'Error calculating CGPA: {e}')
+
+
+async def handle_rank(message):
+    chat_id = message.chat.id
+    user_id = await logged_in_user(message)
+    if user_id is None:
+        return
+    try:
+        cohort = await db.fetchrow('SELECT college, branch, semester FROM users WHERE user_id = $1', user_id)
+    except Exception as e:
+        await bot.send_message(chat_id, f'Error fetching rank: {e}')
+        return
+    result = ranking.board.rank(user_id)
+    if not cohort or ranking.cohort_key(*cohort) is None:
+        await bot.send_message(chat_id, 'Add your college, branch and semester with Update Profile in the menu to see your rank.')
+    elif result is None:
+        await bot.send_message(chat_id, 'No SGPA records found. Please upload your marks card using /upload_markscard_pdf.')
+    else:
+        await bot.send_message(chat_id, ranking.format_rank(result, *cohort))
+
+
+async def handle_subject_stats(message):
+    chat_id = message.chat.id
+    user_id = await logged_in_user(message)
+    if user_id is None:
+        return
+    parts = message.text.split()
+    if len(parts) < 2:
+        await bot.send_message(chat_id, 'Usage: /subject_stats <subject code>, e.g. /subject_stats 21CS51')
+        return
+    code = parts[1].upper()
+    try:
+        async with db.acquire() as conn:
+            user = await conn.fetchrow('SELECT college, year_scheme FROM users WHERE user_id = $1', user_id)
+            stats = await conn.fetch(analytics.SUBJECT_STATS_QUERY.format('$1'), code)
+            grades = await conn.fetch(analytics.GRADE_COUNTS_QUERY.format('$1'), code)
+    except Exception as e:
+        await bot.send_message(chat_id, f'Error fetching subject statistics: {e}')
+        return
+    college, year_scheme = user or (None, None)
+    await bot.send_message(chat_id, analytics.format_subject_stats(code, stats, grades, college, year_scheme))
+
+
+async def handle_my_subjects(message):
+    chat_id = message.chat.id
+    user_id = await logged_in_user(message)
+    if user_id is None:
+        return
+    try:
+        rows = await db.fetch(analytics.MY_SUBJECTS_QUERY.format('$1'), user_id)
+    except Exception as e:
+        await bot.send_message(chat_id, f'Error fetching your subjects: {e}')
+        return
+    await bot.send_message(chat_id, analytics.format_my_subjects(rows))
+
+
+async def handle_profile(message):
+    chat_id = message.chat.id
+    user_id = await logged_in_user(message)
+    if user_id is None:
+        return
+    try:
+        user = await db.fetchrow('SELECT full_name, semester, college, mobile, branch, year_scheme, sgpa, cgpa '
+                                 'FROM users WHERE user_id = $1', user_id)
+    except Exception as e:
+        await bot.send_message(chat_id, f'Error fetching profile: {e}')
+        return
+    if user:
+        full_name, semester, college, mobile, branch, year_scheme, sgpa, cgpa = user
+        profile_message = f"""
+                *Profile Information*
+                Full Name: {full_name}
+                Semester: {semester}
+                College: {college}
+                Mobile: {mobile}
+                Branch: {branch}
+                Year Scheme: {year_scheme}
+                SGPA: {f'{sgpa:.2f}' if sgpa is not None else 'N/A'}
+                CGPA: {f'{cgpa:.2f}' if cgpa is not None else 'N/A'}
+                """
+        await bot.send_message(chat_id, profile_message, parse_mode='Markdown')
+    else:
+        await bot.send_message(chat_id, 'Profile not found.')
+
+
+async def handle_update_profile(message):
+    chat_id = message.chat.id
+    if await logged_in_user(message) is None:
+        return
+    await bot.send_message(chat_id, 'Choose the information you want to update:', reply_markup=update_profile_markup())
+    user_sessions[chat_id]['state'] = states['UPDATE_PROFILE']
+
+
+async def handle_update_field(call):
+    chat_id = call.message.chat.id
+    field = call.data.split('_')[1]
+    user_sessions[chat_id]['update_field'] = field
+    user_sessions[chat_id]['state'] = states['UPDATE_PROFILE_FIELD']
+    await bot.send_message(chat_id, f'Enter your new {field.replace("_", " ")}:')
+
+
+async def handle_update_value(message):
+    chat_id = message.chat.id
+    field = user_sessions[chat_id]['update_field']
+    user_id = user_sessions[chat_id]['userId']
+    try:
+        async with db.acquire() as conn, conn.transaction():
+            row = await conn.fetchrow(f'UPDATE users SET {field} = $1 WHERE user_id = $2 RETURNING college, branch, semester, sgpa',
+                                      message.text, user_id)
+            if field in analytics.COHORT_FIELDS:
+                await analytics.move_student_async(conn, user_id)
+        if row:
+            ranking.board.update(user_id, *row)
+        await bot.send_message(chat_id, f'{field.replace("_", " ").capitalize()} updated successfully!')
+    except Exception as e:
+        await bot.send_message(chat_id, f'Error updating {field.replace("_", " ")}: {e}')
+    finally:
+        user_sessions[chat_id]['state'] = None
+        user_sessions[chat_id].pop('update_field', None)
+
+
+async def handle_upload_markscard_pdf(message):
+    chat_id = message.chat.id
+    if await logged_in_user(message) is None:
+        return
+    user_sessions[chat_id]['state'] = states['MARKSCARD_PDF']
+    await bot.send_message(chat_id, 'Please upload your marks card PDF.')
+
+
+async def handle_upload_markscards_zip(message):
+    chat_id = message.chat.id
+    if await logged_in_user(message) is None:
+        return
+    user_sessions[chat_id]['state'] = states['MARKSCARD_ZIP']
+    await bot.send_message(chat_id, 'Please upload a ZIP file containing your marks card PDFs.')
+
+
+async def handle_text(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    session = user_sessions[chat_id]
+    state = session['state']
+
+    if state == states['USERNAME']:
+        session['username'] = message.text
+        await bot.send_message(chat_id, 'Enter your password:')
+        session['state'] = states['PASSWORD']
+    elif state == states['PASSWORD']:
+        session['password'] = message.text
+        await bot.send_message(chat_id, 'Enter your full name:')
+        session['state'] = states['FULL_NAME']
+    elif state == states['FULL_NAME']:
+        session['full_name'] = message.text
+        try:
+            existing_user = await db.fetchval('SELECT user_id FROM users WHERE username = $1', session['username'])
+            if existing_user:
+                await bot.send_message(chat_id, 'Username already exists. Please login or choose a different username.')
+                session['state'] = states['USERNAME']
+            else:
+                await bot.send_message(chat_id, 'Enter your semester:')
+                session['state'] = states['SEMESTER']
+        except Exception as e:
+            await bot.send_message(chat_id, f'Error during registration: {e}')
+    elif state == states['SEMESTER']:
+        session['semester'] = message.text
+        await bot.send_message(chat_id, 'Enter your college name:')
+        session['state'] = states['COLLEGE']
+    elif state == states['COLLEGE']:
+        session['college'] = message.text
+        await bot.send_message(chat_id, 'Enter your mobile number:')
+        session['state'] = states['MOBILE']
+    elif state == states['MOBILE']:
+        mobile_number = message.text
+        if len(mobile_number) != 10 or not mobile_number.isdigit():
+            await bot.send_message(chat_id, 'Invalid mobile number. Please enter a 10-digit mobile number:')
+        else:
+            session['mobile'] = mobile_number
+            await bot.send_message(chat_id, 'Enter your branch:')
+            session['state'] = states['BRANCH']
+    elif state == states['BRANCH']:
+        session['branch'] = message.text
+        await bot.send_message(chat_id, 'Enter your year scheme:')
+        session['state'] = states['YEAR_SCHEME']
+    elif state == states['YEAR_SCHEME']:
+        password = await run_cpu(hash_password, session['password'])
+        try:
+            user_id = await db.fetchval(
+                'INSERT INTO users (full_name, username, password, semester, college, mobile, branch, year_scheme, sgpa, cgpa, chat_id) '
+                'VALUES ($1, $2, $3, $4, $5, $6, $7, $8, NULL, NULL, $9) RETURNING user_id',
+                session['full_name'], session['username'], password, session['semester'], session['college'],
+                session['mobile'], session['branch'], message.text, str(chat_id))
+            session['userId'] = user_id
+            await bot.send_message(chat_id, 'Registration successful! You can now use the menu to navigate.')
+            session['state'] = None
+        except Exception as e:
+            await bot.send_message(chat_id, f'Error during registration: {e}')
+    elif state == states['LOGIN_USERNAME']:
+        session['username'] = message.text
+        await bot.send_message(chat_id, 'Enter your password:')
+        session['state'] = states['LOGIN_PASSWORD']
+    elif state == states['LOGIN_PASSWORD']:
+        try:
+            user = await db.fetchrow('SELECT user_id, password FROM users WHERE username = $1', session['username'])
+            if user and await run_cpu(check_password, bytes(user['password']), message.text):
+                session['userId'] = user['user_id']
+                await bot.send_message(chat_id, 'Login successful! You can now use the menu to navigate.')
+                session['state'] = None
+            else:
+                await bot.send_message(chat_id, 'Invalid username or password. Please try again.')
+                session['state'] = states['LOGIN_USERNAME']
+        except Exception as e:
+            await bot.send_message(chat_id, f'Error during login: {e}')
+    elif state == states['RESET_PASSWORD']:
+        await reset_password(chat_id, message.text)
+    elif state == states['REMINDER_TIME']:
+        session['reminder_time'] = message.text
+        await bot.send_message(chat_id, 'Enter the reminder message:')
+        session['state'] = states['REMINDER_MESSAGE']
+    elif state == states['REMINDER_MESSAGE']:
+        if await add_reminder(session['userId'], session['reminder_time'], message.text):
+            await bot.send_message(chat_id, 'Reminder set successfully!')
+        else:
+            await bot.send_message(chat_id, 'Error setting reminder.')
+        session['state'] = None
+    elif state == states['FEEDBACK']:
+        await handle_feedback_message(message)
+    else:
+        await bot.send_message(chat_id, 'Unknown command. Please use /menu to see available options.')
+
+
+def analyze_card(data, year_scheme):
+    # Runs on the CPU executor: the Aspose conversion and workbook parsing block
+    with scratch.workspace.job('markscard') as job:
+        pdf_source = job.store('markscard.pdf', data)
+        excel_path = job.path('markscard.xlsx')
+        convert_pdf_to_excel(pdf_source, excel_path)
+        job.track(excel_path)
+        return analyze_marks(excel_path, year_scheme)
+
+
+async def handle_document(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    state = user_sessions[chat_id]['state']
+    user_id = user_sessions[chat_id]['userId']
+
+    if user_id is None:
+        await bot.send_message(chat_id, 'Please login first using /login.')
+        return
+
+    if state == states['MARKSCARD_PDF']:
+        if message.content_type != 'document' or message.document.mime_type != 'application/pdf':
+            await bot.send_message(chat_id, 'Unsupported file format. Please upload a PDF file.')
+            return
+        await convert_markscard(chat_id, user_id, message.document.file_id, message.document.file_size)
+    elif state == states['MARKSCARD_ZIP']:
+        if message.content_type == 'document' and bulk.is_zip(message.document):
+            await handle_markscard_zip(message)
+        else:
+            await bot.send_message(chat_id, 'Unsupported file format. Please upload a ZIP file of marks card PDFs.')
+    elif state == states['SHARE_DOCUMENT']:
+        if message.content_type in ['document', 'photo']:
+            file_id = message.document.file_id if message.content_type == 'document' else message.photo[-1].file_id
+            file_name = message.document.file_name if message.content_type == 'document' else 'photo.jpg'
+            mime_type = message.document.mime_type if message.content_type == 'document' else 'image/jpeg'
+            try:
+                await db.execute('INSERT INTO shared_documents (user_id, file_id, file_name, mime_type) VALUES ($1, $2, $3, $4)',
+                                 user_id, file_id, file_name, mime_type)
+                await bot.send_message(chat_id, f'Document {file_name} shared successfully!')
+            except Exception as e:
+                print(f"Error saving shared document: {e}")
+                await bot.send_message(chat_id, 'Error sharing document.')
+
+
+async def convert_markscard(chat_id, user_id, file_id, file_size=None, job_id=None):
+    # Recorded as a pending job while it runs, as in bot.convert_markscard()
+    payload = {'user_id': user_id, 'file_id': file_id, 'file_size': file_size, 'update_id': updates.current_update_id()}
+    async with lifecycle.async_jobs.track('markscard', chat_id, payload, job_id) as pending:
+        if await db.fetchval('SELECT card_id FROM marks_cards WHERE user_id = $1 AND file_id = $2 AND uploaded_on >= $3',
+                             user_id, file_id, partitions.duplicate_card_since()):
+            sgpa = await db.fetchval('SELECT sgpa FROM users WHERE user_id = $1', user_id)
+            await bot.send_message(chat_id, f'You have already uploaded this marks card. Your SGPA is: {sgpa:.2f}')
+            return
+        try:
+            data = await download_file(file_id)
+            year_scheme = await db.fetchval('SELECT year_scheme FROM users WHERE user_id = $1', user_id)
+            analysis = await run_cpu(analyze_card, data, year_scheme)
+        except UnrecognizedLayoutError as e:
+            print(f"Unrecognized marks card layout from user {user_id} ({file_id}): {e}")
+            await bot.send_message(chat_id, 'Sorry, the layout of this marks card was not recognized, so no SGPA was calculated. It has been flagged for review.')
+            return
+        except ScratchQuotaExceeded as e:
+            print(f"Scratch space full: {e}")
+            await bot.send_message(chat_id, 'The server is busy processing other marks cards. Please try again in a few minutes.')
+            return
+        sgpa = analysis['sgpa']
+        if sgpa is None:
+            print(f"No credited subjects on marks card from user {user_id} ({file_id})")
+            await bot.send_message(chat_id, 'None of the subjects on this marks card are recognized yet, so no SGPA was calculated.')
+            return
+
+        async with db.acquire() as conn, conn.transaction():
+            row = await conn.fetchrow('UPDATE users SET sgpa = $1 WHERE user_id = $2 RETURNING college, branch, semester, sgpa',
+                                      sgpa, user_id)
+            card_id = await conn.fetchval('INSERT INTO marks_cards (user_id, file_id, semester, sgpa) VALUES ($1, $2, $3, $4) '
+                                          'RETURNING card_id', user_id, file_id, analysis['semester'], sgpa)
+            await analytics.record_card_async(conn, user_id, card_id, sgpa, analysis['subjects'])
+        if row:
+            ranking.board.update(user_id, *row)
+
+        await pending.done()
+        await bot.send_message(chat_id, 'Marks card PDF uploaded and processed successfully. SGPA has been updated.')
+        user_sessions[chat_id]['state'] = None
+
+
+async def handle_markscard_zip(message):
+    chat_id = message.chat.id
+    await convert_markscard_zip(chat_id, user_sessions[chat_id]['userId'], message.document.file_id, message.document.file_size)
+
+
+async def convert_markscard_zip(chat_id, user_id, zip_file_id, file_size=None, job_id=None):
+    payload = {'user_id': user_id, 'file_id': zip_file_id, 'file_size': file_size, 'update_id': updates.current_update_id()}
+    async with lifecycle.async_jobs.track('markscard_zip', chat_id, payload, job_id) as pending:
+        await process_markscard_zip(chat_id, user_id, zip_file_id, pending)
+
+
+async def process_markscard_zip(chat_id, user_id, zip_file_id, pending):
+    loop = asyncio.get_running_loop()
+
+    progress = await bot.send_message(chat_id, 'Processing your marks cards...')
+    last_edit = [0.0]
+
+    def on_progress(done, total):
+        # Called from the bulk worker threads; the edit itself runs on the event loop
+        now = time.monotonic()
+        if done < total and now - last_edit[0] < 2:
+            return
+        last_edit[0] = now
+        asyncio.run_coroutine_threadsafe(
+            bot.edit_message_text(f'Processed {done}/{total} marks cards...', chat_id, progress.message_id), loop)
+
+    def process(data, year_scheme):
+        with scratch.workspace.job('markscard-zip') as job:
+            return bulk.process_zip(job.store('markscards.zip', data), year_scheme, on_progress)
+
+    try:
+        data = await download_file(zip_file_id)
+        year_scheme = await db.fetchval('SELECT year_scheme FROM users WHERE user_id = $1', user_id)
+        results = await run_cpu(process, data, year_scheme)
+    except zipfile.BadZipFile:
+        await bot.edit_message_text('That file is not a valid ZIP archive.', chat_id, progress.message_id)
+        return
+    except ScratchQuotaExceeded as e:
+        print(f"Scratch space full: {e}")
+        await bot.send_message(chat_id, 'The server is busy processing other marks cards. Please try again in a few minutes.')
+        return
+
+    summary, by_semester = bulk.summarize(results)
+    row = None
+    async with db.acquire() as conn, conn.transaction():
+        for result in by_semester.values():
+            card_file_id = f'{zip_file_id}/{result.name}'
+            if not await conn.fetchval('SELECT card_id FROM marks_cards WHERE user_id = $1 AND file_id = $2 AND uploaded_on >= $3',
+                                       user_id, card_file_id, partitions.duplicate_card_since()):
+                card_id = await conn.fetchval('INSERT INTO marks_cards (user_id, file_id, semester, sgpa) VALUES ($1, $2, $3, $4) '
+                                              'RETURNING card_id', user_id, card_file_id, result.semester, result.sgpa)
+                await analytics.record_card_async(conn, user_id, card_id, result.sgpa, result.subjects)
+        if by_semester:
+            latest = max(by_semester, key=lambda semester: int(semester) if semester.isdigit() else -1)
+            row = await conn.fetchrow('UPDATE users SET sgpa = $1 WHERE user_id = $2 RETURNING college, branch, semester, sgpa',
+                                      by_semester[latest].sgpa, user_id)
+    if row:
+        ranking.board.update(user_id, *row)
+
+    await pending.done()
+    await bot.send_message(chat_id, summary)
+    user_sessions[chat_id]['state'] = None
+
+
+async def handle_reset_password(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    await bot.send_message(chat_id, 'Enter your username:')
+    user_sessions[chat_id]['state'] = states['LOGIN_USERNAME']
+
+
+async def handle_username_for_reset(message):
+    chat_id = message.chat.id
+    user_sessions[chat_id]['username'] = message.text
+    await bot.send_message(chat_id, 'Enter your new password:')
+    user_sessions[chat_id]['state'] = states['RESET_PASSWORD']
+
+
+async def handle_new_password(message):
+    await reset_password(message.chat.id, message.text)
+
+
+async def reset_password(chat_id, password):
+    new_password = await run_cpu(hash_password, password)
+    try:
+        await db.execute('UPDATE users SET password = $1 WHERE username = $2', new_password, user_sessions[chat_id]['username'])
+        await bot.send_message(chat_id, 'Password reset successfully!')
+        user_sessions[chat_id]['state'] = None
+    except Exception as e:
+        await bot.send_message(chat_id, f'Error resetting password: {e}')
+
+
+async def handle_logout(message):
+    chat_id = message.chat.id
+    user_sessions[chat_id] = {'state': None, 'username': None, 'userId': None}
+    await bot.send_message(chat_id, 'You have been logged out successfully.')
+
+
+async def handle_generate_report(message):
+    chat_id = message.chat.id
+    user_id = await logged_in_user(message)
+    if user_id is None:
+        return
+    try:
+        user = await db.fetchrow('SELECT full_name, semester, college, branch, sgpa, cgpa FROM users WHERE user_id = $1', user_id)
+        with scratch.workspace.job('report') as job:
+            report_path = job.path(f'report_{user_id}.pdf')
+            await run_cpu(render_report, tuple(user), report_path)
+            job.track(report_path)
+            with open(report_path, 'rb') as report_file:
+                await bot.send_document(chat_id, report_file)
+    except ScratchQuotaExceeded as e:
+        print(f"Scratch space full: {e}")
+        await bot.send_message(chat_id, 'Error generating report. Please try again in a few minutes.')
+    except Exception as e:
+        logging.error(f"Error generating report: {e}")
+        await bot.send_message(chat_id, 'Error generating report.')
+
+
+async def add_reminder(user_id, time_str, message):
+    job_id = str(uuid4())
+    try:
+        await db.execute('INSERT INTO reminders (user_id, time_str, message, job_id) VALUES ($1, $2, $3, $4)',
+                         user_id, time_str, message, job_id)
+        hour, minute = map(int, time_str.split(':'))
+        scheduler.add_job(send_reminder, CronTrigger(hour=hour, minute=minute), args=[user_id, message, job_id], id=job_id)
+        return True
+    except Exception as e:
+        print(f"Error adding reminder: {e}")
+        return False
+
+
+async def send_reminder(user_id, message, job_id=None, occurrence=None):
+    try:
+        # Claimed first, as in the threaded runtime, so an occurrence is sent once
+        if job_id is not None and await db.fetchval(lifecycle.CLAIM_REMINDER.format('$1::timestamp', '$2'),
+                                                    occurrence or lifecycle.occurrence(datetime.now()), job_id) is None:
+            return
+        chat_id = await db.fetchval('SELECT chat_id FROM users WHERE user_id = $1', user_id)
+        await bot.send_message(chat_id, f"Reminder: {message}")
+    except Exception as e:
+        print(f"Error sending reminder: {e}")
+
+
+async def schedule_reminders():
+    try:
+        now = datetime.now()
+        for job_id, user_id, time_str, message, last_sent_on, created_on in await db.fetch(
+                'SELECT job_id, user_id, time_str, message, last_sent_on, created_on FROM reminders'):
+            hour, minute = map(int, time_str.split(':'))
+            scheduler.add_job(send_reminder, CronTrigger(hour=hour, minute=minute), args=[user_id, message, job_id], id=job_id,
+                              replace_existing=True)
+            missed = lifecycle.missed_occurrence(time_str, last_sent_on, created_on, now)
+            if missed:
+                scheduler.add_job(send_reminder, args=[user_id, message, job_id, missed])
+    except Exception as e:
+        print(f"Error scheduling reminders: {e}")
+
+
+def run_partition_maintenance():
+    # The partition DDL and COPY archival use psycopg2, on a connection of their own
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        partitions.maintain(conn)
+    finally:
+        conn.close()
+
+
+async def maintain_partitions():
+    try:
+        await asyncio.to_thread(run_partition_maintenance)
+    except Exception as e:
+        print(f"Error maintaining partitions: {e}")
+
+
+async def handle_export_my_data(message):
+    chat_id = message.chat.id
+    user_id = await logged_in_user(message)
+    if user_id is None:
+        return
+    try:
+        export_id = await db.fetchval(export.CLAIM_QUERY.format('$1', '$2'), user_id, export.claim_cutoff())
+    except Exception as e:
+        print(f"Error starting data export: {e}")
+        export_id = None
+    if export_id is None:
+        await bot.send_message(chat_id, f'You can request one data export every {export.EXPORT_INTERVAL_HOURS} hours. Please try again later.')
+        return
+    await bot.send_message(chat_id, 'Preparing your data export, this can take a minute...')
+    status, size = 'failed', None
+    try:
+        with scratch.workspace.job('export') as job:
+            archive = export.ExportArchive(job.path('campus-connect-data.zip'))
+            async with db.acquire() as conn:
+                profile = await export.write_export_async(conn, user_id, archive)
+            report = export.report_row(profile)
+            if report:
+                job.track(await run_cpu(render_report, report, job.path('report.pdf')))
+                archive.file_member('report.pdf', job.path('report.pdf'))
+            size = archive.close(datetime.now())
+            job.track(archive.path)
+            if export.too_large(size):
+                status = 'too_large'
+                await bot.send_message(chat_id, 'Your data export is larger than Telegram allows. Please contact support for a copy.')
+            else:
+                with open(archive.path, 'rb') as export_file:
+                    await bot.send_document(chat_id, export_file, visible_file_name='campus-connect-data.zip',
+                                            caption='Everything we hold about you. See README.txt inside for what each file contains.')
+                status = 'done'
+    except ScratchQuotaExceeded as e:
+        print(f"Scratch space full: {e}")
+        await bot.send_message(chat_id, 'The server is busy. Please try your data export again in a few minutes.')
+    except Exception as e:
+        print(f"Error building data export for user {user_id}: {e}")
+        await bot.send_message(chat_id, 'Error building your data export. Please try again later.')
+    finally:
+        export.EXPORTS.inc(outcome=status)
+        try:
+            await db.execute(export.FINISH_QUERY.format('$1', '$2', '$3'), status, size, export_id)
+        except Exception as e:
+            print(f"Error recording data export: {e}")
+
+
+async def handle_set_reminder(message):
+    # The threaded runtime uses telebot's next-step handlers; AsyncTeleBot has
+    # none, so this goes through the REMINDER_TIME/REMINDER_MESSAGE states
+    chat_id = message.chat.id
+    if await logged_in_user(message) is None:
+        return
+    await bot.send_message(chat_id, 'Enter the reminder time in HH:MM format:')
+    user_sessions[chat_id]['state'] = states['REMINDER_TIME']
+
+
+async def handle_job_opportunities(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    for job in fetch_job_opportunities():
+        job_message = f"**{job[0]}** at **{job[1]}**\n{job[2]}\n[More Info]({job[3]})"
+        await bot.send_message(chat_id, job_message, parse_mode='Markdown', disable_web_page_preview=True)
+
+
+async def handle_share_document(message):
+    chat_id = message.chat.id
+    if await logged_in_user(message) is None:
+        return
+    await bot.send_message(chat_id, 'Upload the document you want to share:')
+    user_sessions[chat_id]['state'] = states['SHARE_DOCUMENT']
+
+
+async def handle_list_resources(message):
+    chat_id = message.chat.id
+    user_id = await logged_in_user(message)
+    if user_id is None:
+        return
+    try:
+        async with db.acquire() as conn:
+            resources = await conn.fetch('SELECT file_id, file_name, mime_type FROM shared_documents WHERE user_id = $1 AND shared_on >= $2',
+                                         user_id, await live_since(conn, 'shared_documents'))
+    except Exception as e:
+        print(f"Error fetching resources: {e}")
+        resources = []
+    if not resources:
+        await bot.send_message(chat_id, 'No resources available.')
+        return
+    for file_id, file_name, mime_type in resources:
+        if mime_type == 'application/pdf':
+            await bot.send_document(chat_id, file_id, caption=file_name)
+        elif mime_type.startswith('image/'):
+            await bot.send_photo(chat_id, file_id, caption=file_name)
+        else:
+            await bot.send_message(chat_id, f"{file_name} - Shared document")
+
+
+async def handle_feedback(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    await bot.send_message(chat_id, 'Enter your feedback:')
+    user_sessions[chat_id]['state'] = states['FEEDBACK']
+
+
+async def handle_feedback_message(message):
+    chat_id = message.chat.id
+    if feedback_buffer.append(user_sessions[chat_id]['userId'], message.text):
+        await bot.send_message(chat_id, 'Thank you for your feedback!')
+    else:
+        await bot.send_message(chat_id, 'Error saving feedback.')
+    user_sessions[chat_id]['state'] = None
+
+
+async def handle_feedback_digest(message):
+    chat_id = message.chat.id
+    if chat_id not in ADMIN_CHAT_IDS:
+        await bot.send_message(chat_id, 'This command is only available to admins.')
+        return
+    await feedback_buffer.flush()
+    try:
+        async with db.acquire() as conn:
+            text = await feedback.digest_async(conn)
+        await bot.send_message(chat_id, text)
+    except Exception as e:
+        print(f"Error building feedback digest: {e}")
+        await bot.send_message(chat_id, 'Error building the feedback digest.')
+
+
+async def handle_queue_stats(message):
+    chat_id = message.chat.id
+    if chat_id not in ADMIN_CHAT_IDS:
+        await bot.send_message(chat_id, 'This command is only available to admins.')
+        return
+    stats = bot.chat_locks.stats()
+    lines = [f"Active chats: {stats['chats']}", f"Queued updates: {stats['pending']}"]
+    lines += [f'Chat {chat}: {length} queued' for chat, length in stats['busiest']]
+    await bot.send_message(chat_id, '\n'.join(lines))
+
+
+async def handle_threads_only(message):
+    chat_id = message.chat.id
+    if chat_id not in ADMIN_CHAT_IDS:
+        await bot.send_message(chat_id, 'This command is only available to admins.')
+        return
+    await bot.send_message(chat_id, 'Broadcasts are not available in the asyncio runtime; run the bot with --runtime threads.')
+
+
+MENU_ACTIONS = {
+    'upload_markscard_pdf': handle_upload_markscard_pdf,
+    'upload_markscards_zip': handle_upload_markscards_zip,
+    'sgpa': handle_sgpa,
+    'cgpa': handle_cgpa,
+    'rank': handle_rank,
+    'profile': handle_profile,
+    'update_profile': handle_update_profile,
+    'generate_report': handle_generate_report,
+    'set_reminder': handle_set_reminder,
+    'share_document': handle_share_document,
+    'list_resources': handle_list_resources,
+    'job_opportunities': handle_job_opportunities,
+    'feedback': handle_feedback,
+    'logout': handle_logout,
+}
+
+
+def register_handlers(bot):
+    # Same order and filters as bot.register_handlers so both runtimes answer alike.
+    # Broadcast commands are answered with a refusal rather than falling through to handle_text.
+    bot.register_message_handler(handle_start, commands=['start'])
+    bot.register_message_handler(handle_menu, func=lambda message: message.text == 'Menu')
+    bot.register_callback_query_handler(handle_query, func=lambda call: True)
+    bot.register_message_handler(handle_register, commands=['register'])
+    bot.register_message_handler(handle_login, commands=['login'])
+    bot.register_message_handler(handle_sgpa, commands=['sgpa'])
+    bot.register_message_handler(handle_cgpa, commands=['cgpa'])
+    bot.register_message_handler(handle_rank, commands=['rank'])
+    bot.register_message_handler(handle_subject_stats, commands=['subject_stats'])
+    bot.register_message_handler(handle_my_subjects, commands=['my_subjects'])
+    bot.register_message_handler(idempotent(handle_export_my_data), commands=['export_my_data'])
+    bot.register_message_handler(handle_profile, commands=['profile'])
+    bot.register_callback_query_handler(handle_update_field, func=lambda call: call.data.startswith('update_'))
+    bot.register_message_handler(idempotent(handle_update_value), func=lambda message: user_sessions[message.chat.id]['state'] == states['UPDATE_PROFILE_FIELD'], content_types=['text'])
+    bot.register_message_handler(handle_upload_markscard_pdf, commands=['upload_markscard_pdf'])
+    bot.register_message_handler(handle_upload_markscards_zip, commands=['upload_markscards_zip'])
+    bot.register_message_handler(handle_feedback_digest, commands=['feedback_digest'])
+    bot.register_message_handler(handle_threads_only, commands=['broadcast', 'broadcast_status', 'broadcast_cancel'])
+    bot.register_message_handler(handle_queue_stats, commands=['queue_stats'])
+    bot.register_message_handler(idempotent(handle_text), func=lambda message: True, content_types=['text'])
+    bot.register_message_handler(idempotent(handle_document), content_types=['document', 'photo'])
+    bot.register_message_handler(handle_reset_password, commands=['reset_password'])
+    bot.register_message_handler(handle_username_for_reset, func=lambda message: user_sessions[message.chat.id]['state'] == states['LOGIN_USERNAME'], content_types=['text'])
+    bot.register_message_handler(idempotent(handle_new_password), func=lambda message: user_sessions[message.chat.id]['state'] == states['RESET_PASSWORD'], content_types=['text'])
+    bot.register_message_handler(handle_generate_report, commands=['generate_report'])
+    bot.register_message_handler(handle_set_reminder, commands=['set_reminder'])
+    bot.register_message_handler(handle_job_opportunities, commands=['job_opportunities'])
+    bot.register_message_handler(handle_share_document, commands=['share_document'])
+    bot.register_message_handler(handle_list_resources, commands=['list_resources'])
+    bot.register_message_handler(handle_feedback, commands=['feedback'])
+    bot.register_message_handler(idempotent(handle_feedback_message), func=lambda message: user_sessions[message.chat.id]['state'] == states['FEEDBACK'], content_types=['text'])
+
+
+def create_schema():
+    # The DDL lives in bot.create_tables; run it once over a short-lived psycopg2 connection
+    threaded.db_pool = storage.PostgresBackend(1, 1, DATABASE_URL)
+    try:
+        threaded.create_tables()
+    finally:
+        threaded.db_pool.closeall()
+        threaded.db_pool = None
+
+
+async def create_app(start_scheduler=True):
+    global DATABASE_URL, BOT_TOKEN, ADMIN_CHAT_IDS, db, bot, scheduler, cpu, feedback_buffer
+
+    # .env was loaded when bot was imported
+    with startup_phase('settings'):
+        DATABASE_URL = os.getenv('DATABASE_URL')
+        BOT_TOKEN = os.getenv('BOT_TOKEN')
+        ADMIN_CHAT_IDS = threaded.admin_chat_ids()
+        if storage.backend_name(DATABASE_URL) != 'postgres':
+            raise SystemExit('The asyncio runtime needs a PostgreSQL DATABASE_URL; run SQLite with --runtime threads')
+
+    with startup_phase('create_tables'):
+        await asyncio.to_thread(create_schema)
+
+    with startup_phase('db_pool'):
+        db = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=DB_POOL_SIZE)
+        cpu = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix='cpu')
+
+    with startup_phase('ranking'):
+        ranking.board = ranking.CohortRanking()
+        print(f"Ranked {ranking.board.rebuild(await db.fetch(ranking.RANK_QUERY))} students")
+
+    with startup_phase('feedback_buffer'):
+        feedback_buffer = feedback.AsyncFeedbackBuffer(db)
+        feedback_buffer.start()
+
+    with startup_phase('layout_cache'):
+        layout.load_cache()
+
+    with startup_phase('scratch_cleanup'):
+        removed = scratch.workspace.cleanup_stale()
+        usage = scratch.workspace.usage()
+        print(f"Scratch space {usage['root']}: removed {removed} stale job(s), quota {usage['quota']} bytes")
+
+    with startup_phase('telebot'):
+        telegram_api_url = os.getenv('TELEGRAM_API_URL')
+        if telegram_api_url:
+            asyncio_helper.API_URL = telegram_api_url.rstrip('/') + '/bot{0}/{1}'
+            asyncio_helper.FILE_URL = telegram_api_url.rstrip('/') + '/file/bot{0}/{1}'
+        updates.async_store = updates.AsyncUpdateStore(db)
+        lifecycle.async_jobs = lifecycle.AsyncJobStore(db)
+        bot = AsyncCampusBot(BOT_TOKEN, updates.async_store)
+        await bot.load_offset()
+        register_handlers(bot)
+        metrics.instrument_handlers(bot)
+
+    with startup_phase('scheduler'):
+        scheduler = AsyncIOScheduler()
+        if start_scheduler:
+            scheduler.start()
+            await schedule_reminders()
+            scheduler.add_job(maintain_partitions, CronTrigger(hour=3, minute=30), id='maintain_partitions', replace_existing=True)
+
+    metrics.DB_POOL_IN_USE.set_function(lambda: db.get_size() - db.get_idle_size())
+    metrics.DB_POOL_IDLE.set_function(db.get_idle_size)
+    metrics.SESSIONS.set_function(lambda: len(user_sessions))
+    metrics.QUEUE_DEPTH.set_function(bot.chat_locks.pending)
+    metrics.SCHEDULED_REMINDERS.set_function(lambda: sum(job.func is send_reminder for job in scheduler.get_jobs()))
+    return bot
+
+
+async def recover_jobs():
+    # As in bot.recover_jobs(): resume the marks-card conversions the previous
+    # process left running and mark the uploads that started them processed
+    resumed = []
+    for job_id, kind, chat_id, payload in await lifecycle.async_jobs.claim_interrupted():
+        if kind not in ('markscard', 'markscard_zip'):
+            await lifecycle.async_jobs.finish(job_id)
+            continue
+        lifecycle.JOBS_RECOVERED.inc(kind=kind)
+        init_session(chat_id)
+        convert = convert_markscard_zip if kind == 'markscard_zip' else convert_markscard
+        task = asyncio.create_task(resume_job(chat_id, convert(chat_id, payload['user_id'], payload['file_id'],
+                                                               payload['file_size'], job_id)))
+        # Shutdown waits for these like any other batch
+        bot.batches.add(task)
+        task.add_done_callback(bot.batches.discard)
+        resumed.append(payload)
+    update_ids = [payload['update_id'] for payload in resumed if payload.get('update_id')]
+    if update_ids:
+        await bot.update_store.record(update_ids)
+    if resumed:
+        print(f"Recovered {len(resumed)} interrupted job(s)")
+
+
+async def resume_job(chat_id, conversion):
+    async with bot.chat_locks.hold(chat_id):
+        try:
+            await conversion
+        except Exception as e:
+            print(f"Error resuming job for chat {chat_id}: {e}")
+
+
+async def shutdown():
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
+    if feedback_buffer is not None:
+        await feedback_buffer.close()
+    if asyncio_helper.session_manager.session is not None:
+        await asyncio_helper.session_manager.session.close()
+    if db is not None:
+        await db.close()
+    if cpu is not None:
+        cpu.shutdown(wait=True)
+
+
+async def run():
+    await create_app()
+    print(startup_report())
+    await recover_jobs()
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        metrics.start_metrics_server(int(metrics_port), os.getenv('METRICS_HOST', '127.0.0.1'))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    polling = asyncio.create_task(bot.infinity_polling(timeout=60))
+    try:
+        await asyncio.wait([polling, asyncio.create_task(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+        print('Shutting down')
+        # Stop taking updates, then give the batches in flight until the deadline
+        bot.accepting = False
+        polling.cancel()
+        started = time.monotonic()
+        if bot.batches:
+            done, pending = await asyncio.wait(set(bot.batches), timeout=lifecycle.SHUTDOWN_TIMEOUT)
+            if pending:
+                print(f"Shutdown: {len(pending)} batch(es) still running at the deadline")
+        print(f"Shutdown: updates drained in {time.monotonic() - started:.1f}s")
+    finally:
+        await shutdown()
+
+
+def main():
+    asyncio.run(run())
+    return 0
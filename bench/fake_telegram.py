@@ -0,0 +1,231 @@
+import argparse
+import itertools
+import json
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# A local stand-in for the parts of the Telegram Bot API the bot uses. Point
+# the bot at it with TELEGRAM_API_URL=http://127.0.0.1:<port>.
+
+BOT_USER = {'id': 1000000001, 'is_bot': True, 'first_name': 'Campus Connect', 'username': 'campus_connect_bot'}
+
+
+class FakeTelegram:
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._updates = []
+        # Ids keep growing across runs: the bot persists its offset and
+        # remembers processed updates and messages in the database
+        first_id = int(time.time() * 1000)
+        self._update_ids = itertools.count(first_id)
+        self._message_ids = itertools.count(first_id)
+        self._files = {}
+        self.outbox = {}
+        self.calls = {}
+
+    # Inbound side, used by the load generator
+
+    def _user(self, chat_id):
+        return {'id': chat_id, 'is_bot': False, 'first_name': f'Student {chat_id}'}
+
+    def _message(self, chat_id, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self._user(chat_id),
+        }
+        message.update(fields)
+        return message
+
+    def push_update(self, **update):
+        with self._lock:
+            update['update_id'] = next(self._update_ids)
+            self._updates.append(update)
+            self._lock.notify_all()
+        return update['update_id']
+
+    def send_text(self, chat_id, text):
+        fields = {'text': text}
+        if text.startswith('/'):
+            fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self.push_update(message=self._message(chat_id, **fields))
+
+    def send_document(self, chat_id, content, file_name='markscard.pdf', mime_type='application/pdf'):
+        file_id = f'file-{chat_id}-{next(self._message_ids)}'
+        with self._lock:
+            self._files[file_id] = content
+        document = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': file_name,
+                    'mime_type': mime_type, 'file_size': len(content)}
+        return self.push_update(message=self._message(chat_id, document=document))
+
+    def press_button(self, chat_id, data):
+        callback = {
+            'id': str(next(self._message_ids)),
+            'from': self._user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': self._message(chat_id, text='Use the menu below to navigate:', **{'from': BOT_USER}),
+        }
+        return self.push_update(callback_query=callback)
+
+    def wait_for_reply(self, chat_id, after, match=None, timeout=30):
+        # Wait for a reply to chat_id beyond index `after` whose text contains `match`
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                replies = self.outbox.get(chat_id, [])
+                for reply in replies[after:]:
+                    if match is None or any(m in reply['text'] for m in match):
+                        return reply, replies[after]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, replies[after] if len(replies) > after else None
+                self._lock.wait(remaining)
+
+    def reply_count(self, chat_id):
+        with self._lock:
+            return len(self.outbox.get(chat_id, []))
+
+    # Bot API side
+
+    def get_updates(self, params):
+        offset = int(params.get('offset', 0) or 0)
+        limit = int(params.get('limit', 100) or 100)
+        timeout = float(params.get('timeout', 0) or 0)
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._lock.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def record_reply(self, method, params):
+        chat_id = int(params['chat_id'])
+        text = params.get('text') or params.get('caption') or ''
+        fields = {'text': text} if method in ('sendMessage', 'editMessageText') else {'caption': text}
+        message = self._message(chat_id, **fields)
+        message['from'] = BOT_USER
+        if method == 'editMessageText' and params.get('message_id'):
+            message['message_id'] = int(params['message_id'])
+        with self._lock:
+            self.outbox.setdefault(chat_id, []).append({'method': method, 'text': text, 'at': time.monotonic()})
+            self._lock.notify_all()
+        return message
+
+    def call(self, method, params):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return self.get_updates(params)
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText'):
+            return self.record_reply(method, params)
+        if method == 'getFile':
+            file_id = params['file_id']
+            with self._lock:
+                content = self._files.get(file_id)
+            if content is None:
+                raise KeyError(file_id)
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(content),
+                    'file_path': f'documents/{file_id}.pdf'}
+        if method in ('answerCallbackQuery', 'deleteWebhook', 'deleteMessage', 'setMyCommands'):
+            return True
+        raise NotImplementedError(method)
+
+    def file_content(self, file_path):
+        file_id = file_path.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        with self._lock:
+            return self._files.get(file_id)
+
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _params(self):
+            parsed = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            content_type = self.headers.get('Content-Type', '')
+            if body and content_type.startswith('application/json'):
+                params.update(json.loads(body))
+            elif body and content_type.startswith('application/x-www-form-urlencoded'):
+                params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+            elif body and content_type.startswith('multipart/form-data'):
+                # aiohttp sends every field in the form; uploaded files are dropped
+                message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+                for part in message.get_payload():
+                    if part.get_filename() is None:
+                        params[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True).decode()
+            return parsed.path, params
+
+        def _send(self, status, body, content_type='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self):
+            path, params = self._params()
+            parts = path.strip('/').split('/')
+            if parts[0] == 'file' and len(parts) >= 3:
+                content = fake.file_content('/'.join(parts[2:]))
+                if content is None:
+                    self._send(404, b'not found', 'text/plain')
+                else:
+                    self._send(200, content, 'application/octet-stream')
+                return
+            if len(parts) != 2 or not parts[0].startswith('bot'):
+                self._send(404, b'{"ok": false, "error_code": 404, "description": "Not Found"}')
+                return
+            try:
+                result = fake.call(parts[1], params)
+                body = {'ok': True, 'result': result}
+                status = 200
+            except NotImplementedError as e:
+                body = {'ok': False, 'error_code': 404, 'description': f'Not Found: method {e} not faked'}
+                status = 404
+            except KeyError as e:
+                body = {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'}
+                status = 400
+            self._send(status, json.dumps(body).encode())
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(fake=None, port=0, host='127.0.0.1'):
+    fake = fake or FakeTelegram()
+    server = ThreadingHTTPServer((host, port), _make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-telegram', daemon=True).start()
+    return fake, server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local fake Telegram Bot API server.')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args(argv)
+    fake, server = serve(port=args.port)
+    print(f'Fake Bot API listening on http://127.0.0.1:{server.server_address[1]}')
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
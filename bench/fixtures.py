@@ -0,0 +1,67 @@
+import random
+
+import openpyxl
+
+# Subject codes per semester, in the order they appear on a VTU marks card
+SEMESTER_SUBJECTS = {
+    '21-3': ['21MAT31', '21CS32', '21CS33', '21CS34', '21CSL35', '21SCR36', '21KBK37', '21CS382'],
+    '21-5': ['21CS51', '21CS52', '21CS53', '21CS54', '21CSL55', '21RMI56', '21CIV57', '21CSL582'],
+    '22-1': ['BMATS101', 'BPHYS102', 'BPOPS103', 'BESCK104B', 'BETCK105I', 'BENGK106', 'BICOK107', 'BIDTK158'],
+    '22-3': ['BCS301', 'BCS302', 'BCS303', 'BCS304', 'BCSL305', 'BCS306A', 'BSCK307', 'BCS358C', 'BNSK359'],
+}
+
+HEADER = ['Subject Code', 'Subject Name', 'Internal Marks', 'External Marks', 'Total', 'Result', 'Announced / Updated on']
+
+
+def marks_rows(semester='22-3', seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for code in SEMESTER_SUBJECTS[semester]:
+        internal = rng.randint(20, 50)
+        external = rng.randint(18, 50)
+        total = internal + external
+        result = 'P' if total >= 40 and external >= 18 else 'F'
+        rows.append([code, f'Subject {code}', internal, external, total, result, '2024-02-12'])
+    return rows
+
+
+def write_marks_xlsx(path, semester='22-3', seed=0, filler_rows=0):
+    # Mimics the sheet Aspose produces: header, one row per subject, then page furniture
+    wb = openpyxl.Workbook()
+    sheet = wb.active
+    sheet.append(HEADER)
+    for row in marks_rows(semester, seed):
+        sheet.append(row)
+    for i in range(filler_rows):
+        sheet.append([f'Note {i}', 'Nothing to see here', None, None, None, None, None])
+    wb.save(path)
+    return path
+
+
+def write_marks_pdf(path, semester='22-3', seed=0):
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Table, TableStyle
+
+    styles = getSampleStyleSheet()
+    doc = SimpleDocTemplate(path, pagesize=landscape(A4))
+    table = Table([HEADER] + marks_rows(semester, seed))
+    table.setStyle(TableStyle([('GRID', (0, 0), (-1, -1), 0.5, colors.black)]))
+    doc.build([
+        Paragraph('Visvesvaraya Technological University', styles['Title']),
+        Paragraph('Student Name: Test Student &nbsp;&nbsp; University Seat Number: 1XX22CS001', styles['Normal']),
+        table,
+    ])
+    return path
+
+
+def random_totals(count, seed=0):
+    rng = random.Random(seed)
+    return [rng.randint(0, 100) for _ in range(count)]
+
+
+def random_subject_codes(count, seed=0):
+    rng = random.Random(seed)
+    codes = [code for subjects in SEMESTER_SUBJECTS.values() for code in subjects] + ['UNKNOWN1', 'XYZ999']
+    return [rng.choice(codes) for _ in range(count)]
@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from dotenv import load_dotenv
+
+# Project modules read their settings when imported, so .env goes first
+load_dotenv()
+
+import storage
+from bench import fixtures
+from bench.fake_telegram import serve
+
+# A step is (kind, payload, expected reply fragments or None for "any reply")
+JOURNEYS = {
+    'register': [
+        ('text', '/start', ['Use the button below']),
+        ('text', '/register', ['Enter your username:']),
+        ('text', '{username}', ['Enter your password:']),
+        ('text', 'secret-{username}', ['Enter your full name:']),
+        ('text', 'Student {chat_id}', ['Enter your semester:']),
+        ('text', '3', ['Enter your college name:']),
+        ('text', 'Example Institute of Technology', ['Enter your mobile number:']),
+        ('text', '9{chat_id:09d}', ['Enter your branch:']),
+        ('text', 'CSE', ['Enter your year scheme:']),
+        ('text', '2022', ['Registration successful']),
+    ],
+    'login': [
+        ('button', 'logout', ['logged out']),
+        ('text', '/login', ['Enter your username:']),
+        ('text', '{username}', ['Enter your password:']),
+        ('text', 'secret-{username}', ['Login successful']),
+    ],
+    'upload_card': [
+        ('text', '/upload_markscard_pdf', ['Please upload your marks card PDF.']),
+        ('document', 'markscard', ['processed successfully', 'already uploaded']),
+    ],
+    'sgpa_cgpa': [
+        ('text', '/sgpa', None),
+        ('text', '/cgpa', None),
+    ],
+    'reminders': [
+        ('text', '/set_reminder', ['Enter the reminder time']),
+        ('text', '08:30', ['Enter the reminder message:']),
+        ('text', 'Attend the placement talk', ['Reminder set successfully!']),
+    ],
+}
+DEFAULT_JOURNEYS = ['register', 'login', 'upload_card', 'sgpa_cgpa', 'reminders']
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.first_reply = []
+        self.completion = []
+        self.per_step = {}
+        self.sent = 0
+        self.errors = {}
+
+    def record(self, step, first, complete):
+        with self._lock:
+            self.sent += 1
+            self.first_reply.append(first)
+            self.completion.append(complete)
+            self.per_step.setdefault(step, []).append(complete)
+
+    def error(self, step, kind):
+        with self._lock:
+            self.sent += 1
+            key = f'{step}: {kind}'
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+
+def run_chat(fake, chat_id, journeys, stats, run_id, card_pdf, timeout):
+    username = f'load-{run_id}-{chat_id}'
+    for journey in journeys:
+        for kind, payload, expect in JOURNEYS[journey]:
+            step = f'{journey}/{payload.split()[0] if kind == "text" else kind}'
+            if kind == 'text' and not payload.startswith('/'):
+                step = f'{journey}/<text>'
+            after = fake.reply_count(chat_id)
+            sent_at = time.monotonic()
+            if kind == 'text':
+                fake.send_text(chat_id, payload.format(username=username, chat_id=chat_id))
+            elif kind == 'button':
+                fake.press_button(chat_id, payload)
+            else:
+                fake.send_document(chat_id, card_pdf)
+            reply, first = fake.wait_for_reply(chat_id, after, expect, timeout)
+            if reply is None:
+                stats.error(step, 'unexpected reply' if first else 'timeout')
+                return
+            if expect is None and 'Error' in reply['text']:
+                stats.error(step, 'error reply')
+                continue
+            stats.record(step, first['at'] - sent_at, reply['at'] - sent_at)
+
+
+def spawn_bot(api_url, database_url, runtime='threads'):
+    env = dict(os.environ)
+    env.update({'BOT_TOKEN': '123456:LOADTEST', 'TELEGRAM_API_URL': api_url})
+    if database_url:
+        env['DATABASE_URL'] = database_url
+    bot_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot.py')
+    return subprocess.Popen([sys.executable, bot_path, '--runtime', runtime], cwd=os.path.dirname(bot_path), env=env)
+
+
+def summarize(stats, elapsed, fake):
+    ms = lambda value: round(value * 1000, 2) if value is not None else None  # noqa: E731
+    errors = sum(stats.errors.values())
+    return {
+        'updates_sent': stats.sent,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_updates_per_s': round(stats.sent / elapsed, 2) if elapsed else None,
+        'error_rate': round(errors / stats.sent, 4) if stats.sent else 0,
+        'errors': stats.errors,
+        'first_reply_ms': {f'p{p}': ms(percentile(stats.first_reply, p)) for p in (50, 90, 99)},
+        'completion_ms': {f'p{p}': ms(percentile(stats.completion, p)) for p in (50, 90, 99)},
+        'per_step_p50_ms': {step: ms(statistics.median(values)) for step, values in sorted(stats.per_step.items())},
+        'per_step_p90_ms': {step: ms(percentile(values, 90)) for step, values in sorted(stats.per_step.items())},
+        'api_calls': dict(fake.calls),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay scripted user journeys against the bot through a fake Bot API.')
+    parser.add_argument('--chats', type=int, default=1000, help='number of simulated chats')
+    parser.add_argument('--concurrency', type=int, default=100, help='chats driven at the same time')
+    parser.add_argument('--journey', action='append', choices=sorted(JOURNEYS),
+                        help='journeys to run per chat, in order (default: all)')
+    parser.add_argument('--port', type=int, default=0, help='port for the fake Bot API')
+    parser.add_argument('--spawn-bot', action='store_true', help='start bot.py against the fake API')
+    parser.add_argument('--database-url', action='append',
+                        help='database for the spawned bot (defaults to $DATABASE_URL); give a postgresql:// and '
+                             'a sqlite:/// URL to compare the storage backends')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for each reply')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds to wait for a spawned bot to start')
+    parser.add_argument('--runtime', action='append', choices=['threads', 'asyncio'],
+                        help='runtime for the spawned bot; give it twice to compare throughput (default: threads)')
+    parser.add_argument('--output', help='write the summary as JSON to this file')
+    args = parser.parse_args(argv)
+
+    runtimes = args.runtime or ['threads']
+    databases = args.database_url or [os.getenv('DATABASE_URL')]
+    if (len(runtimes) > 1 or len(databases) > 1) and not args.spawn_bot:
+        parser.error('comparing runtimes or databases needs --spawn-bot')
+    if 'asyncio' in runtimes and any(storage.backend_name(url) == 'sqlite' for url in databases):
+        parser.error('the asyncio runtime needs a PostgreSQL database')
+
+    # A comparison is keyed by whatever varies: runtime, backend or both
+    runs = {}
+    for runtime in runtimes:
+        for database_url in databases:
+            label = [runtime] if len(runtimes) > 1 else []
+            if len(databases) > 1:
+                label.append(storage.backend_name(database_url) if len({storage.backend_name(url) for url in databases}) > 1
+                             else database_url)
+            runs['/'.join(label) or runtime] = (runtime, database_url)
+
+    with tempfile.TemporaryDirectory(prefix='campus-connect-load-') as workdir:
+        with open(fixtures.write_marks_pdf(os.path.join(workdir, 'card.pdf')), 'rb') as f:
+            card_pdf = f.read()
+        summaries = {label: run_load(args, runtime, database_url, card_pdf) for label, (runtime, database_url) in runs.items()}
+
+    # A single run keeps the flat summary
+    result = next(iter(summaries.values())) if len(summaries) == 1 else summaries
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+    return 1 if any(summary['error_rate'] > 0 for summary in summaries.values()) else 0
+
+
+def run_load(args, runtime, database_url, card_pdf):
+    fake, server = serve(port=args.port)
+    api_url = f'http://127.0.0.1:{server.server_address[1]}'
+    print(f'Fake Bot API listening on {api_url}')
+
+    bot_process = None
+    if args.spawn_bot:
+        bot_process = spawn_bot(api_url, database_url, runtime)
+        time.sleep(args.warmup)
+
+    stats = Stats()
+    run_id = uuid4().hex[:8]
+    journeys = args.journey or DEFAULT_JOURNEYS
+    chat_ids = [700000000 + i for i in range(args.chats)]
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(run_chat, fake, chat_id, journeys, stats, run_id, card_pdf, args.timeout)
+                       for chat_id in chat_ids]
+        for future in futures:
+            future.result()
+    finally:
+        elapsed = time.monotonic() - started
+        if bot_process:
+            bot_process.terminate()
+            bot_process.wait(timeout=30)
+        server.shutdown()
+        server.server_close()
+
+    return summarize(stats, elapsed, fake)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dotenv import load_dotenv
+
+# Project modules read their settings when imported, so .env goes first
+load_dotenv()
+
+from bench import fixtures
+from grading import get_scheme
+from marks import convert_pdf_to_excel, convert_to_grade_points, get_credits_for_subject, process_excel_data
+from reports import render_report
+
+BENCHMARKS = {}
+
+
+class Skip(Exception):
+    pass
+
+
+def benchmark(name, number=1, memory=False):
+    # setup(workdir) returns the callable that is timed
+    def register(setup):
+        BENCHMARKS[name] = {'setup': setup, 'number': number, 'memory': memory}
+        return setup
+    return register
+
+
+def aspose_available():
+    try:
+        import aspose.pdf  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+@benchmark('convert_to_grade_points', number=10)
+def bench_grade_points(workdir):
+    totals = fixtures.random_totals(10000)
+    return lambda: [convert_to_grade_points(total) for total in totals]
+
+
+@benchmark('grade_points_batch', number=10)
+def bench_grade_points_batch(workdir):
+    totals = fixtures.random_totals(10000)
+    scheme = get_scheme('2022')
+    return lambda: scheme.grade_points(totals)
+
+
+@benchmark('get_credits_for_subject', number=10)
+def bench_credits(workdir):
+    codes = fixtures.random_subject_codes(10000)
+    return lambda: [get_credits_for_subject(code) for code in codes]
+
+
+@benchmark('process_excel_data', number=5)
+def bench_process_excel(workdir):
+    path = fixtures.write_marks_xlsx(os.path.join(workdir, 'card.xlsx'))
+    return lambda: process_excel_data(path)
+
+
+@benchmark('process_excel_data_large', number=2, memory=True)
+def bench_process_excel_large(workdir):
+    # Aspose output with a lot of page furniture after the subject table
+    path = fixtures.write_marks_xlsx(os.path.join(workdir, 'card_large.xlsx'), filler_rows=2000)
+    return lambda: process_excel_data(path)
+
+
+@benchmark('aspose_pdf_to_excel')
+def bench_aspose(workdir):
+    if not aspose_available():
+        raise Skip('aspose.pdf is not installed')
+    pdf_path = fixtures.write_marks_pdf(os.path.join(workdir, 'card.pdf'))
+    excel_path = os.path.join(workdir, 'card_converted.xlsx')
+    return lambda: convert_pdf_to_excel(pdf_path, excel_path)
+
+
+@benchmark('render_report', number=2)
+def bench_render_report(workdir):
+    user = ('Test Student', '3', 'Example Institute of Technology', 'CSE', 8.42, 8.17)
+    report_path = os.path.join(workdir, 'report.pdf')
+    return lambda: render_report(user, report_path)
+
+
+@benchmark('end_to_end_card', memory=True)
+def bench_end_to_end(workdir):
+    if not aspose_available():
+        raise Skip('aspose.pdf is not installed')
+    pdf_path = fixtures.write_marks_pdf(os.path.join(workdir, 'e2e.pdf'))
+    excel_path = os.path.join(workdir, 'e2e.xlsx')
+
+    def run():
+        convert_pdf_to_excel(pdf_path, excel_path)
+        return process_excel_data(excel_path)
+    return run
+
+
+def run_benchmark(name, spec, workdir, repeat, warmup):
+    fn = spec['setup'](workdir)
+    number = spec['number']
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - start) / number)
+    timings.sort()
+    result = {
+        'runs': repeat,
+        'number': number,
+        'min_s': timings[0],
+        'median_s': statistics.median(timings),
+        'p95_s': timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))],
+        'mean_s': statistics.fmean(timings),
+    }
+    if spec['memory']:
+        tracemalloc.start()
+        try:
+            fn()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or 'median_s' not in current or 'median_s' not in previous:
+            continue
+        for key in ('median_s', 'peak_bytes'):
+            if key in current and key in previous and previous[key] > 0:
+                ratio = current[key] / previous[key]
+                if ratio > 1 + tolerance:
+                    regressions.append((name, key, previous[key], current[key], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the marks-card, grading and report hot paths.')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results')
+    parser.add_argument('--baseline', help='previous results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown relative to the baseline before failing (0.25 = 25%%)')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--only', action='append', help='run only the named benchmark (repeatable)')
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='campus-connect-bench-') as workdir:
+        for name, spec in BENCHMARKS.items():
+            if args.only and name not in args.only:
+                continue
+            try:
+                results[name] = run_benchmark(name, spec, workdir, args.repeat, args.warmup)
+            except Skip as e:
+                results[name] = {'skipped': str(e)}
+                print(f'{name:<28} skipped: {e}')
+                continue
+            result = results[name]
+            line = f'{name:<28} median {result["median_s"] * 1000:10.3f} ms   p95 {result["p95_s"] * 1000:10.3f} ms'
+            if 'peak_bytes' in result:
+                line += f'   peak {result["peak_bytes"] / 1024:.0f} KiB'
+            print(line)
+
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, key, before, after, ratio in regressions:
+            print(f'REGRESSION {name} {key}: {before:.6g} -> {after:.6g} ({(ratio - 1) * 100:+.1f}%)')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
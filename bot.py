@@ -1,33 +1,74 @@
-import telebot
-from telebot import types
+import time
+_import_started = time.perf_counter()
+
+from dotenv import load_dotenv
+# The project modules below read their settings when imported, so .env goes first
+load_dotenv()
+
+from telebot import types, apihelper
 import requests
 import os
-import psycopg2
-from psycopg2 import pool
-import openpyxl
-from dotenv import load_dotenv
+import sys
+import argparse
+from contextlib import contextmanager
 import bcrypt
-import tempfile
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-from reportlab.lib.units import inch
-from PIL import Image, ImageDraw
+import zipfile
+import threading
 import logging
+import atexit
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from uuid import uuid4
-import time
-import aspose.pdf as ap
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
-from reportlab.lib.styles import getSampleStyleSheet
-
-load_dotenv()
-
-# Initialize PostgreSQL connection pool
-DATABASE_URL = os.getenv('DATABASE_URL')
-db_pool = pool.SimpleConnectionPool(1, 10, DATABASE_URL)
+from datetime import datetime
+import metrics
+import tracing
+import feedback
+import broadcast
+import updates
+import dispatcher
+import ranking
+import analytics
+import partitions
+import export
+import storage
+import lifecycle
+from updates import idempotent
+from marks import convert_pdf_to_excel, analyze_marks
+from reports import render_report
+import layout
+import bulk
+import scratch
+from scratch import ScratchQuotaExceeded
+from layout import UnrecognizedLayoutError
+
+# Created by create_app(); importing this module has no side effects
+DATABASE_URL = None
+BOT_TOKEN = None
+db_pool = None
+bot = None
+scheduler = None
+ADMIN_CHAT_IDS = set()
+
+startup_timings = []
+
+@contextmanager
+def startup_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        startup_timings.append((name, elapsed))
+        metrics.STARTUP_SECONDS.set(elapsed, phase=name)
+
+def startup_report():
+    total = sum(elapsed for _, elapsed in startup_timings)
+    lines = ['Startup time breakdown:']
+    for name, elapsed in startup_timings:
+        share = elapsed / total * 100 if total else 0
+        lines.append(f'  {name:<24} {elapsed * 1000:9.1f} ms  {share:5.1f}%')
+    lines.append(f'  {"total":<24} {total * 1000:9.1f} ms')
+    return '\n'.join(lines)
 
 def get_db_connection():
     try:
@@ -44,6 +85,11 @@ def close_db_connection(conn):
     except Exception as e:
         print(f"Error closing the database connection: {e}")
 
+def live_since(cur, table):
+    # Archived months are gone from the live tables; bounding a listing by them
+    # lets the planner skip partitions past retention that are not archived yet
+    return partitions.fetch_live_since(cur, table) if db_pool.partitioning else datetime.min
+
 # Create tables function
 def create_tables():
     conn = get_db_connection()
@@ -90,6 +136,8 @@ def create_tables():
                     FOREIGN KEY(user_id) REFERENCES users(user_id)
                 )
             """)
+            cur.execute('ALTER TABLE marks_cards ADD COLUMN IF NOT EXISTS semester TEXT')
+            cur.execute('ALTER TABLE marks_cards ADD COLUMN IF NOT EXISTS sgpa REAL')
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS reminders (
                     reminder_id SERIAL PRIMARY KEY,
@@ -100,6 +148,9 @@ def create_tables():
                     FOREIGN KEY(user_id) REFERENCES users(user_id)
                 )
             """)
+            cur.execute('ALTER TABLE reminders ADD COLUMN IF NOT EXISTS created_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
+            # The occurrence last sent, so a restart neither repeats nor silently skips one
+            cur.execute('ALTER TABLE reminders ADD COLUMN IF NOT EXISTS last_sent_on TIMESTAMP')
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS job_opportunities (
                     job_id SERIAL PRIMARY KEY,
@@ -118,6 +169,10 @@ def create_tables():
                     FOREIGN KEY(user_id) REFERENCES users(user_id)
                 )
             """)
+            feedback.create_summary_tables(cur)
+            broadcast.create_tables(cur)
+            updates.create_tables(cur)
+            analytics.create_tables(cur)
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS shared_documents (
                     doc_id SERIAL PRIMARY KEY,
@@ -128,6 +183,11 @@ def create_tables():
                     FOREIGN KEY(user_id) REFERENCES users(user_id)
                 )
             """)
+            cur.execute('ALTER TABLE shared_documents ADD COLUMN IF NOT EXISTS shared_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
+            # marks_cards, feedback and shared_documents become monthly partitioned tables on Postgres
+            partitions.create_tables(cur, db_pool.partitioning)
+            export.create_tables(cur)
+            lifecycle.create_tables(cur)
             conn.commit()
             print('Tables created successfully.')
         except Exception as e:
@@ -138,13 +198,6 @@ def create_tables():
     else:
         print('Failed to connect to the database.')
 
-# Call the function to create tables when bot starts
-create_tables()
-
-# Initialize bot
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-bot = telebot.TeleBot(BOT_TOKEN)
-
 # States for user registration and login
 states = {
     'USERNAME': 0,
@@ -165,6 +218,7 @@ states = {
     'REMINDER_MESSAGE': 15,
     'FEEDBACK': 16,
     'SHARE_DOCUMENT': 17,
+    'MARKSCARD_ZIP': 18,
 }
 
 user_sessions = {}
@@ -181,40 +235,35 @@ def hash_password(password):
 def check_password(stored_password, provided_password):
     return bcrypt.checkpw(provided_password.encode('utf-8'), stored_password)
 
-@bot.message_handler(commands=['start'])
-def handle_start(message):
-    init_session(message.chat.id)
-    
-    # Sending image
-    with open('start.jpg', 'rb') as image:
-        bot.send_photo(message.chat.id, image, caption="Welcome to the Student Bot!")
-    
-    description = """
+START_DESCRIPTION = """
     This bot helps you manage your student information. You can:
     - Register and login
-    - Upload your marks card
-    - Check your SGPA and CGPA
+    - Upload your marks card, or a ZIP of several
+    - Check your SGPA and CGPA, and your rank in your class
+    - Compare your subject marks with your class
     - View and update your profile
     - Set and manage reminders
     - Generate and download your SGPA/CGPA report
     - Get internship/job opportunities
     - Share resources
     - Give feedback
+    - Download a copy of all your data
     """
-    bot.send_message(message.chat.id, description)
-    
+
+def start_markup():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     markup.add(types.KeyboardButton('Menu'))
-    bot.send_message(message.chat.id, 'Use the button below to navigate the menu:', reply_markup=markup)
+    return markup
 
-@bot.message_handler(func=lambda message: message.text == 'Menu')
-def handle_menu(message):
+def menu_markup():
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(types.InlineKeyboardButton("Register", callback_data='register'),
                types.InlineKeyboardButton("Login", callback_data='login'),
                types.InlineKeyboardButton("Upload Marks Card PDF", callback_data='upload_markscard_pdf'),
+               types.InlineKeyboardButton("Bulk Upload (ZIP)", callback_data='upload_markscards_zip'),
                types.InlineKeyboardButton("SGPA", callback_data='sgpa'),
                types.InlineKeyboardButton("CGPA", callback_data='cgpa'),
+               types.InlineKeyboardButton("Class Rank", callback_data='rank'),
                types.InlineKeyboardButton("Profile", callback_data='profile'),
                types.InlineKeyboardButton("Update Profile", callback_data='update_profile'),
                types.InlineKeyboardButton("Generate Report", callback_data='generate_report'),
@@ -224,9 +273,21 @@ def handle_menu(message):
                types.InlineKeyboardButton("Job Opportunities", callback_data='job_opportunities'),
                types.InlineKeyboardButton("Feedback", callback_data='feedback'),
                types.InlineKeyboardButton("Logout", callback_data='logout'))
-    bot.send_message(message.chat.id, 'Use the menu below to navigate:', reply_markup=markup)
+    return markup
+
+def handle_start(message):
+    init_session(message.chat.id)
+    
+    # Sending image
+    with open('start.jpg', 'rb') as image:
+        bot.send_photo(message.chat.id, image, caption="Welcome to the Student Bot!")
+    
+    bot.send_message(message.chat.id, START_DESCRIPTION)
+    bot.send_message(message.chat.id, 'Use the button below to navigate the menu:', reply_markup=start_markup())
+
+def handle_menu(message):
+    bot.send_message(message.chat.id, 'Use the menu below to navigate:', reply_markup=menu_markup())
 
-@bot.callback_query_handler(func=lambda call: True)
 def handle_query(call):
     chat_id = call.message.chat.id
     user_id = user_sessions[chat_id]['userId']
@@ -243,10 +304,14 @@ def handle_query(call):
             handle_login(call.message)
     elif call.data == 'upload_markscard_pdf':
         handle_upload_markscard_pdf(call.message)
+    elif call.data == 'upload_markscards_zip':
+        handle_upload_markscards_zip(call.message)
     elif call.data == 'sgpa':
         handle_sgpa(call.message)
     elif call.data == 'cgpa':
         handle_cgpa(call.message)
+    elif call.data == 'rank':
+        handle_rank(call.message)
     elif call.data == 'profile':
         handle_profile(call.message)
     elif call.data == 'update_profile':
@@ -266,7 +331,6 @@ def handle_query(call):
     elif call.data == 'logout':
         handle_logout(call.message)
 
-@bot.message_handler(commands=['register'])
 def handle_register(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -277,7 +341,6 @@ def handle_register(message):
     user_sessions[chat_id]['state'] = states['USERNAME']
     bot.send_message(chat_id, 'Enter your username:')
 
-@bot.message_handler(commands=['login'])
 def handle_login(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -288,7 +351,6 @@ def handle_login(message):
     user_sessions[chat_id]['state'] = states['LOGIN_USERNAME']
     bot.send_message(chat_id, 'Enter your username:')
 
-@bot.message_handler(commands=['sgpa'])
 def handle_sgpa(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -314,7 +376,6 @@ def handle_sgpa(message):
             bot.send_message(chat_id, f'Error fetching SGPA: {e}')
             close_db_connection(conn)
 
-@bot.message_handler(commands=['cgpa'])
 def handle_cgpa(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -361,7 +422,86 @@ def handle_cgpa(message):
             bot.send_message(chat_id, f'Error calculating CGPA: {e}')
             close_db_connection(conn)
 
-@bot.message_handler(commands=['profile'])
+def handle_rank(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    user_id = user_sessions[chat_id]['userId']
+    if user_id is None:
+        bot.send_message(chat_id, 'Please login first using /login.')
+        return
+
+    conn = get_db_connection()
+    if conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT college, branch, semester FROM users WHERE user_id = %s', (user_id,))
+            cohort = cur.fetchone()
+            cur.close()
+            close_db_connection(conn)
+        except Exception as e:
+            bot.send_message(chat_id, f'Error fetching rank: {e}')
+            close_db_connection(conn)
+            return
+
+        result = ranking.board.rank(user_id)
+        if not cohort or ranking.cohort_key(*cohort) is None:
+            bot.send_message(chat_id, 'Add your college, branch and semester with Update Profile in the menu to see your rank.')
+        elif result is None:
+            bot.send_message(chat_id, 'No SGPA records found. Please upload your marks card using /upload_markscard_pdf.')
+        else:
+            bot.send_message(chat_id, ranking.format_rank(result, *cohort))
+
+def handle_subject_stats(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    user_id = user_sessions[chat_id]['userId']
+    if user_id is None:
+        bot.send_message(chat_id, 'Please login first using /login.')
+        return
+    parts = message.text.split()
+    if len(parts) < 2:
+        bot.send_message(chat_id, 'Usage: /subject_stats <subject code>, e.g. /subject_stats 21CS51')
+        return
+    code = parts[1].upper()
+
+    conn = get_db_connection()
+    if conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT college, year_scheme FROM users WHERE user_id = %s', (user_id,))
+            college, year_scheme = cur.fetchone() or (None, None)
+            cur.execute(analytics.SUBJECT_STATS_QUERY.format('%s'), (code,))
+            stats = cur.fetchall()
+            cur.execute(analytics.GRADE_COUNTS_QUERY.format('%s'), (code,))
+            grades = cur.fetchall()
+            cur.close()
+            close_db_connection(conn)
+            bot.send_message(chat_id, analytics.format_subject_stats(code, stats, grades, college, year_scheme))
+        except Exception as e:
+            bot.send_message(chat_id, f'Error fetching subject statistics: {e}')
+            close_db_connection(conn)
+
+def handle_my_subjects(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    user_id = user_sessions[chat_id]['userId']
+    if user_id is None:
+        bot.send_message(chat_id, 'Please login first using /login.')
+        return
+
+    conn = get_db_connection()
+    if conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(analytics.MY_SUBJECTS_QUERY.format('%s'), (user_id,))
+            rows = cur.fetchall()
+            cur.close()
+            close_db_connection(conn)
+            bot.send_message(chat_id, analytics.format_my_subjects(rows))
+        except Exception as e:
+            bot.send_message(chat_id, f'Error fetching your subjects: {e}')
+            close_db_connection(conn)
+
 def handle_profile(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -399,6 +539,16 @@ def handle_profile(message):
             bot.send_message(chat_id, f'Error fetching profile: {e}')
             close_db_connection(conn)
 
+def update_profile_markup():
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(types.InlineKeyboardButton("Full Name", callback_data='update_full_name'),
+               types.InlineKeyboardButton("Semester", callback_data='update_semester'),
+               types.InlineKeyboardButton("College", callback_data='update_college'),
+               types.InlineKeyboardButton("Mobile", callback_data='update_mobile'),
+               types.InlineKeyboardButton("Branch", callback_data='update_branch'),
+               types.InlineKeyboardButton("Year Scheme", callback_data='update_year_scheme'))
+    return markup
+
 def handle_update_profile(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -407,17 +557,9 @@ def handle_update_profile(message):
         bot.send_message(chat_id, 'Please login first using /login.')
         return
 
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    markup.add(types.InlineKeyboardButton("Full Name", callback_data='update_full_name'),
-               types.InlineKeyboardButton("Semester", callback_data='update_semester'),
-               types.InlineKeyboardButton("College", callback_data='update_college'),
-               types.InlineKeyboardButton("Mobile", callback_data='update_mobile'),
-               types.InlineKeyboardButton("Branch", callback_data='update_branch'),
-               types.InlineKeyboardButton("Year Scheme", callback_data='update_year_scheme'))
-    bot.send_message(chat_id, 'Choose the information you want to update:', reply_markup=markup)
+    bot.send_message(chat_id, 'Choose the information you want to update:', reply_markup=update_profile_markup())
     user_sessions[chat_id]['state'] = states['UPDATE_PROFILE']
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('update_'))
 def handle_update_field(call):
     chat_id = call.message.chat.id
     field = call.data.split('_')[1]
@@ -425,7 +567,6 @@ def handle_update_field(call):
     user_sessions[chat_id]['state'] = states['UPDATE_PROFILE_FIELD']  # Correctly set the state
     bot.send_message(chat_id, f'Enter your new {field.replace("_", " ")}:')
 
-@bot.message_handler(func=lambda message: user_sessions[message.chat.id]['state'] == states['UPDATE_PROFILE_FIELD'], content_types=['text'])
 def handle_update_value(message):
     chat_id = message.chat.id
     field = user_sessions[chat_id]['update_field']
@@ -436,10 +577,17 @@ def handle_update_value(message):
     if conn:
         try:
             cur = conn.cursor()
-            cur.execute(f'UPDATE users SET {field} = %s WHERE user_id = %s', (new_value, user_id))
+            cur.execute(f'UPDATE users SET {field} = %s WHERE user_id = %s RETURNING college, branch, semester, sgpa',
+                        (new_value, user_id))
+            row = cur.fetchone()
+            if field in analytics.COHORT_FIELDS:
+                analytics.move_student(cur, user_id)
             conn.commit()
             cur.close()
             close_db_connection(conn)
+            if row:
+                # Changing college, branch or semester moves the student to another cohort
+                ranking.board.update(user_id, *row)
             bot.send_message(chat_id, f'{field.replace("_", " ").capitalize()} updated successfully!')
         except Exception as e:
             bot.send_message(chat_id, f'Error updating {field.replace("_", " ")}: {e}')
@@ -453,7 +601,8 @@ def fetch_uploaded_documents(user_id):
     if conn:
         try:
             cur = conn.cursor()
-            cur.execute('SELECT file_id, file_name, mime_type FROM shared_documents WHERE user_id = %s', (user_id,))
+            cur.execute('SELECT file_id, file_name, mime_type FROM shared_documents WHERE user_id = %s AND shared_on >= %s',
+                        (user_id, live_since(cur, 'shared_documents')))
             documents = cur.fetchall()
             cur.close()
             close_db_connection(conn)
@@ -463,7 +612,6 @@ def fetch_uploaded_documents(user_id):
             close_db_connection(conn)
             return []
 
-@bot.message_handler(commands=['upload_markscard_pdf'])
 def handle_upload_markscard_pdf(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -474,7 +622,16 @@ def handle_upload_markscard_pdf(message):
     user_sessions[chat_id]['state'] = states['MARKSCARD_PDF']
     bot.send_message(chat_id, 'Please upload your marks card PDF.')
 
-@bot.message_handler(func=lambda message: True, content_types=['text'])
+def handle_upload_markscards_zip(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    user_id = user_sessions[chat_id]['userId']
+    if user_id is None:
+        bot.send_message(chat_id, 'Please login first using /login.')
+        return
+    user_sessions[chat_id]['state'] = states['MARKSCARD_ZIP']
+    bot.send_message(chat_id, 'Please upload a ZIP file containing your marks card PDFs.')
+
 def handle_text(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -568,7 +725,7 @@ def handle_text(message):
                 cur = conn.cursor()
                 cur.execute('SELECT user_id, password FROM users WHERE username = %s', (username,))
                 user = cur.fetchone()
-                if user and check_password(user[1].tobytes(), provided_password):  # Convert stored password to bytes
+                if user and check_password(bytes(user[1]), provided_password):  # Convert stored password to bytes
                     user_sessions[chat_id]['userId'] = user[0]
                     bot.send_message(chat_id, 'Login successful! You can now use the menu to navigate.')
                     user_sessions[chat_id]['state'] = None
@@ -623,7 +780,6 @@ def handle_text(message):
     else:
         bot.send_message(chat_id, 'Unknown command. Please use /menu to see available options.')
 
-@bot.message_handler(content_types=['document', 'photo'])
 def handle_document(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -635,44 +791,14 @@ def handle_document(message):
 
     if state == states['MARKSCARD_PDF']:
         if message.content_type == 'document' and message.document.mime_type == 'application/pdf':
-            file_id = message.document.file_id
-            user_id = user_sessions[chat_id]['userId']
-            
-            # Check if the file already exists
-            if check_existing_marks_card(user_id, file_id):
-                sgpa = fetch_sgpa(user_id)
-                bot.send_message(chat_id, f'You have already uploaded this marks card. Your SGPA is: {sgpa:.2f}')
-                return
-            
-            file_info = bot.get_file(file_id)
-            file_url = f'https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}'
-
-            response = requests.get(file_url)
-
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as pdf_file:
-                pdf_file.write(response.content)
-                pdf_path = pdf_file.name
-
-            excel_path = pdf_path.replace('.pdf', '.xlsx')
-
-            # Convert PDF to Excel
-            document = ap.Document(pdf_path)
-            save_option = ap.ExcelSaveOptions()
-            document.save(excel_path, save_option)
-
-            # Process Excel data
-            sgpa = process_excel_data(excel_path)
-            
-            # Save SGPA to database
-            save_sgpa_to_db(user_id, sgpa)
-            
-            # Save the marks card to the database
-            save_marks_card(user_id, file_id)
-            
-            bot.send_message(chat_id, 'Marks card PDF uploaded and processed successfully. SGPA has been updated.')
-            user_sessions[chat_id]['state'] = None
+            convert_markscard(chat_id, user_sessions[chat_id]['userId'], message.document.file_id, message.document.file_size)
         else:
             bot.send_message(chat_id, 'Unsupported file format. Please upload a PDF file.')
+    elif state == states['MARKSCARD_ZIP']:
+        if message.content_type == 'document' and bulk.is_zip(message.document):
+            handle_markscard_zip(message)
+        else:
+            bot.send_message(chat_id, 'Unsupported file format. Please upload a ZIP file of marks card PDFs.')
     elif state == states['SHARE_DOCUMENT']:
         if message.content_type in ['document', 'photo']:
             file_id = message.document.file_id if message.content_type == 'document' else message.photo[-1].file_id
@@ -685,12 +811,127 @@ def handle_document(message):
             else:
                 bot.send_message(chat_id, 'Error sharing document.')
 
+def convert_markscard(chat_id, user_id, file_id, file_size=None, job_id=None):
+    # Recorded as a pending job while it runs, so a restart in the middle
+    # converts the card again instead of losing the upload
+    payload = {'user_id': user_id, 'file_id': file_id, 'file_size': file_size, 'update_id': updates.current_update_id()}
+    with lifecycle.jobs.track('markscard', chat_id, payload, job_id) as pending:
+        # Check if the file already exists
+        with tracing.span('check_existing_marks_card'):
+            existing = check_existing_marks_card(user_id, file_id)
+        if existing:
+            sgpa = fetch_sgpa(user_id)
+            bot.send_message(chat_id, f'You have already uploaded this marks card. Your SGPA is: {sgpa:.2f}')
+            return
+
+        # The PDF and its Excel conversion live in a per-upload scratch
+        # directory that is removed however processing ends
+        try:
+            with scratch.workspace.job('markscard') as job:
+                pdf_source = job.store('markscard.pdf', download_file(file_id, file_size))
+                excel_path = job.path('markscard.xlsx')
+
+                # Convert PDF to Excel
+                with tracing.span('convert_pdf'):
+                    convert_pdf_to_excel(pdf_source, excel_path)
+                job.track(excel_path)
+
+                # Process Excel data
+                with tracing.span('process_excel_data'):
+                    analysis = analyze_marks(excel_path, fetch_year_scheme(user_id))
+                sgpa = analysis['sgpa']
+        except UnrecognizedLayoutError as e:
+            print(f"Unrecognized marks card layout from user {user_id} ({file_id}): {e}")
+            bot.send_message(chat_id, 'Sorry, the layout of this marks card was not recognized, so no SGPA was calculated. It has been flagged for review.')
+            return
+        except ScratchQuotaExceeded as e:
+            print(f"Scratch space full: {e}")
+            bot.send_message(chat_id, 'The server is busy processing other marks cards. Please try again in a few minutes.')
+            return
+        if sgpa is None:
+            print(f"No credited subjects on marks card from user {user_id} ({file_id})")
+            bot.send_message(chat_id, 'None of the subjects on this marks card are recognized yet, so no SGPA was calculated.')
+            return
+
+        # Save SGPA and the marks card to the database
+        with tracing.span('db_writes'):
+            save_sgpa_to_db(user_id, sgpa)
+            save_marks_card(user_id, file_id, analysis['semester'], sgpa, analysis['subjects'])
+
+        pending.done()
+        bot.send_message(chat_id, 'Marks card PDF uploaded and processed successfully. SGPA has been updated.')
+        user_sessions[chat_id]['state'] = None
+
+def download_file(file_id, file_size=None):
+    with tracing.span('get_file'):
+        file_info = bot.get_file(file_id)
+    file_url = (apihelper.FILE_URL or 'https://api.telegram.org/file/bot{0}/{1}').format(BOT_TOKEN, file_info.file_path)
+
+    with tracing.span('download', size=file_size), metrics.TELEGRAM_API_SECONDS.time(method='downloadFile'):
+        response = requests.get(file_url)
+    response.raise_for_status()
+    return response.content
+
+def handle_markscard_zip(message):
+    chat_id = message.chat.id
+    convert_markscard_zip(chat_id, user_sessions[chat_id]['userId'], message.document.file_id, message.document.file_size)
+
+def convert_markscard_zip(chat_id, user_id, zip_file_id, file_size=None, job_id=None):
+    payload = {'user_id': user_id, 'file_id': zip_file_id, 'file_size': file_size, 'update_id': updates.current_update_id()}
+    with lifecycle.jobs.track('markscard_zip', chat_id, payload, job_id) as pending, \
+            scratch.workspace.job('markscard-zip') as job:
+        try:
+            archive = job.store('markscards.zip', download_file(zip_file_id, file_size))
+        except ScratchQuotaExceeded as e:
+            print(f"Scratch space full: {e}")
+            bot.send_message(chat_id, 'The server is busy processing other marks cards. Please try again in a few minutes.')
+            return
+        process_markscard_zip(chat_id, user_id, zip_file_id, archive, pending)
+
+def process_markscard_zip(chat_id, user_id, zip_file_id, archive, pending=None):
+    progress = bot.send_message(chat_id, 'Processing your marks cards...')
+    last_edit = [0.0]
+    progress_lock = threading.Lock()
+
+    def on_progress(done, total):
+        # Edit the one progress message in place, at most every couple of seconds
+        with progress_lock:
+            now = time.monotonic()
+            if done < total and now - last_edit[0] < 2:
+                return
+            last_edit[0] = now
+            bot.edit_message_text(f'Processed {done}/{total} marks cards...', chat_id, progress.message_id)
+
+    try:
+        with tracing.span('process_zip'):
+            results = bulk.process_zip(archive, fetch_year_scheme(user_id), on_progress)
+    except zipfile.BadZipFile:
+        bot.edit_message_text('That file is not a valid ZIP archive.', chat_id, progress.message_id)
+        return
+
+    summary, by_semester = bulk.summarize(results)
+    with tracing.span('db_writes'):
+        for result in by_semester.values():
+            card_file_id = f'{zip_file_id}/{result.name}'
+            if not check_existing_marks_card(user_id, card_file_id):
+                save_marks_card(user_id, card_file_id, result.semester, result.sgpa, result.subjects)
+        if by_semester:
+            # The profile SGPA tracks the most recent semester in the upload
+            latest = max(by_semester, key=lambda semester: int(semester) if semester.isdigit() else -1)
+            save_sgpa_to_db(user_id, by_semester[latest].sgpa)
+
+    if pending:
+        pending.done()
+    bot.send_message(chat_id, summary)
+    user_sessions[chat_id]['state'] = None
+
 def check_existing_marks_card(user_id, file_id):
     conn = get_db_connection()
     if conn:
         try:
             cur = conn.cursor()
-            cur.execute('SELECT card_id FROM marks_cards WHERE user_id = %s AND file_id = %s', (user_id, file_id))
+            cur.execute('SELECT card_id FROM marks_cards WHERE user_id = %s AND file_id = %s AND uploaded_on >= %s',
+                        (user_id, file_id, partitions.duplicate_card_since()))
             existing_card = cur.fetchone()
             cur.close()
             close_db_connection(conn)
@@ -715,12 +956,31 @@ def fetch_sgpa(user_id):
             close_db_connection(conn)
             return None
 
-def save_marks_card(user_id, file_id):
+def fetch_year_scheme(user_id):
     conn = get_db_connection()
     if conn:
         try:
             cur = conn.cursor()
-            cur.execute('INSERT INTO marks_cards (user_id, file_id) VALUES (%s, %s)', (user_id, file_id))
+            cur.execute('SELECT year_scheme FROM users WHERE user_id = %s', (user_id,))
+            row = cur.fetchone()
+            cur.close()
+            close_db_connection(conn)
+            return row[0] if row else None
+        except Exception as e:
+            print(f"Error fetching year scheme: {e}")
+            close_db_connection(conn)
+            return None
+
+def save_marks_card(user_id, file_id, semester=None, sgpa=None, subjects=()):
+    conn = get_db_connection()
+    if conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('INSERT INTO marks_cards (user_id, file_id, semester, sgpa) VALUES (%s, %s, %s, %s) RETURNING card_id',
+                        (user_id, file_id, semester, sgpa))
+            card_id = cur.fetchone()[0]
+            # Subject marks and their aggregates are written in the same transaction as the card
+            analytics.record_card(cur, user_id, card_id, sgpa, subjects)
             conn.commit()
             cur.close()
             close_db_connection(conn)
@@ -730,71 +990,19 @@ def save_marks_card(user_id, file_id):
             close_db_connection(conn)
             return False
 
-def process_excel_data(excel_path):
-    wb = openpyxl.load_workbook(excel_path)
-    sheet = wb.active
-
-    total_points = 0
-    total_credits = 0
-
-    # Adjust the expected number of columns based on the Excel file's structure
-    for row in sheet.iter_rows(min_row=2, values_only=True):
-        if len(row) >= 4:  # Ensure there are at least 4 values in the row
-            subject_code, subject_name, internal_marks, external_marks = row[:4]
-            
-            # Ensure internal_marks and external_marks are not None and convert them to integers
-            if internal_marks is None or not isinstance(internal_marks, (int, float)):
-                internal_marks = 0
-            if external_marks is None or not isinstance(external_marks, (int, float)):
-                external_marks = 0
-            
-            total_marks = int(internal_marks) + int(external_marks)
-            grade_points = convert_to_grade_points(total_marks)
-            credits = get_credits_for_subject(subject_code)
-            total_points += grade_points * credits
-            total_credits += credits
-
-    sgpa = total_points / total_credits if total_credits != 0 else 0
-    return sgpa
-
-def convert_to_grade_points(total_marks):
-    if total_marks >= 90:
-        return 10
-    elif total_marks >= 80:
-        return 9
-    elif total_marks >= 70:
-        return 8
-    elif total_marks >= 60:
-        return 7
-    elif total_marks >= 50:
-        return 6
-    elif total_marks >= 40:
-        return 5
-    else:
-        return 0
-
-def get_credits_for_subject(subject_code):
-    credits_map = {
-        #5th sem 21 batch
-       '21CS51': 3,'21CSL582': 1,'21CS52': 4,'21CS53': 3,'21CS54': 3,'21CSL55': 1,'21RMI56': 2,'21CIV57': 1,
-       #3rd sem 21 batch
-        '21MAT31':3,'21CS382':1,'21CS32':4,'21CS33':4,'21CS34':3,'21CSL35':1,'21SCR36':1,'21KBK37':1,
-        #3rd sem 22 batch
-        'BCS301':4,'BCS302':4,'BCS303':4,'BCS304':3,'BCSL305':1,'BSCK307':1,'BNSK359':0,'BCS306A':3,'BCS358C':1,
-        #1st sem 22 batch
-        'BMATS101':4,'BPHYS102':4,'BPOPS103':3,'BESCK104B':3,'BETCK105I':3,'BENGK106':1,'BICOK107':1,'BIDTK158':1,
-    }
-    return credits_map.get(subject_code, 0)
-
 def save_sgpa_to_db(user_id, sgpa):
     conn = get_db_connection()
     if conn:
         try:
             cur = conn.cursor()
-            cur.execute('UPDATE users SET sgpa = %s WHERE user_id = %s', (sgpa, user_id))
+            cur.execute('UPDATE users SET sgpa = %s WHERE user_id = %s RETURNING college, branch, semester, sgpa', (sgpa, user_id))
+            row = cur.fetchone()
             conn.commit()
             cur.close()
             close_db_connection(conn)
+            if row:
+                # The stored REAL, not the computed float, so ties match a rebuild from the table
+                ranking.board.update(user_id, *row)
         except Exception as e:
             print(f"Error saving SGPA to database: {e}")
             close_db_connection(conn)
@@ -815,14 +1023,12 @@ def save_marks_to_db(user_id, subject_code, subject_name, internal_marks, extern
             close_db_connection(conn)
             return False
     return False
-@bot.message_handler(commands=['reset_password'])
 def handle_reset_password(message):
     chat_id = message.chat.id
     init_session(chat_id)
     bot.send_message(chat_id, 'Enter your username:')
     user_sessions[chat_id]['state'] = states['LOGIN_USERNAME']
 
-@bot.message_handler(func=lambda message: user_sessions[message.chat.id]['state'] == states['LOGIN_USERNAME'], content_types=['text'])
 def handle_username_for_reset(message):
     chat_id = message.chat.id
     username = message.text
@@ -830,7 +1036,6 @@ def handle_username_for_reset(message):
     bot.send_message(chat_id, 'Enter your new password:')
     user_sessions[chat_id]['state'] = states['RESET_PASSWORD']
 
-@bot.message_handler(func=lambda message: user_sessions[message.chat.id]['state'] == states['RESET_PASSWORD'], content_types=['text'])
 def handle_new_password(message):
     chat_id = message.chat.id
     new_password = hash_password(message.text)
@@ -856,7 +1061,7 @@ def handle_logout(message):
     user_sessions[chat_id] = {'state': None, 'username': None, 'userId': None}
     bot.send_message(chat_id, 'You have been logged out successfully.')
 
-def generate_report(user_id):
+def generate_report(user_id, report_path=None):
     conn = get_db_connection()
     if conn:
         try:
@@ -866,37 +1071,9 @@ def generate_report(user_id):
             cur.close()
             close_db_connection(conn)
 
-            report_path = f'report_{user_id}.pdf'
-            c = SimpleDocTemplate(report_path, pagesize=letter)
-
-            styles = getSampleStyleSheet()
-            title_style = styles['Title']
-            title = Paragraph('Campus Connect', title_style)
-
-            table_data = [
-                ['Field', 'Details'],
-                ['Full Name', user[0]],
-                ['Semester', user[1]],
-                ['College', user[2]],
-                ['Branch', user[3]],
-                ['SGPA', f'{user[4]:.2f}'],
-                ['CGPA', f'{user[5]:.2f}'],
-            ]
-
-            table = Table(table_data, colWidths=[150, 350])
-            table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 14),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ]))
-
-            elements = [title, table]
-            c.build(elements)
+            report_path = report_path or f'report_{user_id}.pdf'
+            with tracing.span('render_report'):
+                render_report(user, report_path)
             return report_path
         except Exception as e:
             logging.error(f"Error generating report: {e}")
@@ -904,7 +1081,6 @@ def generate_report(user_id):
             return None
     else:
         return None
-@bot.message_handler(commands=['generate_report'])
 def handle_generate_report(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -913,12 +1089,106 @@ def handle_generate_report(message):
         bot.send_message(chat_id, 'Please login first using /login.')
         return
 
-    report_path = generate_report(user_id)
-    if report_path:
-        with open(report_path, 'rb') as report_file:
-            bot.send_document(chat_id, report_file)
-    else:
-        bot.send_message(chat_id, 'Error generating report.')
+    try:
+        with scratch.workspace.job('report') as job:
+            report_path = generate_report(user_id, job.path(f'report_{user_id}.pdf'))
+            if report_path:
+                job.track(report_path)
+                with open(report_path, 'rb') as report_file:
+                    bot.send_document(chat_id, report_file)
+            else:
+                bot.send_message(chat_id, 'Error generating report.')
+    except ScratchQuotaExceeded as e:
+        print(f"Scratch space full: {e}")
+        bot.send_message(chat_id, 'Error generating report. Please try again in a few minutes.')
+
+def claim_export(user_id):
+    # Returns the new export's id, or None while the user's last export is too recent
+    conn = get_db_connection()
+    if conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(export.CLAIM_QUERY.format('%(user_id)s', '%(cutoff)s'),
+                        {'user_id': user_id, 'cutoff': export.claim_cutoff()})
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+            return row[0] if row else None
+        except Exception as e:
+            print(f"Error starting data export: {e}")
+            return None
+        finally:
+            close_db_connection(conn)
+
+def finish_export(export_id, status, size=None):
+    export.EXPORTS.inc(outcome=status)
+    conn = get_db_connection()
+    if conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(export.FINISH_QUERY.format('%s', '%s', '%s'), (status, size, export_id))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            print(f"Error recording data export: {e}")
+        finally:
+            close_db_connection(conn)
+
+def build_export(user_id, job):
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError('no database connection')
+    archive = export.ExportArchive(job.path('campus-connect-data.zip'))
+    try:
+        with tracing.span('write_export'):
+            profile = export.write_export(conn, user_id, archive, db_pool.partitioning)
+    finally:
+        close_db_connection(conn)
+    report = export.report_row(profile)
+    if report:
+        with tracing.span('render_report'):
+            report_path = render_report(report, job.path('report.pdf'))
+        job.track(report_path)
+        archive.file_member('report.pdf', report_path)
+    archive.close(datetime.now())
+    return job.track(archive.path)
+
+def handle_export_my_data(message):
+    chat_id = message.chat.id
+    init_session(chat_id)
+    user_id = user_sessions[chat_id]['userId']
+    if user_id is None:
+        bot.send_message(chat_id, 'Please login first using /login.')
+        return
+
+    export_id = claim_export(user_id)
+    if export_id is None:
+        bot.send_message(chat_id, f'You can request one data export every {export.EXPORT_INTERVAL_HOURS} hours. Please try again later.')
+        return
+    bot.send_message(chat_id, 'Preparing your data export, this can take a minute...')
+    status, size = 'failed', None
+    try:
+        # The ZIP is built in a scratch job and removed once it has been sent
+        with scratch.workspace.job('export') as job:
+            path = build_export(user_id, job)
+            size = os.path.getsize(path)
+            if export.too_large(size):
+                status = 'too_large'
+                bot.send_message(chat_id, 'Your data export is larger than Telegram allows. Please contact support for a copy.')
+            else:
+                with open(path, 'rb') as export_file:
+                    bot.send_document(chat_id, export_file, visible_file_name='campus-connect-data.zip',
+                                      caption='Everything we hold about you. See README.txt inside for what each file contains.')
+                status = 'done'
+    except ScratchQuotaExceeded as e:
+        print(f"Scratch space full: {e}")
+        bot.send_message(chat_id, 'The server is busy. Please try your data export again in a few minutes.')
+    except Exception as e:
+        print(f"Error building data export for user {user_id}: {e}")
+        bot.send_message(chat_id, 'Error building your data export. Please try again later.')
+    finally:
+        # A failed export does not count towards the rate limit
+        finish_export(export_id, status, size)
 
 def add_reminder(user_id, time_str, message):
     job_id = str(uuid4())
@@ -933,7 +1203,7 @@ def add_reminder(user_id, time_str, message):
             close_db_connection(conn)
 
             hour, minute = map(int, time_str.split(':'))
-            scheduler.add_job(send_reminder, CronTrigger(hour=hour, minute=minute), args=[user_id, message], id=job_id)
+            scheduler.add_job(send_reminder, CronTrigger(hour=hour, minute=minute), args=[user_id, message, job_id], id=job_id)
             return True
         except Exception as e:
             print(f"Error adding reminder: {e}")
@@ -941,11 +1211,22 @@ def add_reminder(user_id, time_str, message):
             return False
     return False
 
-def send_reminder(user_id, message):
+def send_reminder(user_id, message, job_id=None, occurrence=None):
     conn = get_db_connection()
     if conn:
         try:
             cur = conn.cursor()
+            if job_id is not None:
+                # Claim this occurrence first; if another run (a catch-up after a
+                # restart, or an overlapping process) already sent it, skip it
+                cur.execute(lifecycle.CLAIM_REMINDER.format('%(occurrence)s', '%(job_id)s'),
+                            {'occurrence': occurrence or lifecycle.occurrence(datetime.now()), 'job_id': job_id})
+                claimed = cur.fetchone() is not None
+                conn.commit()
+                if not claimed:
+                    cur.close()
+                    close_db_connection(conn)
+                    return
             cur.execute('SELECT chat_id FROM users WHERE user_id = %s', (user_id,))
             chat_id = cur.fetchone()[0]
             cur.close()
@@ -961,19 +1242,35 @@ def schedule_reminders():
     if conn:
         try:
             cur = conn.cursor()
-            cur.execute('SELECT job_id, user_id, time_str, message FROM reminders')
+            cur.execute('SELECT job_id, user_id, time_str, message, last_sent_on, created_on FROM reminders')
             reminders = cur.fetchall()
             cur.close()
             close_db_connection(conn)
 
-            for job_id, user_id, time_str, message in reminders:
+            now = datetime.now()
+            for job_id, user_id, time_str, message, last_sent_on, created_on in reminders:
                 hour, minute = map(int, time_str.split(':'))
-                scheduler.add_job(send_reminder, CronTrigger(hour=hour, minute=minute), args=[user_id, message], id=job_id)
+                scheduler.add_job(send_reminder, CronTrigger(hour=hour, minute=minute), args=[user_id, message, job_id], id=job_id)
+                # Send an occurrence that fell while the bot was down, if it is recent
+                missed = lifecycle.missed_occurrence(time_str, last_sent_on, created_on, now)
+                if missed:
+                    scheduler.add_job(send_reminder, args=[user_id, message, job_id, missed])
         except Exception as e:
             print(f"Error scheduling reminders: {e}")
             close_db_connection(conn)
 
-@bot.message_handler(commands=['set_reminder'])
+def maintain_partitions():
+    if not db_pool.partitioning:
+        return
+    conn = get_db_connection()
+    if conn:
+        try:
+            partitions.maintain(conn)
+        except Exception as e:
+            print(f"Error maintaining partitions: {e}")
+        finally:
+            close_db_connection(conn)
+
 def handle_set_reminder(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -1002,12 +1299,6 @@ def get_reminder_message(message, reminder_time):
     else:
         bot.send_message(chat_id, 'Error setting reminder.')
 
-scheduler = BackgroundScheduler()
-scheduler.start()
-
-schedule_reminders()
-
-@bot.message_handler(commands=['job_opportunities'])
 def handle_job_opportunities(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -1030,7 +1321,6 @@ def fetch_job_opportunities():
     ]
     return job_opportunities
 
-@bot.message_handler(commands=['share_document'])
 def handle_share_document(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -1059,7 +1349,6 @@ def save_shared_document(user_id, file_id, file_name, mime_type):
             return False
     return False
 
-@bot.message_handler(commands=['list_resources'])
 def handle_list_resources(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -1086,7 +1375,8 @@ def fetch_resources(user_id):
     if conn:
         try:
             cur = conn.cursor()
-            cur.execute('SELECT file_id, file_name, mime_type FROM shared_documents WHERE user_id = %s', (user_id,))
+            cur.execute('SELECT file_id, file_name, mime_type FROM shared_documents WHERE user_id = %s AND shared_on >= %s',
+                        (user_id, live_since(cur, 'shared_documents')))
             resources = cur.fetchall()
             cur.close()
             close_db_connection(conn)
@@ -1096,7 +1386,6 @@ def fetch_resources(user_id):
             close_db_connection(conn)
             return []
 
-@bot.message_handler(commands=['feedback'])
 def handle_feedback(message):
     chat_id = message.chat.id
     init_session(chat_id)
@@ -1104,42 +1393,317 @@ def handle_feedback(message):
     bot.send_message(chat_id, 'Enter your feedback:')
     user_sessions[chat_id]['state'] = states['FEEDBACK']
 
-@bot.message_handler(func=lambda message: user_sessions[message.chat.id]['state'] == states['FEEDBACK'], content_types=['text'])
 def handle_feedback_message(message):
     chat_id = message.chat.id
     user_id = user_sessions[chat_id]['userId']
-    feedback = message.text
+    feedback_text = message.text
 
-    if save_feedback(user_id, feedback):
+    if save_feedback(user_id, feedback_text):
         bot.send_message(chat_id, 'Thank you for your feedback!')
     else:
         bot.send_message(chat_id, 'Error saving feedback.')
 
     user_sessions[chat_id]['state'] = None
 
-def save_feedback(user_id, feedback):
+def save_feedback(user_id, feedback_text):
+    # Buffered and written in batches by feedback.buffer
+    return feedback.buffer.append(user_id, feedback_text)
+
+def admin_chat_ids():
+    return {int(chat_id) for chat_id in os.getenv('ADMIN_CHAT_IDS', '').replace(',', ' ').split()}
+
+def is_admin(chat_id):
+    return chat_id in ADMIN_CHAT_IDS
+
+def handle_feedback_digest(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        bot.send_message(chat_id, 'This command is only available to admins.')
+        return
+    # Include anything still waiting in the buffer
+    feedback.buffer.flush()
     conn = get_db_connection()
     if conn:
         try:
             cur = conn.cursor()
-            cur.execute('INSERT INTO feedback (user_id, feedback_text) VALUES (%s, %s)', (user_id, feedback))
-            conn.commit()
+            text = feedback.digest(cur)
             cur.close()
-            close_db_connection(conn)
-            return True
+            bot.send_message(chat_id, text)
         except Exception as e:
-            print(f"Error saving feedback: {e}")
+            print(f"Error building feedback digest: {e}")
+            bot.send_message(chat_id, 'Error building the feedback digest.')
+        finally:
             close_db_connection(conn)
-            return False
-    return False
+    else:
+        bot.send_message(chat_id, 'Failed to connect to the database.')
+
+def handle_broadcast(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        bot.send_message(chat_id, 'This command is only available to admins.')
+        return
+    try:
+        filters, text = broadcast.parse_command(message.text)
+    except ValueError as e:
+        bot.send_message(chat_id, str(e))
+        return
+    if not text:
+        bot.send_message(chat_id, 'Usage:\n/broadcast college=...; branch=...; semester=...\nYour message\n\n'
+                                  'The filter line is optional; without it everyone receives the message.')
+        return
+    broadcast_id = broadcast.broadcaster.create(chat_id, text, filters)
+    if broadcast_id is None:
+        bot.send_message(chat_id, 'Failed to connect to the database.')
+    else:
+        bot.send_message(chat_id, f'Broadcast #{broadcast_id} started. Check progress with /broadcast_status {broadcast_id}')
+
+def parse_broadcast_id(message):
+    parts = message.text.split()
+    return int(parts[1].lstrip('#')) if len(parts) > 1 and parts[1].lstrip('#').isdigit() else None
+
+def handle_broadcast_status(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        bot.send_message(chat_id, 'This command is only available to admins.')
+        return
+    lines = broadcast.broadcaster.status(parse_broadcast_id(message))
+    if lines is None:
+        bot.send_message(chat_id, 'Failed to connect to the database.')
+    else:
+        bot.send_message(chat_id, '\n'.join(lines) or 'No broadcasts found.')
+
+def handle_broadcast_cancel(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        bot.send_message(chat_id, 'This command is only available to admins.')
+        return
+    broadcast_id = parse_broadcast_id(message)
+    if broadcast_id is None:
+        bot.send_message(chat_id, 'Usage: /broadcast_cancel <id>')
+    elif broadcast.broadcaster.cancel(broadcast_id):
+        bot.send_message(chat_id, f'Broadcast #{broadcast_id} cancelled.')
+    else:
+        bot.send_message(chat_id, f'Broadcast #{broadcast_id} is not running.')
+
+def handle_queue_stats(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        bot.send_message(chat_id, 'This command is only available to admins.')
+        return
+    stats = bot.dispatcher.stats()
+    lines = [f"Workers: {stats['workers']}", f"Active chats: {stats['mailboxes']}", f"Queued updates: {stats['pending']}"]
+    lines += [f'Chat {chat}: {length} queued' for chat, length in stats['busiest']]
+    bot.send_message(chat_id, '\n'.join(lines))
+
+def register_handlers(bot):
+    # Registration order matters: telebot runs the first handler whose filters match.
+    # Handlers with side effects are wrapped in idempotent() so a redelivered message is not processed twice.
+    bot.register_message_handler(handle_start, commands=['start'])
+    bot.register_message_handler(handle_menu, func=lambda message: message.text == 'Menu')
+    bot.register_callback_query_handler(handle_query, func=lambda call: True)
+    bot.register_message_handler(handle_register, commands=['register'])
+    bot.register_message_handler(handle_login, commands=['login'])
+    bot.register_message_handler(handle_sgpa, commands=['sgpa'])
+    bot.register_message_handler(handle_cgpa, commands=['cgpa'])
+    bot.register_message_handler(handle_rank, commands=['rank'])
+    bot.register_message_handler(handle_subject_stats, commands=['subject_stats'])
+    bot.register_message_handler(handle_my_subjects, commands=['my_subjects'])
+    bot.register_message_handler(idempotent(handle_export_my_data), commands=['export_my_data'])
+    bot.register_message_handler(handle_profile, commands=['profile'])
+    bot.register_callback_query_handler(handle_update_field, func=lambda call: call.data.startswith('update_'))
+    bot.register_message_handler(idempotent(handle_update_value), func=lambda message: user_sessions[message.chat.id]['state'] == states['UPDATE_PROFILE_FIELD'], content_types=['text'])
+    bot.register_message_handler(handle_upload_markscard_pdf, commands=['upload_markscard_pdf'])
+    bot.register_message_handler(handle_upload_markscards_zip, commands=['upload_markscards_zip'])
+    bot.register_message_handler(handle_feedback_digest, commands=['feedback_digest'])
+    bot.register_message_handler(idempotent(handle_broadcast), commands=['broadcast'])
+    bot.register_message_handler(handle_broadcast_status, commands=['broadcast_status'])
+    bot.register_message_handler(handle_broadcast_cancel, commands=['broadcast_cancel'])
+    bot.register_message_handler(handle_queue_stats, commands=['queue_stats'])
+    bot.register_message_handler(idempotent(handle_text), func=lambda message: True, content_types=['text'])
+    bot.register_message_handler(idempotent(handle_document), content_types=['document', 'photo'])
+    bot.register_message_handler(handle_reset_password, commands=['reset_password'])
+    bot.register_message_handler(handle_username_for_reset, func=lambda message: user_sessions[message.chat.id]['state'] == states['LOGIN_USERNAME'], content_types=['text'])
+    bot.register_message_handler(idempotent(handle_new_password), func=lambda message: user_sessions[message.chat.id]['state'] == states['RESET_PASSWORD'], content_types=['text'])
+    bot.register_message_handler(handle_generate_report, commands=['generate_report'])
+    bot.register_message_handler(handle_set_reminder, commands=['set_reminder'])
+    bot.register_message_handler(handle_job_opportunities, commands=['job_opportunities'])
+    bot.register_message_handler(handle_share_document, commands=['share_document'])
+    bot.register_message_handler(handle_list_resources, commands=['list_resources'])
+    bot.register_message_handler(handle_feedback, commands=['feedback'])
+    bot.register_message_handler(idempotent(handle_feedback_message), func=lambda message: user_sessions[message.chat.id]['state'] == states['FEEDBACK'], content_types=['text'])
+
+def create_app(start_scheduler=True):
+    global DATABASE_URL, BOT_TOKEN, ADMIN_CHAT_IDS, db_pool, bot, scheduler
+
+    with startup_phase('settings'):
+        DATABASE_URL = os.getenv('DATABASE_URL')
+        BOT_TOKEN = os.getenv('BOT_TOKEN')
+        ADMIN_CHAT_IDS = admin_chat_ids()
+
+    # Initialize the database connection pool: PostgreSQL, or embedded SQLite for a sqlite:/// URL
+    with startup_phase('db_pool'):
+        # Shared by the chat workers, the feedback writer, broadcasts and the polling thread
+        db_pool = storage.connect(DATABASE_URL, int(os.getenv('DB_POOL_SIZE', str(dispatcher.CHAT_WORKERS + 4))))
+        print(f"Using the {db_pool.name} backend")
+
+    with startup_phase('create_tables'):
+        create_tables()
+
+    with startup_phase('ranking'):
+        ranking.board = ranking.CohortRanking()
+        # Built once from the users table, then kept current by every SGPA and profile write
+        conn = get_db_connection()
+        if conn:
+            try:
+                cur = conn.cursor()
+                print(f"Ranked {ranking.load(cur)} students")
+                cur.close()
+            finally:
+                close_db_connection(conn)
+
+    with startup_phase('feedback_buffer'):
+        feedback.buffer = feedback.FeedbackBuffer(get_db_connection, close_db_connection)
+        feedback.buffer.start()
+        # Anything still buffered is written out when the process exits
+        atexit.register(feedback.buffer.close)
+
+    with startup_phase('layout_cache'):
+        layout.load_cache()
+
+    with startup_phase('scratch_cleanup'):
+        removed = scratch.workspace.cleanup_stale()
+        usage = scratch.workspace.usage()
+        print(f"Scratch space {usage['root']}: removed {removed} stale job(s), quota {usage['quota']} bytes")
+
+    # Initialize bot
+    with startup_phase('telebot'):
+        # Talk to a different Bot API server, e.g. the local fake in bench/fake_telegram.py
+        telegram_api_url = os.getenv('TELEGRAM_API_URL')
+        if telegram_api_url:
+            apihelper.API_URL = telegram_api_url.rstrip('/') + '/bot{0}/{1}'
+            apihelper.FILE_URL = telegram_api_url.rstrip('/') + '/file/bot{0}/{1}'
+        # Time and trace every Bot API call made through telebot
+        apihelper.CUSTOM_REQUEST_SENDER = metrics.timed_request_sender(tracing.traced_request_sender(requests.Session().request))
+        updates.store = updates.UpdateStore(get_db_connection, close_db_connection)
+        bot = dispatcher.CampusBot(BOT_TOKEN, updates.store, dispatcher.ChatDispatcher())
+        register_handlers(bot)
+        tracing.instrument_handlers(bot)
+        metrics.instrument_handlers(bot)
+        broadcast.broadcaster = broadcast.Broadcaster(bot, get_db_connection, close_db_connection)
+        lifecycle.jobs = lifecycle.JobStore(get_db_connection, close_db_connection)
+
+    with startup_phase('scheduler'):
+        scheduler = BackgroundScheduler()
+        if start_scheduler:
+            scheduler.start()
+            schedule_reminders()
+            # Next months' partitions and archival of cold ones, once a day outside busy hours
+            scheduler.add_job(maintain_partitions, CronTrigger(hour=3, minute=30), id='maintain_partitions', replace_existing=True)
+
+    metrics.DB_POOL_IN_USE.set_function(db_pool.in_use)
+    metrics.DB_POOL_IDLE.set_function(db_pool.idle)
+    metrics.SESSIONS.set_function(lambda: len(user_sessions))
+    metrics.QUEUE_DEPTH.set_function(bot.dispatcher.pending)
+    metrics.SCHEDULED_REMINDERS.set_function(lambda: sum(job.func is send_reminder for job in scheduler.get_jobs()))
+    return bot
+
+def recover_jobs():
+    # Re-enqueue the marks-card conversions the previous process left running.
+    # The uploads that started them are marked processed, or Telegram's
+    # redelivery would run them a second time without the session state.
+    resumed = []
+    for job_id, kind, chat_id, payload in lifecycle.jobs.claim_interrupted():
+        if kind not in ('markscard', 'markscard_zip'):
+            # Updates saved by older versions; Telegram redelivers those now
+            lifecycle.jobs.finish(job_id)
+            continue
+        lifecycle.JOBS_RECOVERED.inc(kind=kind)
+        init_session(chat_id)
+        convert = convert_markscard_zip if kind == 'markscard_zip' else convert_markscard
+        bot.dispatcher.submit(chat_id, convert, chat_id, payload['user_id'], payload['file_id'],
+                              payload['file_size'], job_id)
+        resumed.append(payload)
+    update_ids = [payload['update_id'] for payload in resumed if payload.get('update_id')]
+    if update_ids:
+        bot.update_store.record(update_ids)
+    if resumed:
+        print(f"Recovered {len(resumed)} interrupted job(s)")
+
+def shutdown(timeout=lifecycle.SHUTDOWN_TIMEOUT):
+    # Polling has already stopped taking updates; finish what is in flight.
+    # Updates left unfinished at the deadline are not confirmed to Telegram,
+    # which delivers them again to the next process.
+    def stop_scheduler(remaining):
+        if scheduler.running:
+            # Reminders that do not fire now are caught up at the next start
+            scheduler.shutdown(wait=False)
+
+    return lifecycle.manager.shutdown([
+        ('scheduler', stop_scheduler),
+        ('chat workers', bot.dispatcher.shutdown),
+        ('broadcasts', broadcast.broadcaster.stop),
+        ('feedback', lambda remaining: feedback.buffer.close()),
+    ], timeout)
 
 def start_polling():
-    while True:
+    while not lifecycle.manager.stopping():
         try:
             bot.polling(none_stop=True, interval=0, timeout=60)
         except Exception as e:
             print(f"Error occurred: {e}")
-            time.sleep(15)
+            lifecycle.manager.wait(15)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Campus Connect Telegram bot')
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default=os.getenv('BOT_RUNTIME', 'threads'),
+                        help='run handlers on worker threads (default) or as coroutines on an asyncio event loop; '
+                             'the asyncio runtime has no broadcasts')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='build the app, print where boot time goes (including the lazily loaded libraries) and exit')
+    args = parser.parse_args(argv)
+
+    if args.runtime == 'asyncio' and not args.startup_report:
+        # Imported here so the threaded runtime does not need asyncpg
+        import async_bot
+        return async_bot.main()
+
+    create_app(start_scheduler=not args.startup_report)
+
+    if args.startup_report:
+        # These are normally loaded on first use; time them so the report shows what was deferred
+        for name, module in (('lazy: openpyxl', 'openpyxl'), ('lazy: reportlab', 'reportlab.platypus'),
+                             ('lazy: aspose.pdf', 'aspose.pdf')):
+            try:
+                with startup_phase(name):
+                    __import__(module)
+            except ImportError as e:
+                print(f"Could not import {module}: {e}")
+        print(startup_report())
+        return 0
+
+    print(startup_report())
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        metrics.start_metrics_server(int(metrics_port), os.getenv('METRICS_HOST', '127.0.0.1'))
+    if os.getenv('PROFILE_SLOW_UPDATES_MS'):
+        tracing.enable_profiler(float(os.getenv('PROFILE_SLOW_UPDATES_MS')),
+                                float(os.getenv('PROFILE_INTERVAL_MS', '5')),
+                                os.getenv('PROFILE_DIR', 'profiles'))
+    lifecycle.manager.install_signal_handlers()
+    lifecycle.manager.on_stop(bot.stop_updates)
+    broadcast.broadcaster.resume()
+    recover_jobs()
+    threading.Thread(target=start_polling, name='polling', daemon=True).start()
+    lifecycle.manager.wait()
+    if not shutdown():
+        # Unfinished updates are redelivered; conversions are recorded as pending jobs
+        print('Shutdown deadline passed; exiting with work left for the next start')
+        sys.stdout.flush()
+        os._exit(1)
+    return 0
+
+startup_timings.append(('import bot', time.perf_counter() - _import_started))
+metrics.STARTUP_SECONDS.set(startup_timings[-1][1], phase='import bot')
 
 if __name__ == "__main__":
-    start_polling()
+    sys.exit(main())
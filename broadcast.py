@@ -0,0 +1,314 @@
+import os
+import threading
+import time
+
+import requests
+from telebot.apihelper import ApiTelegramException
+from urllib3.exceptions import ConnectTimeoutError
+
+import metrics
+
+# Telegram allows about 30 messages per second across all chats; leave room for normal replies
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '20'))
+# Recipients sent between two progress checkpoints; a crash can resend at most this many
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv('BROADCAST_CHECKPOINT_EVERY', '25'))
+BROADCAST_FETCH_SIZE = 500
+MAX_RETRIES = 5
+
+FILTERS = ('college', 'branch', 'semester')
+
+BROADCAST_MESSAGES = metrics.Counter('campus_connect_broadcast_messages_total', 'Broadcast messages by outcome.', ['outcome'])
+BROADCASTS_RUNNING = metrics.Gauge('campus_connect_broadcasts_running', 'Broadcasts currently sending.')
+
+
+def never_sent(error):
+    # True only for errors raised before the request left, so a retry cannot duplicate it
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        # requests wraps urllib3's error, usually inside a MaxRetryError
+        cause = error.args[0] if error.args else None
+        cause = getattr(cause, 'reason', cause)
+        # NewConnectionError (refused, DNS) is a ConnectTimeoutError too
+        return isinstance(cause, ConnectTimeoutError)
+    return False
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def create_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id SERIAL PRIMARY KEY,
+            created_by TEXT,
+            message TEXT,
+            college TEXT,
+            branch TEXT,
+            semester TEXT,
+            status TEXT DEFAULT 'running',
+            last_user_id INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            created_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_on TIMESTAMP
+        )
+    """)
+
+
+def parse_command(text):
+    # /broadcast college=RVCE; semester=5
+    # Results are out!
+    # The first line holds optional key=value filters, the rest is the message
+    parts = text.split(None, 1)
+    body = parts[1] if len(parts) > 1 else ''
+    first, _, rest = body.partition('\n')
+    filters = {}
+    if '=' in first:
+        for part in first.split(';'):
+            key, _, value = part.partition('=')
+            key = key.strip().lower()
+            if key not in FILTERS or not value.strip():
+                raise ValueError(f'Unknown filter "{part.strip()}". Use {", ".join(FILTERS)}.')
+            filters[key] = value.strip()
+        body = rest
+    return filters, body.strip()
+
+
+def describe(row):
+    broadcast_id, status, college, branch, semester, delivered, failed, blocked, created_on = row
+    audience = ', '.join(f'{key}={value}' for key, value in zip(FILTERS, (college, branch, semester)) if value) or 'everyone'
+    return (f'#{broadcast_id} [{status}] to {audience} on {created_on:%d %b %H:%M}: '
+            f'{delivered} delivered, {failed} failed, {blocked} blocked')
+
+
+class Broadcaster:
+    def __init__(self, bot, get_connection, release_connection, rate=BROADCAST_RATE):
+        self.bot = bot
+        self._get_connection = get_connection
+        self._release_connection = release_connection
+        self.bucket = TokenBucket(rate)
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        BROADCASTS_RUNNING.set_function(lambda: len(self._threads))
+
+    def create(self, created_by, message, filters):
+        conn = self._get_connection()
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor()
+            cur.execute('''
+                INSERT INTO broadcasts (created_by, message, college, branch, semester)
+                VALUES (%s, %s, %s, %s, %s) RETURNING broadcast_id
+            ''', (str(created_by), message, filters.get('college'), filters.get('branch'), filters.get('semester')))
+            broadcast_id = cur.fetchone()[0]
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            print(f"Error creating broadcast: {e}")
+            conn.rollback()
+            return None
+        finally:
+            self._release_connection(conn)
+        self.start(broadcast_id)
+        return broadcast_id
+
+    def start(self, broadcast_id):
+        with self._lock:
+            if broadcast_id in self._threads:
+                return
+            thread = threading.Thread(target=self._run, args=(broadcast_id,), name=f'broadcast-{broadcast_id}', daemon=True)
+            self._threads[broadcast_id] = thread
+        thread.start()
+
+    def resume(self):
+        # Pick up broadcasts that were still sending when the process stopped
+        conn = self._get_connection()
+        if not conn:
+            return []
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT broadcast_id FROM broadcasts WHERE status = 'running' ORDER BY broadcast_id")
+            pending = [row[0] for row in cur.fetchall()]
+            cur.close()
+        finally:
+            self._release_connection(conn)
+        for broadcast_id in pending:
+            print(f"Resuming broadcast #{broadcast_id}")
+            self.start(broadcast_id)
+        return pending
+
+    def cancel(self, broadcast_id):
+        return self._update("UPDATE broadcasts SET status = 'cancelled', finished_on = CURRENT_TIMESTAMP "
+                            "WHERE broadcast_id = %s AND status = 'running'", (broadcast_id,))
+
+    def stop(self, timeout=None):
+        # Stop sending after the current message and checkpoint; the broadcasts
+        # stay 'running' so the next start resumes them. Returns False if one
+        # was still sending at the timeout.
+        self._stopping.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        threads = list(self._threads.values())
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in threads)
+
+    def status(self, broadcast_id=None, limit=5):
+        conn = self._get_connection()
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor()
+            columns = 'broadcast_id, status, college, branch, semester, delivered, failed, blocked, created_on'
+            if broadcast_id is None:
+                cur.execute(f'SELECT {columns} FROM broadcasts ORDER BY broadcast_id DESC LIMIT %s', (limit,))
+            else:
+                cur.execute(f'SELECT {columns} FROM broadcasts WHERE broadcast_id = %s', (broadcast_id,))
+            rows = cur.fetchall()
+            cur.close()
+            return [describe(row) for row in rows]
+        finally:
+            self._release_connection(conn)
+
+    def _update(self, sql, params):
+        conn = self._get_connection()
+        if not conn:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            changed = cur.rowcount
+            conn.commit()
+            cur.close()
+            return changed > 0
+        except Exception as e:
+            print(f"Error updating broadcast: {e}")
+            conn.rollback()
+            return False
+        finally:
+            self._release_connection(conn)
+
+    def _run(self, broadcast_id):
+        try:
+            self._send_all(broadcast_id)
+        except Exception as e:
+            print(f"Broadcast #{broadcast_id} stopped: {e}")
+        finally:
+            with self._lock:
+                self._threads.pop(broadcast_id, None)
+
+    def _send_all(self, broadcast_id):
+        conn = self._get_connection()
+        if not conn:
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT message, college, branch, semester, last_user_id, delivered, failed, blocked, created_by, status
+                FROM broadcasts WHERE broadcast_id = %s
+            ''', (broadcast_id,))
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+            if row is None or row[9] != 'running':
+                return
+            message, college, branch, semester, last_user_id, delivered, failed, blocked, created_by, _ = row
+            counts = {'delivered': delivered, 'failed': failed, 'blocked': blocked}
+
+            conditions = ['chat_id IS NOT NULL', 'user_id > %s']
+            params = [last_user_id]
+            for column, value in (('college', college), ('branch', branch), ('semester', semester)):
+                if value:
+                    conditions.append(f'lower(trim({column})) = lower(%s)')
+                    params.append(value.strip())
+
+            # A named cursor streams recipients from the server instead of loading them all
+            recipients = conn.cursor(name=f'broadcast_{broadcast_id}')
+            recipients.itersize = BROADCAST_FETCH_SIZE
+            recipients.execute(f'SELECT user_id, chat_id FROM users WHERE {" AND ".join(conditions)} ORDER BY user_id',
+                               params)
+            since_checkpoint = 0
+            for user_id, chat_id in recipients:
+                if self._stopping.is_set():
+                    break
+                outcome = self._send(chat_id, message)
+                counts[outcome] += 1
+                BROADCAST_MESSAGES.inc(outcome=outcome)
+                last_user_id = user_id
+                since_checkpoint += 1
+                if since_checkpoint >= BROADCAST_CHECKPOINT_EVERY:
+                    since_checkpoint = 0
+                    if not self._checkpoint(broadcast_id, last_user_id, counts):
+                        print(f"Broadcast #{broadcast_id} is no longer running; stopping")
+                        return
+            else:
+                self._checkpoint(broadcast_id, last_user_id, counts, finished=True)
+                self._report(created_by, broadcast_id, counts)
+                return
+            self._checkpoint(broadcast_id, last_user_id, counts)
+        finally:
+            conn.rollback()
+            self._release_connection(conn)
+
+    def _checkpoint(self, broadcast_id, last_user_id, counts, finished=False):
+        # Runs on its own connection so the streaming cursor's transaction stays open
+        status = ", status = 'done', finished_on = CURRENT_TIMESTAMP" if finished else ''
+        return self._update(f'''
+            UPDATE broadcasts SET last_user_id = %s, delivered = %s, failed = %s, blocked = %s{status}
+            WHERE broadcast_id = %s AND status = 'running'
+        ''', (last_user_id, counts['delivered'], counts['failed'], counts['blocked'], broadcast_id))
+
+    def _send(self, chat_id, message):
+        for attempt in range(MAX_RETRIES):
+            self.bucket.acquire()
+            try:
+                self.bot.send_message(chat_id, message)
+                return 'delivered'
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 2 ** attempt)
+                    time.sleep(retry_after)
+                    continue
+                if e.error_code == 403:
+                    return 'blocked'
+                print(f"Broadcast to {chat_id} failed: {e}")
+                return 'failed'
+            except Exception as e:
+                print(f"Broadcast to {chat_id} failed: {e}")
+                if not never_sent(e):
+                    # A read timeout or dropped response may come after Telegram
+                    # delivered the message; resending could send it twice
+                    return 'failed'
+                time.sleep(2 ** attempt)
+        return 'failed'
+
+    def _report(self, created_by, broadcast_id, counts):
+        try:
+            self.bot.send_message(created_by, f'Broadcast #{broadcast_id} finished: {counts["delivered"]} delivered, '
+                                              f'{counts["failed"]} failed, {counts["blocked"]} blocked.')
+        except Exception as e:
+            print(f"Error reporting broadcast #{broadcast_id}: {e}")
+
+
+broadcaster = None
@@ -0,0 +1,121 @@
+import io
+import os
+import posixpath
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from layout import UnrecognizedLayoutError
+from marks import analyze_marks, convert_pdf_to_excel
+
+BULK_UPLOAD_WORKERS = int(os.getenv('BULK_UPLOAD_WORKERS', '4'))
+MAX_ZIP_ENTRIES = int(os.getenv('MAX_ZIP_ENTRIES', '100'))
+MAX_ENTRY_BYTES = int(os.getenv('MAX_ZIP_ENTRY_BYTES', str(10 * 1024 * 1024)))
+
+ZIP_MIME_TYPES = ('application/zip', 'application/x-zip-compressed', 'application/x-zip')
+
+BULK_CARDS = metrics.Counter('campus_connect_bulk_cards_total', 'Marks cards processed from ZIP uploads.', ['outcome'])
+
+
+class CardResult:
+    def __init__(self, name, sgpa=None, semester=None, error=None, subjects=()):
+        self.name = name
+        self.sgpa = sgpa
+        self.semester = semester
+        self.error = error
+        self.subjects = subjects
+
+
+def is_zip(document):
+    return document.mime_type in ZIP_MIME_TYPES or (document.file_name or '').lower().endswith('.zip')
+
+
+def pdf_entries(archive):
+    entries = []
+    for info in archive.infolist():
+        name = posixpath.basename(info.filename)
+        if info.is_dir() or name.startswith('.') or info.filename.startswith('__MACOSX/'):
+            continue
+        if name.lower().endswith('.pdf'):
+            entries.append(info)
+    return entries
+
+
+def process_card(name, data, year_scheme):
+    # The PDF and the converted workbook stay in memory; nothing is extracted to disk
+    try:
+        excel = io.BytesIO()
+        convert_pdf_to_excel(io.BytesIO(data), excel)
+        excel.seek(0)
+        analysis = analyze_marks(excel, year_scheme)
+    except UnrecognizedLayoutError as e:
+        print(f"Unrecognized marks card layout in {name}: {e}")
+        return CardResult(name, error='layout not recognized')
+    except Exception as e:
+        print(f"Error processing {name}: {e}")
+        return CardResult(name, error='could not be converted')
+    if analysis['sgpa'] is None:
+        return CardResult(name, semester=analysis['semester'], error='no recognized subjects')
+    return CardResult(name, sgpa=analysis['sgpa'], semester=analysis['semester'], subjects=analysis['subjects'])
+
+
+def process_zip(zip_source, year_scheme=None, on_progress=None, workers=None):
+    # Reads one entry at a time and hands it to the worker pool; at most
+    # 2 * workers entries are held in memory. on_progress(done, total) is
+    # called from worker threads as cards finish.
+    workers = workers or BULK_UPLOAD_WORKERS
+    results = []
+    completed = []
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    with zipfile.ZipFile(zip_source) as archive:
+        entries = pdf_entries(archive)
+        for info in entries[MAX_ZIP_ENTRIES:]:
+            results.append(CardResult(info.filename, error=f'skipped, only {MAX_ZIP_ENTRIES} cards per ZIP'))
+        for info in entries[:MAX_ZIP_ENTRIES]:
+            if info.file_size > MAX_ENTRY_BYTES:
+                results.append(CardResult(info.filename, error='too large'))
+        entries = [info for info in entries[:MAX_ZIP_ENTRIES] if info.file_size <= MAX_ENTRY_BYTES]
+        total = len(entries)
+
+        def finished(future):
+            slots.release()
+            result = future.result()
+            BULK_CARDS.inc(outcome='ok' if result.error is None else 'error')
+            with lock:
+                completed.append(result)
+                done = len(completed)
+            if on_progress:
+                try:
+                    on_progress(done, total)
+                except Exception as e:
+                    print(f"Error reporting bulk upload progress: {e}")
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bulk-upload') as pool:
+            for info in entries:
+                slots.acquire()
+                data = archive.read(info)
+                pool.submit(process_card, info.filename, data, year_scheme).add_done_callback(finished)
+
+    results = sorted(completed + results, key=lambda result: result.name)
+    return results
+
+
+def summarize(results):
+    # One line per semester (the last card wins when a semester appears twice), then failures
+    by_semester = {}
+    for result in results:
+        if result.error is None:
+            by_semester[result.semester or '?'] = result
+    lines = ['Bulk upload summary:']
+    for semester in sorted(by_semester, key=lambda s: (not s.isdigit(), s)):
+        result = by_semester[semester]
+        lines.append(f'Semester {semester}: SGPA {result.sgpa:.2f} ({posixpath.basename(result.name)})')
+    failures = [result for result in results if result.error is not None]
+    for result in failures:
+        lines.append(f'{posixpath.basename(result.name)}: {result.error}')
+    if not by_semester and not failures:
+        lines.append('No marks card PDFs were found in the ZIP.')
+    return '\n'.join(lines), by_semester
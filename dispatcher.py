@@ -0,0 +1,150 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from updates import IdempotentTeleBot
+
+CHAT_WORKERS = int(os.getenv('CHAT_WORKERS', '8'))
+# Tasks a mailbox runs before giving its worker back, so one busy chat cannot hold a thread
+MAILBOX_BATCH = 8
+# Update fields that belong to a chat; an update's first one decides its mailbox
+CHAT_UPDATE_FIELDS = ('message', 'edited_message', 'callback_query', 'channel_post', 'edited_channel_post',
+                      'my_chat_member', 'chat_member', 'chat_join_request')
+
+logger = logging.getLogger(__name__)
+
+MAILBOXES = metrics.Gauge('campus_connect_chat_mailboxes', 'Chats with queued or running updates.')
+MAILBOX_WAIT_SECONDS = metrics.Histogram('campus_connect_chat_mailbox_wait_seconds', 'Time an update waits in its chat mailbox.')
+
+
+def chat_key(obj):
+    # Messages carry .chat, callback queries carry .message.chat (or only .from_user)
+    chat = getattr(obj, 'chat', None) or getattr(getattr(obj, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(obj, 'from_user', None)
+    return user.id if user is not None else None
+
+
+def update_chat(update):
+    for field in CHAT_UPDATE_FIELDS:
+        obj = getattr(update, field, None)
+        if obj is not None:
+            return chat_key(obj)
+    return None
+
+
+class ChatDispatcher:
+    # One mailbox per chat with pending work: a chat's updates run strictly in
+    # order, different chats run in parallel on a bounded pool. A mailbox only
+    # exists while it has work, so idle chats cost nothing.
+
+    def __init__(self, workers=CHAT_WORKERS, on_error=None):
+        self.workers = workers
+        self.on_error = on_error
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat')
+        self._mailboxes = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._closed = False
+        self._abandoned = False
+        MAILBOXES.set_function(lambda: len(self._mailboxes))
+
+    def submit(self, chat_id, task, *args, **kwargs):
+        item = (task, args, kwargs, time.perf_counter())
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('dispatcher is shut down')
+            mailbox = self._mailboxes.get(chat_id)
+            if mailbox is not None:
+                mailbox.append(item)
+                return
+            self._mailboxes[chat_id] = deque([item])
+        self._pool.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        for _ in range(MAILBOX_BATCH):
+            with self._lock:
+                if self._abandoned:
+                    return
+                mailbox = self._mailboxes[chat_id]
+                task, args, kwargs, queued = mailbox[0]
+            MAILBOX_WAIT_SECONDS.observe(time.perf_counter() - queued)
+            try:
+                task(*args, **kwargs)
+            except Exception as e:
+                if not (self.on_error and self.on_error(e)):
+                    logger.exception('Unhandled error processing an update for chat %s', chat_id)
+            with self._lock:
+                # The running item stays at the head so submit() never starts a second drainer
+                mailbox.popleft()
+                if not mailbox:
+                    del self._mailboxes[chat_id]
+                    self._idle.notify_all()
+                    return
+        # Still busy: requeue behind the other chats waiting for a worker
+        with self._lock:
+            if self._abandoned:
+                return
+            self._pool.submit(self._drain, chat_id)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(mailbox) for mailbox in self._mailboxes.values())
+
+    def stats(self, top=10):
+        with self._lock:
+            lengths = sorted(((len(mailbox), chat_id) for chat_id, mailbox in self._mailboxes.items()), reverse=True)
+        return {
+            'workers': self.workers,
+            'mailboxes': len(lengths),
+            'pending': sum(length for length, _ in lengths),
+            'busiest': [(chat_id, length) for length, chat_id in lengths[:top]],
+        }
+
+    def shutdown(self, timeout=None):
+        # Stop accepting work and wait for the queued updates to finish. Past
+        # the timeout, running updates are left to finish but queued ones are
+        # not started.
+        with self._lock:
+            self._closed = True
+            drained = self._idle.wait_for(lambda: not self._mailboxes, timeout)
+            self._abandoned = not drained
+        self._pool.shutdown(wait=drained, cancel_futures=not drained)
+        return drained
+
+
+class CampusBot(IdempotentTeleBot):
+    # Every update goes through the dispatcher instead of telebot's worker
+    # pool, so two updates from the same chat never run at the same time. The
+    # whole update is queued, not just the handler: picking the handler reads
+    # user_sessions state and the next-step handlers an earlier update of the
+    # chat may still be about to set.
+
+    def __init__(self, token, update_store, dispatcher, **kwargs):
+        kwargs.setdefault('num_threads', 1)
+        super().__init__(token, update_store, **kwargs)
+        self.dispatcher = dispatcher
+        dispatcher.on_error = self._handle_exception
+
+    def _dispatch(self, updates):
+        for update in updates:
+            chat_id = update_chat(update)
+            if chat_id is None:
+                # Not tied to a chat (inline queries, polls): handled right here
+                try:
+                    super()._dispatch([update])
+                except Exception as e:
+                    if not self._handle_exception(e):
+                        logger.exception('Unhandled error processing update %s', update.update_id)
+            else:
+                self.dispatcher.submit(chat_id, super()._dispatch, [update])
+
+    def _exec_task(self, task, *args, **kwargs):
+        # Already on the update's worker (or the polling thread), so run it
+        # here; an error goes to the dispatcher's on_error like any other
+        task(*args, **kwargs)
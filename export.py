@@ -0,0 +1,173 @@
+import csv
+import io
+import json
+import os
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import metrics
+import partitions
+
+# One export per student in this window; failed exports do not count
+EXPORT_INTERVAL_HOURS = int(os.getenv('EXPORT_INTERVAL_HOURS', '24'))
+# Rows fetched per round trip from the server-side cursors
+EXPORT_FETCH_SIZE = 500
+# Telegram bots cannot upload documents larger than 50 MB
+MAX_EXPORT_BYTES = 50 * 1024 * 1024
+
+EXPORTS = metrics.Counter('campus_connect_data_exports_total', 'Personal data exports by outcome.', ['outcome'])
+
+# Queries take the student's user_id; {0} is the driver's placeholder. Sections
+# of a partitioned table also take live_since(), as {1}, so the planner skips
+# months past retention that the daily job has not archived yet.
+PROFILE_QUERY = ('SELECT user_id, full_name, username, semester, college, mobile, branch, year_scheme, sgpa, cgpa, chat_id '
+                 'FROM users WHERE user_id = {0}')
+SECTIONS = [
+    ('semester_results.csv', 'marks_cards', 'SELECT card_id, file_id, semester, sgpa, uploaded_on FROM marks_cards '
+                                            'WHERE user_id = {0} AND uploaded_on >= {1} ORDER BY uploaded_on, card_id'),
+    ('marks.csv', None, 'SELECT card_id, subject_code, subject_name, internal_marks, external_marks, total, max_marks, '
+                        'grade_points, credits, updated_on FROM marks WHERE user_id = {0} ORDER BY subject_code'),
+    ('reminders.csv', None, 'SELECT reminder_id, time_str, message, created_on FROM reminders WHERE user_id = {0} ORDER BY reminder_id'),
+    ('feedback.csv', 'feedback', 'SELECT feedback_id, feedback_text, submitted_on FROM feedback '
+                                 'WHERE user_id = {0} AND submitted_on >= {1} ORDER BY submitted_on'),
+    ('shared_documents.csv', 'shared_documents', 'SELECT doc_id, file_id, file_name, mime_type, shared_on FROM shared_documents '
+                                                 'WHERE user_id = {0} AND shared_on >= {1} ORDER BY shared_on'),
+]
+CLAIM_QUERY = '''
+    INSERT INTO data_exports (user_id)
+    SELECT {0}::integer WHERE NOT EXISTS (
+        SELECT 1 FROM data_exports WHERE user_id = {0} AND status <> 'failed'
+            AND requested_on > {1})
+    RETURNING export_id
+'''
+FINISH_QUERY = 'UPDATE data_exports SET status = {0}, size_bytes = {1}, finished_on = CURRENT_TIMESTAMP WHERE export_id = {2}'
+
+README = """Everything Campus Connect holds about you, as of {created}.
+
+profile.json          your profile (the password hash is not included)
+semester_results.csv  one row per uploaded marks card
+marks.csv             your per-subject marks
+reminders.csv         your reminders
+feedback.csv          feedback you have sent
+shared_documents.csv  documents you shared (names and Telegram file ids)
+report.pdf            your SGPA/CGPA report, when both are available
+
+Records older than our retention period are archived outside the live
+database and are not part of this export; support can restore them.
+"""
+
+
+def create_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS data_exports (
+            export_id SERIAL PRIMARY KEY,
+            user_id INTEGER,
+            status TEXT DEFAULT 'running',
+            size_bytes BIGINT,
+            requested_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_on TIMESTAMP,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    """)
+
+
+class ExportArchive:
+    # Members are compressed straight into the ZIP file as rows arrive, so
+    # memory holds one fetch batch and zlib's window, not the whole export
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    @contextmanager
+    def csv_member(self, name, columns):
+        # Yields a function that writes a batch of rows
+        with self.zip.open(name, 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8', newline='') as text:
+            writer = csv.writer(text)
+            writer.writerow(columns)
+            yield writer.writerows
+
+    def json_member(self, name, value):
+        self.zip.writestr(name, json.dumps(value, indent=2, default=str))
+
+    def file_member(self, name, path):
+        self.zip.write(path, name)
+
+    def close(self, created):
+        self.zip.writestr('README.txt', README.format(created=f'{created:%Y-%m-%d %H:%M}'))
+        self.zip.close()
+        return os.path.getsize(self.path)
+
+
+def claim_cutoff():
+    # Exports requested after this count against the limit
+    return datetime.now() - timedelta(hours=EXPORT_INTERVAL_HOURS)
+
+
+def report_row(profile):
+    # render_report() needs both figures; without them the export has no report
+    if profile.get('sgpa') is None or profile.get('cgpa') is None:
+        return None
+    return tuple(profile[key] for key in ('full_name', 'semester', 'college', 'branch', 'sgpa', 'cgpa'))
+
+
+def too_large(size):
+    return size > MAX_EXPORT_BYTES
+
+
+def live_since(cur, table, partitioned=True):
+    # Older rows are archived and not part of the export; without partitioning nothing is
+    if not partitioned:
+        return datetime.min
+    return partitions.fetch_live_since(cur, table)
+
+
+def write_export(conn, user_id, archive, partitioned=True):
+    # Profile and sections come from one read-only snapshot, so the members agree
+    # with each other; each section streams through a server-side cursor
+    cur = conn.cursor()
+    try:
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+        cur.execute(PROFILE_QUERY.format('%s'), (user_id,))
+        row = cur.fetchone()
+        profile = dict(zip([column[0] for column in cur.description], row)) if row else {}
+        archive.json_member('profile.json', profile)
+        for index, (name, table, query) in enumerate(SECTIONS):
+            params = (user_id, live_since(cur, table, partitioned)) if table else (user_id,)
+            rows = conn.cursor(name=f'export_{user_id}_{index}')
+            rows.execute(query.format('%s', '%s'), params)
+            # A named cursor only has a description after its first fetch
+            batch = rows.fetchmany(EXPORT_FETCH_SIZE)
+            with archive.csv_member(name, [column[0] for column in rows.description]) as write:
+                while batch:
+                    write(batch)
+                    batch = rows.fetchmany(EXPORT_FETCH_SIZE)
+            rows.close()
+        return profile
+    finally:
+        cur.close()
+        conn.rollback()
+
+
+async def write_export_async(conn, user_id, archive):
+    # write_export() on an asyncpg connection; batches are compressed on the
+    # event loop, which is a few milliseconds per EXPORT_FETCH_SIZE rows
+    async with conn.transaction(isolation='repeatable_read', readonly=True):
+        row = await conn.fetchrow(PROFILE_QUERY.format('$1'), user_id)
+        profile = dict(row) if row else {}
+        archive.json_member('profile.json', profile)
+        for name, table, query in SECTIONS:
+            statement = await conn.prepare(query.format('$1', '$2'))
+            if table:
+                restored_since = await conn.fetchval(partitions.RESTORED_SINCE_QUERY.format('$1'), table)
+                cursor = await statement.cursor(user_id, partitions.live_since(table, restored_since))
+            else:
+                cursor = await statement.cursor(user_id)
+            with archive.csv_member(name, [attribute.name for attribute in statement.get_attributes()]) as write:
+                while True:
+                    batch = await cursor.fetch(EXPORT_FETCH_SIZE)
+                    if not batch:
+                        break
+                    write([tuple(record) for record in batch])
+    return profile
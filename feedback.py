@@ -0,0 +1,358 @@
+import asyncio
+import json
+import os
+import re
+import threading
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+
+import metrics
+from storage import execute_values
+
+FEEDBACK_FLUSH_SIZE = int(os.getenv('FEEDBACK_FLUSH_SIZE', '50'))
+FEEDBACK_FLUSH_SECONDS = float(os.getenv('FEEDBACK_FLUSH_SECONDS', '5'))
+# A batch that failed this many flushes in a row is retried one row at a time
+FEEDBACK_MAX_ATTEMPTS = 3
+# Buffered feedback kept while the database is unreachable; the oldest is dropped beyond this
+FEEDBACK_MAX_PENDING = int(os.getenv('FEEDBACK_MAX_PENDING', '10000'))
+# Rows the database keeps rejecting are appended here as JSON lines
+FEEDBACK_DEAD_LETTER = os.getenv('FEEDBACK_DEAD_LETTER', 'feedback-dead-letter.jsonl')
+
+STOP_WORDS = frozenset('''
+    the and for are but not you your with this that have has was were will would can could should
+    its from they them their there what when where which who why how all any just very more most
+    too also than then into out our about been being because bot please thanks thank good nice
+'''.split())
+WORD = re.compile(r'[a-z]{3,}')
+
+FEEDBACK_BUFFERED = metrics.Gauge('campus_connect_feedback_buffered', 'Feedback messages waiting to be written.')
+FEEDBACK_FLUSH_TIME = metrics.Histogram('campus_connect_feedback_flush_seconds', 'Time to write one feedback batch.')
+FEEDBACK_DROPPED = metrics.Counter('campus_connect_feedback_dropped_total', 'Feedback messages not written to the database.', ['reason'])
+
+
+def terms(text):
+    return set(WORD.findall(text.lower())) - STOP_WORDS
+
+
+def bounded(rows):
+    # Keeps the newest FEEDBACK_MAX_PENDING rows
+    excess = len(rows) - FEEDBACK_MAX_PENDING
+    if excess <= 0:
+        return rows
+    print(f"Feedback buffer full, dropping the {excess} oldest message(s)")
+    FEEDBACK_DROPPED.inc(excess, reason='overflow')
+    return rows[excess:]
+
+
+def dead_letter(rows):
+    # Rows the database rejected on their own, kept for an operator to look at
+    try:
+        with open(FEEDBACK_DEAD_LETTER, 'a') as f:
+            for user_id, text, submitted_on in rows:
+                f.write(json.dumps({'user_id': user_id, 'feedback_text': text, 'submitted_on': submitted_on.isoformat()}) + '\n')
+        print(f"Moved {len(rows)} feedback message(s) the database rejected to {FEEDBACK_DEAD_LETTER}")
+    except OSError as e:
+        print(f"Error writing the feedback dead-letter log: {e}")
+    FEEDBACK_DROPPED.inc(len(rows), reason='rejected')
+
+
+class FeedbackBuffer:
+    # Feedback is acknowledged as soon as it is buffered and written in
+    # batches, together with the digest summary, by a background thread
+
+    def __init__(self, get_connection, release_connection, flush_size=FEEDBACK_FLUSH_SIZE,
+                 flush_seconds=FEEDBACK_FLUSH_SECONDS):
+        self._get_connection = get_connection
+        self._release_connection = release_connection
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self._pending = []
+        self._attempts = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        FEEDBACK_BUFFERED.set_function(lambda: len(self._pending))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='feedback-writer', daemon=True)
+        self._thread.start()
+
+    def append(self, user_id, text):
+        with self._lock:
+            self._pending.append((user_id, text, datetime.now()))
+            if len(self._pending) > FEEDBACK_MAX_PENDING:
+                self._pending = bounded(self._pending)
+            full = len(self._pending) >= self.flush_size
+        if full:
+            self._wake.set()
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        # Stop the writer and flush whatever is still buffered
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+        return self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return True
+            if self._write(batch):
+                self._attempts = 0
+                return True
+            self._attempts += 1
+            if self._attempts >= FEEDBACK_MAX_ATTEMPTS:
+                # One bad row (a NUL byte, an over-long value) fails the whole
+                # batch every time; write row by row and set aside the ones the
+                # database rejects while it is otherwise healthy
+                batch = self._write_rows(batch)
+                if not batch:
+                    self._attempts = 0
+                    return True
+            # Put the batch back in front of anything that arrived meanwhile and retry later
+            with self._lock:
+                self._pending = bounded(batch + self._pending)
+            return False
+
+    def _write_rows(self, batch):
+        # Returns the rows still to be written
+        for index, row in enumerate(batch):
+            if self._write([row]):
+                continue
+            if not self._healthy():
+                return batch[index:]
+            dead_letter([row])
+        return []
+
+    def _healthy(self):
+        conn = self._get_connection()
+        if not conn:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            return True
+        except Exception:
+            return False
+        finally:
+            self._release_connection(conn)
+
+    def _write(self, batch):
+        conn = self._get_connection()
+        if not conn:
+            return False
+        try:
+            with FEEDBACK_FLUSH_TIME.time():
+                cur = conn.cursor()
+                execute_values(cur, 'INSERT INTO feedback (user_id, feedback_text, submitted_on) VALUES %s', batch)
+                update_summary(cur, batch)
+                conn.commit()
+                cur.close()
+            return True
+        except Exception as e:
+            print(f"Error writing feedback batch of {len(batch)}: {e}")
+            conn.rollback()
+            return False
+        finally:
+            self._release_connection(conn)
+
+
+class AsyncFeedbackBuffer:
+    # FeedbackBuffer for the asyncio runtime: the flusher is a task on the
+    # event loop and writes through an asyncpg pool
+
+    def __init__(self, pool, flush_size=FEEDBACK_FLUSH_SIZE, flush_seconds=FEEDBACK_FLUSH_SECONDS):
+        self.pool = pool
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self._pending = []
+        self._attempts = 0
+        self._wake = asyncio.Event()
+        self._flushing = asyncio.Lock()
+        self._task = None
+        FEEDBACK_BUFFERED.set_function(lambda: len(self._pending))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def append(self, user_id, text):
+        self._pending.append((user_id, text, datetime.now()))
+        if len(self._pending) > FEEDBACK_MAX_PENDING:
+            self._pending = bounded(self._pending)
+        if len(self._pending) >= self.flush_size:
+            self._wake.set()
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        return await self.flush()
+
+    async def flush(self):
+        async with self._flushing:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return True
+            if await self._write(batch):
+                self._attempts = 0
+                return True
+            self._attempts += 1
+            if self._attempts >= FEEDBACK_MAX_ATTEMPTS:
+                # As in FeedbackBuffer.flush(): row by row, rejected rows set aside
+                batch = await self._write_rows(batch)
+                if not batch:
+                    self._attempts = 0
+                    return True
+            self._pending = bounded(batch + self._pending)
+            return False
+
+    async def _write_rows(self, batch):
+        for index, row in enumerate(batch):
+            if await self._write([row]):
+                continue
+            if not await self._healthy():
+                return batch[index:]
+            dead_letter([row])
+        return []
+
+    async def _healthy(self):
+        try:
+            await self.pool.fetchval('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    async def _write(self, batch):
+        try:
+            with FEEDBACK_FLUSH_TIME.time():
+                async with self.pool.acquire() as conn, conn.transaction():
+                    await conn.executemany('INSERT INTO feedback (user_id, feedback_text, submitted_on) VALUES ($1, $2, $3)',
+                                           batch)
+                    user_ids = sorted({user_id for user_id, _, _ in batch if user_id is not None})
+                    rows = await conn.fetch('SELECT user_id, college FROM users WHERE user_id = ANY($1::int[])', user_ids)
+                    daily, term_counts = summary_rows(batch, {row['user_id']: row['college'] for row in rows})
+                    await conn.executemany('''
+                        INSERT INTO feedback_daily (day, college, count) VALUES ($1, $2, $3)
+                        ON CONFLICT (day, college) DO UPDATE SET count = feedback_daily.count + EXCLUDED.count
+                    ''', daily)
+                    await conn.executemany('''
+                        INSERT INTO feedback_terms (term, count) VALUES ($1, $2)
+                        ON CONFLICT (term) DO UPDATE SET count = feedback_terms.count + EXCLUDED.count
+                    ''', term_counts)
+            return True
+        except Exception as e:
+            print(f"Error writing feedback batch of {len(batch)}: {e}")
+            return False
+
+
+def summary_rows(batch, colleges):
+    # batch is a list of (user_id, text, submitted_on); returns the increments
+    # for feedback_daily and feedback_terms
+    daily = Counter()
+    term_counts = Counter()
+    for user_id, text, submitted_on in batch:
+        college = (colleges.get(user_id) or 'Unknown').strip() or 'Unknown'
+        daily[(submitted_on.date(), college)] += 1
+        term_counts.update(terms(text or ''))
+    return [(day, college, count) for (day, college), count in daily.items()], list(term_counts.items())
+
+
+def update_summary(cur, batch):
+    # The summary tables are bumped in the same transaction as the inserts
+    user_ids = sorted({user_id for user_id, _, _ in batch if user_id is not None})
+    colleges = {}
+    if user_ids:
+        cur.execute('SELECT user_id, college FROM users WHERE user_id = ANY(%s)', (user_ids,))
+        colleges = dict(cur.fetchall())
+
+    daily, term_counts = summary_rows(batch, colleges)
+    execute_values(cur, '''
+        INSERT INTO feedback_daily (day, college, count) VALUES %s
+        ON CONFLICT (day, college) DO UPDATE SET count = feedback_daily.count + EXCLUDED.count
+    ''', daily)
+    if term_counts:
+        execute_values(cur, '''
+            INSERT INTO feedback_terms (term, count) VALUES %s
+            ON CONFLICT (term) DO UPDATE SET count = feedback_terms.count + EXCLUDED.count
+        ''', term_counts)
+
+
+def create_summary_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feedback_daily (
+            day DATE,
+            college TEXT,
+            count INTEGER,
+            PRIMARY KEY (day, college)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feedback_terms (
+            term TEXT PRIMARY KEY,
+            count INTEGER
+        )
+    """)
+    # One-off backfill the first time the summary exists next to older feedback
+    cur.execute('SELECT EXISTS (SELECT 1 FROM feedback_daily)')
+    if not cur.fetchone()[0]:
+        cur.execute('SELECT user_id, feedback_text, submitted_on FROM feedback')
+        rows = [(user_id, text, submitted_on or datetime.now()) for user_id, text, submitted_on in cur.fetchall()]
+        if rows:
+            update_summary(cur, rows)
+
+
+def digest(cur, days=14, top_terms=10):
+    since = date.today() - timedelta(days=days - 1)
+    cur.execute('SELECT day, SUM(count) FROM feedback_daily WHERE day >= %s GROUP BY day ORDER BY day', (since,))
+    per_day = cur.fetchall()
+    cur.execute('SELECT COALESCE(SUM(count), 0) FROM feedback_daily')
+    total = cur.fetchone()[0]
+    cur.execute('SELECT college, SUM(count) AS n FROM feedback_daily GROUP BY college ORDER BY n DESC LIMIT 10')
+    per_college = cur.fetchall()
+    cur.execute('SELECT term, count FROM feedback_terms ORDER BY count DESC, term LIMIT %s', (top_terms,))
+    top = cur.fetchall()
+    return format_digest(days, total, per_day, per_college, top)
+
+
+async def digest_async(conn, days=14, top_terms=10):
+    since = date.today() - timedelta(days=days - 1)
+    per_day = await conn.fetch('SELECT day, SUM(count) FROM feedback_daily WHERE day >= $1 GROUP BY day ORDER BY day', since)
+    total = await conn.fetchval('SELECT COALESCE(SUM(count), 0) FROM feedback_daily')
+    per_college = await conn.fetch('SELECT college, SUM(count) AS n FROM feedback_daily GROUP BY college ORDER BY n DESC LIMIT 10')
+    top = await conn.fetch('SELECT term, count FROM feedback_terms ORDER BY count DESC, term LIMIT $1', top_terms)
+    return format_digest(days, total, [tuple(row) for row in per_day], [tuple(row) for row in per_college],
+                         [tuple(row) for row in top])
+
+
+def format_digest(days, total, per_day, per_college, top):
+    lines = ['Feedback digest', f'All-time feedback: {total}', '', f'Last {days} days:']
+    lines += [f'{day:%d %b}: {count}' for day, count in per_day] or ['No feedback.']
+    lines += ['', 'By college:'] + ([f'{college}: {count}' for college, count in per_college] or ['None yet.'])
+    lines += ['', 'Top terms:'] + ([f'{term} ({count})' for term, count in top] or ['None yet.'])
+    return '\n'.join(lines)
+
+
+buffer = None
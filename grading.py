@@ -0,0 +1,99 @@
+import re
+from bisect import bisect_right
+
+
+class GradingScheme:
+    # bands maps the lowest percentage of each grade to its grade points, e.g.
+    # {90: 10, 80: 9, ...}; anything below the lowest band scores 0. The pass
+    # rule is a minimum overall percentage plus optional minimum CIE (internal)
+    # and SEE (external) percentages.
+
+    def __init__(self, name, bands, pass_percentage=40, internal_max=None, external_max=None,
+                 min_internal_percentage=None, min_external_percentage=None, max_marks=100):
+        self.name = name
+        self.bands = dict(bands)
+        self.pass_percentage = pass_percentage
+        self.internal_max = internal_max
+        self.external_max = external_max
+        self.min_internal_percentage = min_internal_percentage
+        self.min_external_percentage = min_external_percentage
+        self.max_marks = max_marks
+        # Compiled lookup tables: ascending thresholds and the points they award
+        self._thresholds = sorted(self.bands)
+        self._points = [self.bands[threshold] for threshold in self._thresholds]
+        # The same table with the pass mark folded in as a cut worth 0 points, so
+        # one bisect applies both; _cut_points[i] is what bisect index i scores
+        self._cuts = sorted(set(self._thresholds) | {pass_percentage})
+        self._cut_points = [0] + [self.lookup(cut) if cut >= pass_percentage else 0 for cut in self._cuts]
+
+    def lookup(self, percentage):
+        index = bisect_right(self._thresholds, percentage)
+        return self._points[index - 1] if index else 0
+
+    def grade_points(self, totals, max_marks=None, internals=None, externals=None):
+        # Grade a whole batch at once. max_marks may be a single value or one
+        # per total; internals/externals are only needed for the pass rule.
+        cuts, points = self._cuts, self._cut_points
+        if isinstance(max_marks, (list, tuple)):
+            maxima = [maximum or self.max_marks for maximum in max_marks]
+            results = [points[bisect_right(cuts, total * 100 / maximum)] for total, maximum in zip(totals, maxima)]
+        else:
+            maximum = max_marks or self.max_marks
+            maxima = None
+            if maximum == 100:
+                # Totals out of 100 already are percentages
+                results = [points[bisect_right(cuts, total)] for total in totals]
+            else:
+                results = [points[bisect_right(cuts, total * 100 / maximum)] for total in totals]
+
+        for minimum, component_max, marks in ((self.min_internal_percentage, self.internal_max, internals),
+                                              (self.min_external_percentage, self.external_max, externals)):
+            if minimum is None or marks is None or not component_max:
+                continue
+            for i, mark in enumerate(marks):
+                if not results[i]:
+                    continue
+                # CIE/SEE maxima scale with the course, e.g. a 50-mark lab has half the usual split
+                scale = (maxima[i] if maxima else maximum) / self.max_marks
+                if mark * 100 / (component_max * scale) < minimum:
+                    results[i] = 0
+        return results
+
+
+SCHEMES = {}
+
+
+def register_scheme(scheme, *aliases):
+    for key in (scheme.name,) + aliases:
+        SCHEMES[key] = scheme
+    return scheme
+
+
+# The ladder the bot has always used; applies when users.year_scheme is unknown
+DEFAULT_SCHEME = register_scheme(GradingScheme('default', {90: 10, 80: 9, 70: 8, 60: 7, 50: 6, 40: 5}))
+
+# VTU 2018 scheme: S+ S A B C D E, CIE 40 / SEE 60, SEE minimum 35%
+register_scheme(GradingScheme('2018', {90: 10, 80: 9, 70: 8, 60: 7, 50: 6, 45: 5, 40: 4},
+                              internal_max=40, external_max=60, min_external_percentage=35))
+
+# VTU 2021 and 2022 schemes: O A+ A B+ B C P, CIE 50 / SEE 50, CIE minimum 40%, SEE minimum 35%
+for year in ('2021', '2022'):
+    register_scheme(GradingScheme(year, {90: 10, 80: 9, 70: 8, 60: 7, 55: 6, 50: 5, 40: 4},
+                                  internal_max=50, external_max=50,
+                                  min_internal_percentage=40, min_external_percentage=35))
+
+
+def get_scheme(year_scheme):
+    # users.year_scheme is free text: "2022", "22", "2021 scheme", "21-scheme", ...
+    if year_scheme is None:
+        return DEFAULT_SCHEME
+    text = str(year_scheme).strip().lower()
+    if text in SCHEMES:
+        return SCHEMES[text]
+    match = re.search(r'\d{2,4}', text)
+    if match:
+        year = match.group()
+        year = '20' + year[-2:] if len(year) != 4 else year
+        if year in SCHEMES:
+            return SCHEMES[year]
+    return DEFAULT_SCHEME
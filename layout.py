@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+import metrics
+
+# How far down each sheet to look for the subject table's header row
+HEADER_SCAN_ROWS = 40
+
+# Header cell -> column role, checked in order so "Subject Code" is a code and not a name
+ROLE_PATTERNS = (
+    ('subject_code', re.compile(r'\b(code|sub code|course code)\b')),
+    ('internal', re.compile(r'\b(internal|cie|ia)\b')),
+    ('external', re.compile(r'\b(external|see)\b')),
+    ('total', re.compile(r'\btotal\b')),
+    ('max_marks', re.compile(r'\b(max|maximum)\b')),
+    ('subject_name', re.compile(r'\b(name|subject|course|title)\b')),
+)
+REQUIRED_ROLES = {'subject_code', 'internal', 'external'}
+SUBJECT_CODE = re.compile(r'^\d{0,2}[A-Z]{2,}[A-Z0-9]*\d[A-Z0-9]*$')
+
+LAYOUT_CACHE_FILE = os.getenv('LAYOUT_CACHE_FILE')
+
+LAYOUT_CACHE_HITS = metrics.Counter('campus_connect_layout_cache_hits_total', 'Marks cards whose layout was already known.')
+LAYOUT_DETECTIONS = metrics.Counter('campus_connect_layout_detections_total', 'Marks-card layouts detected from scratch.')
+LAYOUT_UNRECOGNIZED = metrics.Counter('campus_connect_layout_unrecognized_total', 'Marks cards whose layout could not be mapped.')
+
+
+class UnrecognizedLayoutError(Exception):
+    pass
+
+
+class Layout:
+    def __init__(self, fingerprint, sheet_index, header_row, columns):
+        self.fingerprint = fingerprint
+        self.sheet_index = sheet_index
+        self.header_row = header_row
+        self.columns = columns
+
+    def to_dict(self):
+        return {'sheet_index': self.sheet_index, 'header_row': self.header_row, 'columns': self.columns}
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _normalize(value):
+    if value is None:
+        return ''
+    return re.sub(r'[^a-z0-9]+', ' ', str(value).lower()).strip()
+
+
+def _fingerprint(sheet_index, header_row, cells):
+    tokens = [_normalize(cell) for cell in cells]
+    while tokens and not tokens[-1]:
+        tokens.pop()
+    key = json.dumps([sheet_index, header_row, tokens])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def _classify(text):
+    for role, pattern in ROLE_PATTERNS:
+        if pattern.search(text):
+            return role
+    return None
+
+
+def _map_columns(cells):
+    columns = {}
+    for index, cell in enumerate(cells):
+        text = _normalize(cell)
+        if not text:
+            continue
+        role = _classify(text)
+        if role and role not in columns:
+            columns[role] = index
+    return columns if REQUIRED_ROLES <= columns.keys() else None
+
+
+def _row(sheet, row_index):
+    for cells in sheet.iter_rows(min_row=row_index, max_row=row_index, values_only=True):
+        return cells
+    return ()
+
+
+def _cached_layout(workbook):
+    # Only the header row at each known position is read, not the whole scan window
+    with _cache_lock:
+        known = list(_cache.values())
+    seen = {}
+    for layout in known:
+        position = (layout.sheet_index, layout.header_row)
+        if position not in seen:
+            if layout.sheet_index >= len(workbook.worksheets):
+                seen[position] = None
+            else:
+                cells = _row(workbook.worksheets[layout.sheet_index], layout.header_row)
+                seen[position] = _fingerprint(layout.sheet_index, layout.header_row, cells)
+        if seen[position] == layout.fingerprint:
+            return layout
+    return None
+
+
+def _detect_layout(workbook):
+    for sheet_index, sheet in enumerate(workbook.worksheets):
+        rows = sheet.iter_rows(max_row=HEADER_SCAN_ROWS, values_only=True)
+        for header_row, cells in enumerate(rows, start=1):
+            columns = _map_columns(cells)
+            if columns:
+                return Layout(_fingerprint(sheet_index, header_row, cells), sheet_index, header_row, columns)
+    return None
+
+
+def _number(value):
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value.strip())
+        except ValueError:
+            return None
+    return None
+
+
+def read_marks(excel_path):
+    # Returns (rows, layout); rows are (code, name, internal, external, max_marks)
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        layout = _cached_layout(workbook)
+        if layout is not None:
+            LAYOUT_CACHE_HITS.inc()
+        else:
+            layout = _detect_layout(workbook)
+            if layout is None:
+                LAYOUT_UNRECOGNIZED.inc()
+                raise UnrecognizedLayoutError('no subject table header found')
+            LAYOUT_DETECTIONS.inc()
+            remember(layout)
+
+        columns = layout.columns
+        sheet = workbook.worksheets[layout.sheet_index]
+        rows = []
+        for cells in sheet.iter_rows(min_row=layout.header_row + 1, values_only=True):
+            code = cells[columns['subject_code']] if len(cells) > columns['subject_code'] else None
+            code = str(code).strip().upper() if code is not None else ''
+            if not SUBJECT_CODE.match(code):
+                continue
+            values = {role: (cells[index] if index < len(cells) else None) for role, index in columns.items()}
+            internal = _number(values['internal']) or 0
+            external = _number(values['external']) or 0
+            max_marks = _number(values.get('max_marks'))
+            rows.append((code, values.get('subject_name'), int(internal), int(external),
+                         int(max_marks) if max_marks else None))
+    finally:
+        workbook.close()
+
+    if not rows:
+        LAYOUT_UNRECOGNIZED.inc()
+        raise UnrecognizedLayoutError(f'layout {layout.fingerprint} matched but no subject rows were found')
+    return rows, layout
+
+
+def remember(layout):
+    with _cache_lock:
+        _cache[layout.fingerprint] = layout
+        snapshot = {fingerprint: known.to_dict() for fingerprint, known in _cache.items()}
+    if LAYOUT_CACHE_FILE:
+        try:
+            with open(LAYOUT_CACHE_FILE, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, indent=2)
+        except OSError as e:
+            print(f"Error saving layout cache: {e}")
+
+
+def load_cache(path=None):
+    path = path or LAYOUT_CACHE_FILE
+    if not path or not os.path.exists(path):
+        return 0
+    try:
+        with open(path, encoding='utf-8') as f:
+            saved = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error loading layout cache: {e}")
+        return 0
+    with _cache_lock:
+        for fingerprint, entry in saved.items():
+            _cache[fingerprint] = Layout(fingerprint, entry['sheet_index'], entry['header_row'], entry['columns'])
+    return len(saved)
@@ -0,0 +1,276 @@
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from datetime import timedelta
+from uuid import uuid4
+
+import metrics
+
+# Seconds a stopping process spends finishing in-flight work; keep it under
+# the supervisor's kill timeout (systemd and Kubernetes default to 90 and 30)
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '25'))
+# A job that was interrupted this many times is dropped instead of retried
+MAX_JOB_ATTEMPTS = 3
+# Reminders missed while the bot was down are still sent if at most this late
+REMINDER_CATCHUP_MINUTES = int(os.getenv('REMINDER_CATCHUP_MINUTES', '60'))
+
+JOBS_RECOVERED = metrics.Counter('campus_connect_recovered_jobs_total', 'Interrupted jobs re-enqueued at startup.', ['kind'])
+
+# Claims one reminder occurrence before it is sent; {0} is the occurrence, {1} the job id
+CLAIM_REMINDER = '''
+    UPDATE reminders SET last_sent_on = {0}
+    WHERE job_id = {1} AND (last_sent_on IS NULL OR last_sent_on < {0})
+    RETURNING user_id
+'''
+# pending_jobs statements shared by JobStore and AsyncJobStore; {0}, {1}, ... are the driver's placeholders
+ADD_JOB = 'INSERT INTO pending_jobs (kind, chat_id, payload, owner) VALUES ({0}, {1}, {2}, {3}) RETURNING job_id'
+FINISH_JOB = 'DELETE FROM pending_jobs WHERE job_id = {0}'
+CLAIM_JOBS = '''
+    UPDATE pending_jobs SET owner = {0}, attempts = attempts + 1
+    WHERE owner IS NULL OR owner <> {1}
+    RETURNING job_id, kind, chat_id, payload, attempts
+'''
+DROP_JOBS = 'DELETE FROM pending_jobs WHERE job_id = ANY({0})'
+
+
+def create_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pending_jobs (
+            job_id SERIAL PRIMARY KEY,
+            kind TEXT,
+            chat_id BIGINT,
+            payload TEXT,
+            owner TEXT,
+            attempts INTEGER DEFAULT 0,
+            created_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def occurrence(moment):
+    # Reminders fire on the minute; this is the occurrence a run at `moment` belongs to
+    return moment.replace(second=0, microsecond=0)
+
+
+def missed_occurrence(time_str, last_sent_on, created_on, now):
+    # The latest scheduled time of a reminder if it was not sent and is recent
+    # enough to still be worth sending, else None
+    hour, minute = map(int, time_str.split(':'))
+    latest = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if latest > now:
+        latest -= timedelta(days=1)
+    if now - latest > timedelta(minutes=REMINDER_CATCHUP_MINUTES):
+        return None
+    since = max([moment for moment in (last_sent_on, created_on) if moment is not None], default=None)
+    if since is not None and latest <= since:
+        return None
+    return latest
+
+
+class Job:
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+
+    def done(self):
+        # Call before replying: a job that is finished is never run again, so
+        # a restart cannot send its reply twice
+        if self.job_id is not None:
+            self.store.finish(self.job_id)
+            self.job_id = None
+
+
+class JobStore:
+    # Long-running work (marks-card conversions) is recorded while it runs;
+    # the next process picks up whatever is left. Only one process polls a bot at a time (Telegram
+    # rejects a second getUpdates), so a starting process owns every job left
+    # by earlier ones.
+
+    def __init__(self, get_connection, release_connection):
+        self._get_connection = get_connection
+        self._release_connection = release_connection
+        self.owner = uuid4().hex
+
+    def _run(self, work, default=None):
+        conn = self._get_connection()
+        if not conn:
+            return default
+        try:
+            cur = conn.cursor()
+            result = work(cur)
+            conn.commit()
+            cur.close()
+            return result
+        except Exception as e:
+            print(f"Error in job store: {e}")
+            conn.rollback()
+            return default
+        finally:
+            self._release_connection(conn)
+
+    def add(self, kind, chat_id, payload):
+        def work(cur):
+            cur.execute(ADD_JOB.format('%s', '%s', '%s', '%s'),
+                        (kind, chat_id, payload if isinstance(payload, str) else json.dumps(payload), self.owner))
+            return cur.fetchone()[0]
+        return self._run(work)
+
+    def finish(self, job_id):
+        def work(cur):
+            cur.execute(FINISH_JOB.format('%s'), (job_id,))
+        self._run(work)
+
+    @contextmanager
+    def track(self, kind, chat_id, payload, job_id=None):
+        # The job is recorded for as long as the block runs; a recovered job
+        # passes its job_id so the same row is reused
+        job = Job(self, job_id if job_id is not None else self.add(kind, chat_id, payload))
+        try:
+            yield job
+        finally:
+            job.done()
+
+    def claim_interrupted(self):
+        # Returns (job_id, kind, chat_id, payload) for the jobs earlier processes left behind
+        def work(cur):
+            cur.execute(CLAIM_JOBS.format('%s', '%s'), (self.owner, self.owner))
+            rows = sorted(cur.fetchall())
+            dropped = dropped_jobs(rows)
+            if dropped:
+                cur.execute(DROP_JOBS.format('%s'), (dropped,))
+            return claimed_jobs(rows)
+        return self._run(work, [])
+
+
+def dropped_jobs(rows):
+    # Claimed rows that were interrupted too often to retry
+    dropped = [row[0] for row in rows if row[4] > MAX_JOB_ATTEMPTS]
+    if dropped:
+        print(f"Dropping {len(dropped)} job(s) interrupted {MAX_JOB_ATTEMPTS} times")
+    return dropped
+
+
+def claimed_jobs(rows):
+    return [(job_id, kind, chat_id, json.loads(payload)) for job_id, kind, chat_id, payload, attempts in rows
+            if attempts <= MAX_JOB_ATTEMPTS]
+
+
+class AsyncJob:
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+
+    async def done(self):
+        # As Job.done(): call before replying
+        if self.job_id is not None:
+            await self.store.finish(self.job_id)
+            self.job_id = None
+
+
+class AsyncJobStore:
+    # JobStore for the asyncio runtime, on an asyncpg pool; both runtimes
+    # share pending_jobs, so either one recovers what the other left
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.owner = uuid4().hex
+
+    async def add(self, kind, chat_id, payload):
+        try:
+            return await self.pool.fetchval(ADD_JOB.format('$1', '$2', '$3', '$4'), kind, chat_id,
+                                            payload if isinstance(payload, str) else json.dumps(payload), self.owner)
+        except Exception as e:
+            print(f"Error in job store: {e}")
+            return None
+
+    async def finish(self, job_id):
+        try:
+            await self.pool.execute(FINISH_JOB.format('$1'), job_id)
+        except Exception as e:
+            print(f"Error in job store: {e}")
+
+    @asynccontextmanager
+    async def track(self, kind, chat_id, payload, job_id=None):
+        job = AsyncJob(self, job_id if job_id is not None else await self.add(kind, chat_id, payload))
+        try:
+            yield job
+        finally:
+            await job.done()
+
+    async def claim_interrupted(self):
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                rows = sorted(tuple(row) for row in await conn.fetch(CLAIM_JOBS.format('$1', '$1'), self.owner))
+                dropped = dropped_jobs(rows)
+                if dropped:
+                    await conn.execute(DROP_JOBS.format('$1'), dropped)
+            return claimed_jobs(rows)
+        except Exception as e:
+            print(f"Error in job store: {e}")
+            return []
+
+
+class Lifecycle:
+    # SIGTERM and SIGINT ask the process to stop; shutdown() then runs the
+    # registered steps in order against one deadline
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._on_stop = []
+
+    def install_signal_handlers(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._signal)
+
+    def _signal(self, signum, frame):
+        if self._stop.is_set():
+            # A second signal skips the drain
+            print(f"Received {signal.Signals(signum).name} again, exiting now")
+            sys.stdout.flush()
+            os._exit(1)
+        print(f"Received {signal.Signals(signum).name}, shutting down")
+        self.request_stop()
+
+    def on_stop(self, func):
+        self._on_stop.append(func)
+
+    def request_stop(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        for func in self._on_stop:
+            try:
+                func()
+            except Exception as e:
+                print(f"Error stopping: {e}")
+
+    def stopping(self):
+        return self._stop.is_set()
+
+    def wait(self, timeout=None):
+        return self._stop.wait(timeout)
+
+    def shutdown(self, steps, timeout=SHUTDOWN_TIMEOUT):
+        # steps are (name, func) pairs; func gets the seconds left and returns
+        # False if it had to leave work unfinished. Returns True if every step finished.
+        deadline = time.monotonic() + timeout
+        finished = True
+        for name, step in steps:
+            started = time.monotonic()
+            try:
+                ok = step(max(0.0, deadline - started)) is not False
+            except Exception as e:
+                print(f"Error during shutdown ({name}): {e}")
+                ok = False
+            print(f"Shutdown: {name} {'done' if ok else 'left unfinished'} in {time.monotonic() - started:.1f}s")
+            finished = finished and ok
+        return finished
+
+
+manager = Lifecycle()
+jobs = None
+async_jobs = None
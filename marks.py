@@ -0,0 +1,99 @@
+import re
+from collections import Counter, namedtuple
+
+import metrics
+from grading import get_scheme
+from layout import read_marks
+
+SEMESTER_DIGIT = re.compile(r'^\d{0,2}[A-Z]+(\d)')
+
+GradedSubject = namedtuple('GradedSubject', 'code name internal external max_marks credits grade_points')
+
+
+def convert_pdf_to_excel(pdf_path, excel_path):
+    # Both arguments may be paths or binary file objects such as io.BytesIO
+    import aspose.pdf as ap
+
+    with metrics.PDF_CONVERSION_SECONDS.time():
+        document = ap.Document(pdf_path)
+        save_option = ap.ExcelSaveOptions()
+        document.save(excel_path, save_option)
+    return excel_path
+
+
+def read_marks_rows(excel_path):
+    # Raises layout.UnrecognizedLayoutError rather than scoring an unknown layout as 0
+    rows, _ = read_marks(excel_path)
+    return rows
+
+
+def grade_subjects(rows, year_scheme=None):
+    # rows are (subject_code, subject_name, internal, external, max_marks) tuples;
+    # max_marks of None means the scheme's usual 100. Returns one GradedSubject per row.
+    scheme = get_scheme(year_scheme)
+    grade_points = scheme.grade_points(
+        [internal + external for _, _, internal, external, _ in rows],
+        max_marks=[max_marks for _, _, _, _, max_marks in rows],
+        internals=[internal for _, _, internal, _, _ in rows],
+        externals=[external for _, _, _, external, _ in rows],
+    )
+    return [GradedSubject(code, name, internal, external, max_marks or scheme.max_marks, get_credits_for_subject(code), points)
+            for (code, name, internal, external, max_marks), points in zip(rows, grade_points)]
+
+
+def sgpa_of(subjects):
+    # Returns None when none of the subjects carry credits, so an unknown card
+    # is not reported as SGPA 0
+    credited = [subject for subject in subjects if subject.credits > 0]
+    if not credited:
+        return None
+    total_points = sum(subject.grade_points * subject.credits for subject in credited)
+    total_credits = sum(subject.credits for subject in credited)
+    return total_points / total_credits
+
+
+def compute_sgpa(rows, year_scheme=None):
+    return sgpa_of(grade_subjects(rows, year_scheme))
+
+
+def process_excel_data(excel_path, year_scheme=None):
+    return compute_sgpa(read_marks_rows(excel_path), year_scheme)
+
+
+def semester_of(rows):
+    # VTU codes carry the semester as the first digit after the department
+    # letters: 21CS51 -> 5, BCS301 -> 3, BMATS101 -> 1
+    votes = Counter()
+    for row in rows:
+        match = SEMESTER_DIGIT.match(row[0] or '')
+        if match and match.group(1) != '0':
+            votes[match.group(1)] += get_credits_for_subject(row[0]) or 1
+    return votes.most_common(1)[0][0] if votes else None
+
+
+def analyze_marks(excel_source, year_scheme=None):
+    rows = read_marks_rows(excel_source)
+    subjects = grade_subjects(rows, year_scheme)
+    return {'sgpa': sgpa_of(subjects), 'semester': semester_of(rows), 'rows': rows, 'subjects': subjects}
+
+
+def convert_to_grade_points(total_marks, year_scheme=None):
+    # Single lookup for a total out of 100; use GradingScheme.grade_points for batches
+    scheme = get_scheme(year_scheme)
+    return scheme.lookup(total_marks) if total_marks >= scheme.pass_percentage else 0
+
+
+CREDITS_MAP = {
+    #5th sem 21 batch
+   '21CS51': 3,'21CSL582': 1,'21CS52': 4,'21CS53': 3,'21CS54': 3,'21CSL55': 1,'21RMI56': 2,'21CIV57': 1,
+   #3rd sem 21 batch
+    '21MAT31':3,'21CS382':1,'21CS32':4,'21CS33':4,'21CS34':3,'21CSL35':1,'21SCR36':1,'21KBK37':1,
+    #3rd sem 22 batch
+    'BCS301':4,'BCS302':4,'BCS303':4,'BCS304':3,'BCSL305':1,'BSCK307':1,'BNSK359':0,'BCS306A':3,'BCS358C':1,
+    #1st sem 22 batch
+    'BMATS101':4,'BPHYS102':4,'BPOPS103':3,'BESCK104B':3,'BETCK105I':3,'BENGK106':1,'BICOK107':1,'BIDTK158':1,
+}
+
+
+def get_credits_for_subject(subject_code):
+    return CREDITS_MAP.get(subject_code, 0)
@@ -0,0 +1,290 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default latency buckets in seconds, from fast DB lookups up to slow PDF conversions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(key)} {_format_value(value)}' for key, value in values]
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._fn = fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn):
+        # fn is evaluated at scrape time; it returns a number, or a dict of
+        # label-tuple -> number for labelled gauges
+        self._fn = fn
+
+    def _samples(self):
+        if self._fn is not None:
+            try:
+                value = self._fn()
+            except Exception as e:
+                print(f"Error collecting gauge {self.name}: {e}")
+                return []
+            if isinstance(value, dict):
+                items = sorted((tuple(zip(self.labelnames, key)), v) for key, v in value.items())
+            else:
+                items = [((), value)]
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(key)} {_format_value(value)}' for key, value in items]
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(key + (("le", _format_value(bound)),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics shared by the bot
+HANDLER_SECONDS = Histogram('campus_connect_handler_seconds', 'Time spent in update handlers.', ['handler'])
+HANDLER_ERRORS = Counter('campus_connect_handler_errors_total', 'Handler invocations that raised.', ['handler'])
+DB_QUERY_SECONDS = Histogram('campus_connect_db_query_seconds', 'Database statement latency.', ['statement'])
+TELEGRAM_API_SECONDS = Histogram('campus_connect_telegram_api_seconds', 'Telegram Bot API call latency.', ['method'])
+PDF_CONVERSION_SECONDS = Histogram('campus_connect_pdf_conversion_seconds', 'Marks card PDF to Excel conversion time.')
+REPORT_RENDER_SECONDS = Histogram('campus_connect_report_render_seconds', 'SGPA/CGPA report rendering time.')
+DB_POOL_IN_USE = Gauge('campus_connect_db_pool_connections_in_use', 'Connections checked out of the pool.')
+DB_POOL_IDLE = Gauge('campus_connect_db_pool_connections_idle', 'Idle connections held by the pool.')
+SESSIONS = Gauge('campus_connect_sessions', 'Chat sessions held in memory.')
+QUEUE_DEPTH = Gauge('campus_connect_update_queue_depth', 'Updates queued or running, across all chats.')
+SCHEDULED_REMINDERS = Gauge('campus_connect_scheduled_reminders', 'Reminder jobs registered with the scheduler.')
+STARTUP_SECONDS = Gauge('campus_connect_startup_seconds', 'Time spent in each startup phase.', ['phase'])
+
+
+def timed_handler(func, name=None):
+    name = name or func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+    return wrapper
+
+
+def timed_coroutine(func, name=None):
+    # timed_handler for async handlers
+    name = name or func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+    return wrapper
+
+
+def instrument_handlers(bot):
+    # Wrap every registered handler so each one reports its own latency
+    wrap = timed_coroutine if getattr(bot, 'is_async', False) else timed_handler
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            handler['function'] = wrap(handler['function'])
+
+
+def statement_name(sql):
+    # Label a statement by verb and table, e.g. "select_users" or "insert_marks_cards"
+    tokens = sql.replace('(', ' ').replace(';', ' ').lower().split()
+    if not tokens:
+        return 'unknown'
+    verb = tokens[0]
+    if verb == 'update':
+        return f'update_{tokens[1]}' if len(tokens) > 1 else verb
+    keywords = {'select': 'from', 'delete': 'from', 'insert': 'into', 'create': 'table', 'alter': 'table'}
+    keyword = keywords.get(verb)
+    if keyword not in tokens[:-1]:
+        return verb
+    table = tokens[tokens.index(keyword) + 1:]
+    while table[:1] and table[0] in ('if', 'not', 'exists'):
+        table = table[1:]
+    return f'{verb}_{table[0]}' if table else verb
+
+
+def make_timed_cursor(base):
+    class TimedCursor(base):
+        def execute(self, query, vars=None):
+            start = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                sql = query if isinstance(query, str) else str(query)
+                DB_QUERY_SECONDS.observe(time.perf_counter() - start, statement=statement_name(sql))
+
+        def executemany(self, query, vars_list):
+            start = time.perf_counter()
+            try:
+                return super().executemany(query, vars_list)
+            finally:
+                sql = query if isinstance(query, str) else str(query)
+                DB_QUERY_SECONDS.observe(time.perf_counter() - start, statement=statement_name(sql))
+    return TimedCursor
+
+
+def timed_request_sender(send):
+    # Plugs into telebot.apihelper.CUSTOM_REQUEST_SENDER; the Bot API method is the last URL segment
+    def sender(method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            return send(method, url, **kwargs)
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - start, method=url.rsplit('/', 1)[-1])
+    return sender
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    return server
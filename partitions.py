@@ -0,0 +1,313 @@
+import argparse
+import gzip
+import os
+import sys
+from datetime import datetime
+
+import psycopg2
+from dotenv import load_dotenv
+
+if __name__ == '__main__':
+    # Run as a script: the settings below come from .env too
+    load_dotenv()
+
+# Append-heavy tables, partitioned by month on their timestamp column. Reminders
+# are not here: they are a small live schedule that is read in full at startup.
+PARTITIONED = {
+    'marks_cards': ('card_id', 'uploaded_on'),
+    'feedback': ('feedback_id', 'submitted_on'),
+    'shared_documents': ('doc_id', 'shared_on'),
+}
+# Months kept in the live database; older partitions are archived. 0 keeps everything.
+RETENTION_MONTHS = {
+    'marks_cards': int(os.getenv('MARKS_CARDS_RETENTION_MONTHS', '36')),
+    'feedback': int(os.getenv('FEEDBACK_RETENTION_MONTHS', '12')),
+    'shared_documents': int(os.getenv('SHARED_DOCUMENTS_RETENTION_MONTHS', '24')),
+}
+# Partitions created ahead of time so inserts never find their month missing
+MONTHS_AHEAD = 3
+# A marks card uploaded again within this many months is reported as a
+# duplicate; an older copy of the same file is read again. The bound lets the
+# planner skip the older partitions. 0 checks every live month.
+DUPLICATE_CARD_MONTHS = int(os.getenv('DUPLICATE_CARD_MONTHS', '6'))
+# Earliest restored month of a table; {0} is the driver's placeholder
+RESTORED_SINCE_QUERY = 'SELECT MIN(range_from) FROM archived_partitions WHERE parent = {0} AND restored_on IS NOT NULL'
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f'{table}_p{month:%Y_%m}'
+
+
+def duplicate_card_since(now=None):
+    # Lower bound on uploaded_on for the duplicate marks-card check
+    if DUPLICATE_CARD_MONTHS <= 0:
+        return datetime.min
+    return add_months(month_start(now or datetime.now()), 1 - DUPLICATE_CARD_MONTHS)
+
+
+def live_since(table, restored_since=None, now=None):
+    # Oldest moment the live database holds for table: the start of its
+    # retention window, or of the oldest month brought back with restore()
+    months = RETENTION_MONTHS[table]
+    if months <= 0:
+        return datetime.min
+    since = add_months(month_start(now or datetime.now()), -months)
+    return min(since, restored_since) if restored_since else since
+
+
+def fetch_live_since(cur, table):
+    # live_since() with the restored months read from the database
+    cur.execute(RESTORED_SINCE_QUERY.format('%s'), (table,))
+    return live_since(table, cur.fetchone()[0])
+
+
+def create_tables(cur, partitioned=True):
+    # Without partitioning (the SQLite backend) the tables stay plain and only get the indexes
+    if partitioned:
+        create_partitioned_tables(cur)
+    # Indexes on a partitioned parent are created on every partition, including future ones
+    cur.execute('CREATE INDEX IF NOT EXISTS marks_cards_user_file ON marks_cards (user_id, file_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS feedback_user ON feedback (user_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS shared_documents_user ON shared_documents (user_id)')
+    if partitioned:
+        ensure_partitions(cur)
+
+
+def create_partitioned_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS archived_partitions (
+            partition_name TEXT PRIMARY KEY,
+            parent TEXT,
+            range_from TIMESTAMP,
+            range_to TIMESTAMP,
+            path TEXT,
+            row_count BIGINT,
+            archived_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            restored_on TIMESTAMP
+        )
+    """)
+    for table, (id_column, time_column) in PARTITIONED.items():
+        if not is_partitioned(cur, table):
+            convert(cur, table, id_column, time_column)
+
+
+def is_partitioned(cur, table):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def convert(cur, table, id_column, time_column):
+    # One-off migration of a plain table: the rows are copied into monthly
+    # partitions of a new table with the same columns, id sequence and defaults
+    legacy = f'{table}_unpartitioned'
+    print(f"Partitioning {table} by month on {time_column}")
+    cur.execute(f'UPDATE {table} SET {time_column} = CURRENT_TIMESTAMP WHERE {time_column} IS NULL')
+    cur.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+    cur.execute(f'ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey')
+    cur.execute(f'CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ({time_column})')
+    cur.execute(f'ALTER TABLE {table} ALTER COLUMN {time_column} SET NOT NULL')
+    # The primary key of a partitioned table has to include the partition key
+    cur.execute(f'ALTER TABLE {table} ADD PRIMARY KEY ({id_column}, {time_column})')
+    cur.execute(f'ALTER TABLE {table} ADD FOREIGN KEY (user_id) REFERENCES users(user_id)')
+    cur.execute('SELECT pg_get_serial_sequence(%s, %s)', (legacy, id_column))
+    sequence = cur.fetchone()[0]
+    if sequence:
+        cur.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.{id_column}')
+
+    # Only months that have rows; ensure_partitions() adds the current and upcoming ones
+    cur.execute(f"SELECT DISTINCT date_trunc('month', {time_column}) FROM {legacy}")
+    for month, in cur.fetchall():
+        create_partition(cur, table, month)
+    cur.execute(f'INSERT INTO {table} SELECT * FROM {legacy}')
+    cur.execute(f'DROP TABLE {legacy}')
+
+
+def create_partition(cur, table, month):
+    name = partition_name(table, month)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM ('{month:%Y-%m-%d}') "
+                f"TO ('{add_months(month, 1):%Y-%m-%d}')")
+    return name
+
+
+def ensure_partitions(cur, now=None):
+    current = month_start(now or datetime.now())
+    for table in PARTITIONED:
+        for offset in range(MONTHS_AHEAD + 1):
+            create_partition(cur, table, add_months(current, offset))
+
+
+def live_partitions(cur, table):
+    # (name, first day of its month) for every attached partition, oldest first
+    cur.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                'WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname', (table,))
+    prefix = f'{table}_p'
+    return [(name, datetime.strptime(name[len(prefix):], '%Y_%m')) for name, in cur.fetchall() if name.startswith(prefix)]
+
+
+def cold_partitions(cur, now=None):
+    # Partitions whose whole month is older than the table's retention, except
+    # ones brought back with restore(), which stay until archived by hand
+    current = month_start(now or datetime.now())
+    cur.execute('SELECT partition_name FROM archived_partitions WHERE restored_on IS NOT NULL')
+    restored = {name for name, in cur.fetchall()}
+    cold = []
+    for table in PARTITIONED:
+        months = RETENTION_MONTHS[table]
+        if months <= 0:
+            continue
+        cutoff = add_months(current, -months)
+        cold += [(table, name, month) for name, month in live_partitions(cur, table)
+                 if add_months(month, 1) <= cutoff and name not in restored]
+    return cold
+
+
+def archive(conn, table, name, month):
+    # The partition is written to a gzip'd CSV first; it is only detached and
+    # dropped once the file is complete, all in one transaction
+    directory = os.path.join(ARCHIVE_DIR, table)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.csv.gz')
+    partial = path + '.partial'
+    cur = conn.cursor()
+    try:
+        # Nothing can be written to the partition while it is copied out
+        cur.execute(f'LOCK TABLE {name} IN SHARE MODE')
+        with gzip.open(partial, 'wb') as archive_file:
+            cur.copy_expert(f'COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)', archive_file)
+            rows = cur.rowcount
+        with open(partial, 'rb') as archive_file:
+            os.fsync(archive_file.fileno())
+        os.replace(partial, path)
+        cur.execute(f'ALTER TABLE {table} DETACH PARTITION {name}')
+        cur.execute(f'DROP TABLE {name}')
+        cur.execute('''
+            INSERT INTO archived_partitions (partition_name, parent, range_from, range_to, path, row_count)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (partition_name) DO UPDATE SET path = EXCLUDED.path, row_count = EXCLUDED.row_count,
+                archived_on = CURRENT_TIMESTAMP, restored_on = NULL
+        ''', (name, table, month, add_months(month, 1), os.path.abspath(path), rows))
+        conn.commit()
+        return path, rows
+    except Exception:
+        conn.rollback()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        cur.close()
+
+
+def restore(conn, name):
+    # Recreates the partition for its month and loads the archived rows back
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT parent, range_from, path FROM archived_partitions WHERE partition_name = %s AND restored_on IS NULL',
+                    (name,))
+        row = cur.fetchone()
+        if row is None:
+            raise ValueError(f'{name} is not an archived partition')
+        table, month, path = row
+        create_partition(cur, table, month)
+        with gzip.open(path, 'rb') as archive_file:
+            # The header names the columns, so a later column order change does not matter
+            columns = archive_file.readline().decode().strip()
+            cur.copy_expert(f'COPY {name} ({columns}) FROM STDIN WITH (FORMAT csv)', archive_file)
+            rows = cur.rowcount
+        cur.execute('UPDATE archived_partitions SET restored_on = CURRENT_TIMESTAMP WHERE partition_name = %s', (name,))
+        conn.commit()
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def maintain(conn, now=None):
+    # Daily job: add next months' partitions and archive the ones past retention
+    cur = conn.cursor()
+    try:
+        ensure_partitions(cur, now)
+        conn.commit()
+        cold = cold_partitions(cur, now)
+        conn.commit()
+    finally:
+        cur.close()
+    archived = []
+    for table, name, month in cold:
+        try:
+            path, rows = archive(conn, table, name, month)
+            print(f"Archived {rows} rows from {name} to {path}")
+            archived.append(name)
+        except Exception as e:
+            print(f"Error archiving {name}: {e}")
+    return archived
+
+
+def list_partitions(conn):
+    cur = conn.cursor()
+    try:
+        lines = []
+        for table in PARTITIONED:
+            names = [name for name, _ in live_partitions(cur, table)]
+            lines.append(f'{table}: {len(names)} live partitions ({names[0]} .. {names[-1]})' if names else f'{table}: not partitioned')
+        cur.execute('SELECT partition_name, row_count, archived_on, restored_on, path FROM archived_partitions ORDER BY partition_name')
+        for name, rows, archived_on, restored_on, path in cur.fetchall():
+            state = f'restored {restored_on:%Y-%m-%d}' if restored_on else f'archived {archived_on:%Y-%m-%d}'
+            lines.append(f'{name}: {rows} rows, {state}, {path}')
+        conn.commit()
+        return lines
+    finally:
+        cur.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the monthly partitions and their archives')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    subcommands.add_parser('list', help='show live partitions and archived ones')
+    subcommands.add_parser('maintain', help='create upcoming partitions and archive the ones past retention')
+    archive_parser = subcommands.add_parser('archive', help='archive one live partition now')
+    archive_parser.add_argument('partition', help='partition name, e.g. feedback_p2024_01')
+    restore_parser = subcommands.add_parser('restore', help='load an archived partition back into the database')
+    restore_parser.add_argument('partition', help='partition name, e.g. feedback_p2024_01')
+    args = parser.parse_args(argv)
+
+    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        if args.command == 'list':
+            print('\n'.join(list_partitions(conn)))
+        elif args.command == 'maintain':
+            print(f"Archived {len(maintain(conn))} partition(s)")
+        elif args.command == 'archive':
+            table = next((table for table in PARTITIONED if args.partition.startswith(f'{table}_p')), None)
+            with conn.cursor() as cur:
+                months = dict(live_partitions(cur, table)) if table else {}
+            if args.partition not in months:
+                print(f'{args.partition} is not a live partition')
+                return 1
+            path, rows = archive(conn, table, args.partition, months[args.partition])
+            print(f"Archived {rows} rows from {args.partition} to {path}")
+        else:
+            try:
+                print(f"Restored {restore(conn, args.partition)} rows into {args.partition}")
+            except ValueError as e:
+                print(e)
+                return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+import metrics
+
+RANKED_STUDENTS = metrics.Gauge('campus_connect_ranked_students', 'Students with an SGPA in the cohort rankings.')
+
+RANK_QUERY = 'SELECT user_id, college, branch, semester, sgpa FROM users WHERE sgpa IS NOT NULL'
+
+
+def cohort_key(college, branch, semester):
+    # Profiles are typed by hand, so "RVCE " and "rvce" are the same cohort
+    if not (college and branch and semester):
+        return None
+    return college.strip().lower(), branch.strip().lower(), semester.strip().lower()
+
+
+class CohortRanking:
+    # One ascending list of SGPAs per college/branch/semester. Lookups are two
+    # bisects; a write moves one entry instead of re-sorting the cohort.
+
+    def __init__(self):
+        self._cohorts = {}
+        self._students = {}
+        self._lock = threading.Lock()
+        RANKED_STUDENTS.set_function(lambda: len(self._students))
+
+    def rebuild(self, rows):
+        cohorts = {}
+        students = {}
+        for user_id, college, branch, semester, sgpa in rows:
+            key = cohort_key(college, branch, semester)
+            if key is None or sgpa is None:
+                continue
+            cohorts.setdefault(key, []).append(sgpa)
+            students[user_id] = (key, sgpa)
+        for values in cohorts.values():
+            values.sort()
+        with self._lock:
+            self._cohorts = cohorts
+            self._students = students
+        return len(students)
+
+    def update(self, user_id, college, branch, semester, sgpa):
+        key = cohort_key(college, branch, semester)
+        with self._lock:
+            self._remove(user_id)
+            if key is None or sgpa is None:
+                return
+            insort(self._cohorts.setdefault(key, []), sgpa)
+            self._students[user_id] = (key, sgpa)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        entry = self._students.pop(user_id, None)
+        if entry is None:
+            return
+        key, sgpa = entry
+        values = self._cohorts[key]
+        del values[bisect_left(values, sgpa)]
+        if not values:
+            del self._cohorts[key]
+
+    def rank(self, user_id):
+        # Returns (rank, cohort size, percent of the cohort below you) or None;
+        # equal SGPAs share a rank
+        with self._lock:
+            entry = self._students.get(user_id)
+            if entry is None:
+                return None
+            key, sgpa = entry
+            values = self._cohorts[key]
+            below = bisect_left(values, sgpa)
+            above = len(values) - bisect_right(values, sgpa)
+            return above + 1, len(values), below * 100 / len(values)
+
+
+def load(cur):
+    cur.execute(RANK_QUERY)
+    return board.rebuild(cur.fetchall())
+
+
+def format_rank(result, college, branch, semester):
+    rank, size, percentile = result
+    cohort = f'{college.strip()} / {branch.strip()} / semester {semester.strip()}'
+    if size == 1:
+        return f'You are the only student in {cohort} with an SGPA so far.'
+    return (f'You are ranked {rank} of {size} in {cohort}.\n'
+            f'Your SGPA is higher than {percentile:.0f}% of your cohort.')
+
+
+board = None
@@ -0,0 +1,42 @@
+import metrics
+
+
+def render_report(user, report_path):
+    # ReportLab is only needed when someone asks for a report, so load it on first use
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
+
+    c = SimpleDocTemplate(report_path, pagesize=letter)
+
+    styles = getSampleStyleSheet()
+    title_style = styles['Title']
+    title = Paragraph('Campus Connect', title_style)
+
+    table_data = [
+        ['Field', 'Details'],
+        ['Full Name', user[0]],
+        ['Semester', user[1]],
+        ['College', user[2]],
+        ['Branch', user[3]],
+        ['SGPA', f'{user[4]:.2f}'],
+        ['CGPA', f'{user[5]:.2f}'],
+    ]
+
+    table = Table(table_data, colWidths=[150, 350])
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 14),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ]))
+
+    elements = [title, table]
+    with metrics.REPORT_RENDER_SECONDS.time():
+        c.build(elements)
+    return report_path
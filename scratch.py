@@ -0,0 +1,146 @@
+import fcntl
+import io
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from uuid import uuid4
+
+import metrics
+
+# Point SCRATCH_DIR at a tmpfs such as /dev/shm/campus-connect to keep conversions off the disk
+SCRATCH_DIR = os.getenv('SCRATCH_DIR') or os.path.join(tempfile.gettempdir(), 'campus-connect-scratch')
+SCRATCH_QUOTA_BYTES = int(os.getenv('SCRATCH_QUOTA_BYTES', str(512 * 1024 * 1024)))
+# Payloads up to this size are kept in memory instead of being written out
+SCRATCH_MEMORY_LIMIT = int(os.getenv('SCRATCH_MEMORY_LIMIT', str(2 * 1024 * 1024)))
+
+SCRATCH_BYTES = metrics.Gauge('campus_connect_scratch_bytes_in_use', 'Bytes held on disk by scratch jobs.')
+SCRATCH_JOBS = metrics.Gauge('campus_connect_scratch_jobs', 'Scratch jobs currently open.')
+SCRATCH_REJECTED = metrics.Counter('campus_connect_scratch_quota_rejections_total', 'Writes refused because the scratch quota was full.')
+
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, workspace, path):
+        self.workspace = workspace
+        self.dir = path
+        self.bytes = 0
+
+    def path(self, name):
+        # For tools that insist on writing a file themselves; call track() afterwards
+        return os.path.join(self.dir, os.path.basename(name))
+
+    def track(self, path):
+        size = os.path.getsize(path)
+        try:
+            self._reserve(size)
+        except ScratchQuotaExceeded:
+            os.remove(path)
+            raise
+        return path
+
+    def write(self, name, data):
+        self._reserve(len(data))
+        path = self.path(name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def store(self, name, data):
+        # Small payloads come back as an in-memory stream, larger ones as a path on disk
+        if len(data) <= self.workspace.memory_limit:
+            return io.BytesIO(data)
+        return self.write(name, data)
+
+    def _reserve(self, size):
+        self.workspace._reserve(size)
+        self.bytes += size
+
+
+class Workspace:
+    def __init__(self, root=SCRATCH_DIR, quota=SCRATCH_QUOTA_BYTES, memory_limit=SCRATCH_MEMORY_LIMIT):
+        self.root = root
+        self.quota = quota
+        self.memory_limit = memory_limit
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._jobs = 0
+        # Job directories are named after a token held under an flock for the
+        # life of the process. A PID would not do: a restarted container's
+        # bot is PID 1 again and would take the last run's leftovers for its own.
+        self.token = uuid4().hex[:12]
+        self._lock_file = None
+
+    def _reserve(self, size):
+        with self._lock:
+            if self._bytes + size > self.quota:
+                SCRATCH_REJECTED.inc()
+                raise ScratchQuotaExceeded(f'scratch quota of {self.quota} bytes is full ({self._bytes} in use)')
+            self._bytes += size
+
+    @contextmanager
+    def job(self, kind='job'):
+        # Every job gets its own directory, removed on success and on failure
+        self._hold_lock()
+        path = os.path.join(self.root, f'{self.token}-{kind}-{uuid4().hex}')
+        os.mkdir(path)
+        job = Job(self, path)
+        with self._lock:
+            self._jobs += 1
+        try:
+            yield job
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+            with self._lock:
+                self._jobs -= 1
+                self._bytes -= job.bytes
+
+    def _hold_lock(self):
+        with self._lock:
+            if self._lock_file is None:
+                os.makedirs(self.root, exist_ok=True)
+                lock_file = open(os.path.join(self.root, f'{self.token}.lock'), 'w')
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._lock_file = lock_file
+
+    def cleanup_stale(self):
+        # Remove job directories left behind by processes that are no longer
+        # running: any token that is not ours and whose lock nobody holds
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        self._hold_lock()
+        live = {self.token}
+        stale_locks = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.lock') or name[:-len('.lock')] == self.token:
+                continue
+            lock_file = open(os.path.join(self.root, name), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                stale_locks.append((name, lock_file))
+            except BlockingIOError:
+                live.add(name[:-len('.lock')])
+                lock_file.close()
+        for name in os.listdir(self.root):
+            if name.endswith('.lock') or name.split('-', 1)[0] in live:
+                continue
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            removed += 1
+        for name, lock_file in stale_locks:
+            os.remove(os.path.join(self.root, name))
+            lock_file.close()
+        return removed
+
+    def usage(self):
+        with self._lock:
+            return {'root': self.root, 'bytes_in_use': self._bytes, 'quota': self.quota, 'jobs': self._jobs}
+
+
+workspace = Workspace()
+SCRATCH_BYTES.set_function(lambda: workspace.usage()['bytes_in_use'])
+SCRATCH_JOBS.set_function(lambda: workspace.usage()['jobs'])
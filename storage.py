@@ -0,0 +1,302 @@
+import re
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+
+from psycopg2 import extensions, extras, pool
+
+import metrics
+
+# Seconds a transaction waits for the SQLite write lock before giving up,
+# like a Postgres lock_timeout; the single writer keeps transactions short
+SQLITE_WRITE_TIMEOUT = 30
+
+SQLITE_WRITE_WAIT = metrics.Histogram('campus_connect_sqlite_write_wait_seconds', 'Time spent waiting for the SQLite write lock.')
+
+# SQLite has no datetime type; values are stored as ISO text in the local time
+# zone, like the TIMESTAMP columns Postgres fills from CURRENT_TIMESTAMP
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('DATE', lambda value: date.fromisoformat(value.decode()))
+
+
+def backend_name(url):
+    return 'sqlite' if (url or '').startswith('sqlite:') else 'postgres'
+
+
+def connect(url, size):
+    # DATABASE_URL picks the backend: postgresql://... or sqlite:///campus.db
+    if backend_name(url) == 'sqlite':
+        return SQLiteBackend(sqlite_path(url), size)
+    return PostgresBackend(1, size, url, cursor_factory=metrics.make_timed_cursor(extensions.cursor))
+
+
+def sqlite_path(url):
+    # sqlite:///campus.db is relative to the working directory, sqlite:////srv/campus.db absolute
+    path = url.split(':', 1)[1]
+    if path.startswith('//'):
+        path = path[3:] if path.startswith('///') else path[2:]
+    if not path:
+        raise ValueError('a SQLite DATABASE_URL needs a file path, e.g. sqlite:///campus.db')
+    return path
+
+
+def execute_values(cur, query, rows):
+    # psycopg2.extras.execute_values() for either backend; query has one "VALUES %s"
+    if isinstance(cur, SQLiteCursor):
+        return cur.execute_values(query, rows)
+    return extras.execute_values(cur, query, rows)
+
+
+class PostgresBackend(pool.ThreadedConnectionPool):
+    name = 'postgres'
+    # Monthly partitions and their archives (partitions.py)
+    partitioning = True
+
+    def in_use(self):
+        return len(self._used)
+
+    def idle(self):
+        return len(self._pool)
+
+
+class SQLiteBackend:
+    # An embedded database for single-campus deployments and local benchmarks.
+    # In WAL mode readers never block the writer or each other, so every pooled
+    # connection reads on its own sqlite3 connection; SQLite allows one writer
+    # at a time, so writes share one connection and a transaction holds it from
+    # its first write until commit or rollback. The SQL is the Postgres SQL used
+    # everywhere else, translated by translate().
+    name = 'sqlite'
+    partitioning = False
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = []
+        self._used = set()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.cursor_factory = metrics.make_timed_cursor(SQLiteCursor)
+        self.writer = self._open()
+        self.writer.execute('PRAGMA journal_mode = WAL')
+        # WAL stays consistent after a crash with NORMAL; only the last commits can be lost on power failure
+        self.writer.execute('PRAGMA synchronous = NORMAL')
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=SQLITE_WRITE_TIMEOUT, isolation_level=None,
+                               check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.execute('PRAGMA foreign_keys = ON')
+        return conn
+
+    def getconn(self):
+        with self._lock:
+            if self._idle:
+                conn = self._idle.pop()
+            elif len(self._used) < self.size:
+                conn = SQLiteConnection(self, self._open())
+            else:
+                raise pool.PoolError('connection pool exhausted')
+            self._used.add(conn)
+            return conn
+
+    def putconn(self, conn):
+        # Like psycopg2's pool, anything left uncommitted is rolled back
+        with self._lock:
+            if conn not in self._used:
+                raise pool.PoolError('trying to put unkeyed connection')
+            self._used.discard(conn)
+        conn.rollback()
+        with self._lock:
+            self._idle.append(conn)
+
+    def closeall(self):
+        with self._lock:
+            for conn in self._idle + list(self._used):
+                conn.reader.close()
+            self._idle, self._used = [], set()
+        self.writer.close()
+
+    def in_use(self):
+        return len(self._used)
+
+    def idle(self):
+        return len(self._idle)
+
+    def begin_write(self):
+        start = time.perf_counter()
+        acquired = self._write_lock.acquire(timeout=SQLITE_WRITE_TIMEOUT)
+        SQLITE_WRITE_WAIT.observe(time.perf_counter() - start)
+        if not acquired:
+            raise sqlite3.OperationalError('database is locked')
+        try:
+            self.writer.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self._write_lock.release()
+            raise
+
+    def end_write(self, statement):
+        try:
+            self.writer.execute(statement)
+        finally:
+            self._write_lock.release()
+
+
+class SQLiteConnection:
+    # The psycopg2 connection interface the bot uses: cursor(), commit(), rollback()
+
+    def __init__(self, backend, reader):
+        self.backend = backend
+        self.reader = reader
+        self.writing = False
+        self.snapshot = False
+
+    def cursor(self, name=None):
+        # SQLite cursors already step through results lazily, so a named
+        # (server-side) cursor is an ordinary one
+        return self.backend.cursor_factory(self)
+
+    def connection_for(self, sql):
+        if not self.writing and is_write(sql):
+            self.backend.begin_write()
+            self.writing = True
+        return self.current()
+
+    def current(self):
+        # Reads after the transaction's first write have to see that write
+        return self.backend.writer if self.writing else self.reader
+
+    def start_snapshot(self):
+        # SET TRANSACTION ...: later reads share one snapshot until commit or rollback
+        if not self.snapshot and not self.writing:
+            self.reader.execute('BEGIN')
+            self.snapshot = True
+
+    def commit(self):
+        self._finish('COMMIT')
+
+    def rollback(self):
+        self._finish('ROLLBACK')
+
+    def _finish(self, statement):
+        if self.snapshot:
+            self.snapshot = False
+            self.reader.execute(statement)
+        if self.writing:
+            self.writing = False
+            self.backend.end_write(statement)
+
+    def close(self):
+        self.rollback()
+        self.reader.close()
+
+
+class SQLiteCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = None
+        self.rowcount = -1
+
+    @property
+    def description(self):
+        return self._cursor.description if self._cursor else None
+
+    def execute(self, query, vars=None):
+        if SET_TRANSACTION.match(query):
+            self.connection.start_snapshot()
+            return
+        if ADD_COLUMN.match(query):
+            return self._add_column(query)
+        sql, params = translate(query, vars)
+        self._cursor = self.connection.connection_for(sql).execute(sql, params)
+        self.rowcount = self._cursor.rowcount
+
+    def executemany(self, query, vars_list):
+        sql, _ = translate(query, {})
+        self._cursor = self.connection.connection_for(sql).executemany(sql, list(vars_list))
+        self.rowcount = self._cursor.rowcount
+
+    def execute_values(self, query, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        placeholders = '(' + ', '.join(['%s'] * len(rows[0])) + ')'
+        self.executemany(query.replace('VALUES %s', 'VALUES ' + placeholders, 1), rows)
+
+    def _add_column(self, query):
+        # SQLite has no ADD COLUMN IF NOT EXISTS
+        table, column, definition = ADD_COLUMN.match(query).groups()
+        columns = [row[1] for row in self.connection.current().execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            self.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def fetchone(self):
+        return self._cursor.fetchone() if self._cursor else None
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or 1) if self._cursor else []
+
+    def fetchall(self):
+        return self._cursor.fetchall() if self._cursor else []
+
+    def __iter__(self):
+        return iter(self._cursor) if self._cursor else iter(())
+
+    def close(self):
+        if self._cursor:
+            self._cursor.close()
+            self._cursor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+SET_TRANSACTION = re.compile(r'\s*SET\s+TRANSACTION\b', re.I)
+ADD_COLUMN = re.compile(r'\s*ALTER\s+TABLE\s+(\w+)\s+ADD\s+COLUMN\s+IF\s+NOT\s+EXISTS\s+(\w+)\s+(.*)', re.I | re.S)
+READ_ONLY = re.compile(r'\s*(SELECT|PRAGMA|EXPLAIN)\b', re.I)
+PLACEHOLDER = re.compile(r'(=\s*ANY\s*\(\s*)?%(?:\((\w+)\))?s(\s*\))?|%%')
+# Postgres-only spellings with a direct SQLite equivalent
+REWRITES = [
+    (re.compile(r'\bSERIAL\s+PRIMARY\s+KEY\b', re.I), 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+    (re.compile(r'\bBYTEA\b', re.I), 'BLOB'),
+    (re.compile(r'::\w+(\[\])?'), ''),
+    (re.compile(r'\bCURRENT_TIMESTAMP\b', re.I), "(datetime('now', 'localtime'))"),
+]
+
+
+def is_write(sql):
+    return not READ_ONLY.match(sql)
+
+
+def translate(query, params):
+    # Returns SQLite SQL and parameters for a psycopg2 query: %s and %(name)s
+    # become ? and :name, and "= ANY(%s)" with a list becomes "IN (?, ?, ...)"
+    # since SQLite has no arrays. Like psycopg2, a query without parameters is
+    # not scanned for placeholders.
+    for pattern, replacement in REWRITES:
+        query = pattern.sub(replacement, query)
+    if params is None:
+        return query, ()
+    values = iter(params if not isinstance(params, dict) else ())
+    flat = []
+
+    def placeholder(match):
+        if match.group(0) == '%%':
+            return '%'
+        prefix, name, suffix = match.group(1) or '', match.group(2), match.group(3) or ''
+        if name or isinstance(params, dict):
+            return f'{prefix}:{name}{suffix}' if name else f'{prefix}?{suffix}'
+        value = next(values)
+        if prefix and suffix and isinstance(value, (list, tuple)):
+            flat.extend(value)
+            return 'IN (' + ', '.join(['?'] * len(value)) + ')'
+        flat.append(value)
+        return f'{prefix}?{suffix}'
+
+    sql = PLACEHOLDER.sub(placeholder, query)
+    return sql, params if isinstance(params, dict) else flat
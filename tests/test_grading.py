@@ -0,0 +1,64 @@
+import pytest
+
+from grading import DEFAULT_SCHEME, SCHEMES, get_scheme
+
+# (scheme, total out of 100, grade points): each band's lowest total and the one just below it
+BOUNDARIES = {
+    'default': [(100, 10), (90, 10), (89.5, 9), (80, 9), (79, 8), (70, 8), (69, 7), (60, 7), (59, 6),
+                (50, 6), (49, 5), (40, 5), (39.9, 0), (0, 0)],
+    '2018': [(100, 10), (90, 10), (89, 9), (80, 9), (79, 8), (70, 8), (69, 7), (60, 7), (59, 6),
+             (50, 6), (49, 5), (45, 5), (44, 4), (40, 4), (39.5, 0), (0, 0)],
+    '2021': [(100, 10), (90, 10), (89, 9), (80, 9), (79, 8), (70, 8), (69, 7), (60, 7), (59, 6),
+             (55, 6), (54.5, 5), (50, 5), (49, 4), (40, 4), (39, 0), (0, 0)],
+}
+BOUNDARIES['2022'] = BOUNDARIES['2021']
+
+
+@pytest.mark.parametrize('name', sorted(BOUNDARIES))
+def test_band_boundaries(name):
+    totals, expected = zip(*BOUNDARIES[name])
+    assert SCHEMES[name].grade_points(list(totals)) == list(expected)
+
+
+@pytest.mark.parametrize('name', sorted(BOUNDARIES))
+def test_boundaries_scale_with_max_marks(name):
+    # A 50-mark course reaches each band at half the total
+    totals, expected = zip(*BOUNDARIES[name])
+    scheme = SCHEMES[name]
+    assert scheme.grade_points([total / 2 for total in totals], 50) == list(expected)
+    assert scheme.grade_points([total / 2 for total in totals], [50] * len(totals)) == list(expected)
+
+
+def test_lookup_matches_grade_points_above_the_pass_mark():
+    for scheme in set(SCHEMES.values()):
+        for total in range(scheme.pass_percentage, 101):
+            assert scheme.grade_points([total]) == [scheme.lookup(total)]
+
+
+def test_2022_needs_40_percent_internal_and_35_percent_external():
+    scheme = SCHEMES['2022']
+    # CIE out of 50: 20 is 40%; SEE out of 50: 17.5 is 35%
+    assert scheme.grade_points([70, 70, 70, 70], internals=[20, 19, 40, 40], externals=[50, 50, 17.5, 17]) == [8, 0, 8, 0]
+
+
+def test_2018_needs_35_percent_external_only():
+    scheme = SCHEMES['2018']
+    # SEE out of 60: 21 is 35%; there is no CIE minimum
+    assert scheme.grade_points([60, 60, 60], internals=[0, 0, 0], externals=[21, 20.9, 60]) == [7, 0, 7]
+
+
+def test_component_minimums_scale_with_max_marks():
+    # A 50-mark lab has a CIE out of 25, so 10 is the 40% minimum
+    assert SCHEMES['2022'].grade_points([40, 40], 50, internals=[10, 9.9], externals=[25, 25]) == [9, 0]
+
+
+def test_failed_totals_stay_zero_whatever_the_components():
+    assert SCHEMES['2022'].grade_points([30], internals=[50], externals=[50]) == [0]
+
+
+@pytest.mark.parametrize('year_scheme, name', [
+    ('2022', '2022'), ('22', '2022'), ('2021 scheme', '2021'), ('21-scheme', '2021'), (' 2018 ', '2018'),
+    (None, 'default'), ('2015', 'default'), ('new', 'default'),
+])
+def test_get_scheme(year_scheme, name):
+    assert get_scheme(year_scheme) is (DEFAULT_SCHEME if name == 'default' else SCHEMES[name])
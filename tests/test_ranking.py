@@ -0,0 +1,64 @@
+import pytest
+
+from ranking import CohortRanking, format_rank
+
+COHORT = ('RVCE', 'CSE', '3')
+
+
+@pytest.fixture
+def board():
+    board = CohortRanking()
+    # SGPAs 9.5, 8.0, 8.0, 8.0, 7.0 in one cohort
+    board.rebuild([(1, *COHORT, 9.5), (2, *COHORT, 8.0), (3, *COHORT, 8.0), (4, *COHORT, 8.0), (5, *COHORT, 7.0),
+                   (6, 'RVCE', 'ECE', '3', 9.9)])
+    return board
+
+
+def test_ties_share_a_rank(board):
+    assert board.rank(1) == (1, 5, 80.0)
+    # Three students on 8.0 are all second; one of five is below them
+    assert board.rank(2) == board.rank(3) == board.rank(4) == (2, 5, 20.0)
+    assert board.rank(5) == (5, 5, 0.0)
+
+
+def test_all_tied():
+    board = CohortRanking()
+    board.rebuild([(user_id, *COHORT, 8.0) for user_id in range(4)])
+    assert {board.rank(user_id) for user_id in range(4)} == {(1, 4, 0.0)}
+
+
+def test_cohorts_are_case_and_space_insensitive(board):
+    board.update(7, ' rvce', 'cse ', '3', 8.0)
+    assert board.rank(7) == (2, 6, 100 / 6)
+    assert board.rank(6) == (1, 1, 0.0)
+
+
+def test_update_moves_a_student(board):
+    board.update(2, *COHORT, 10.0)
+    assert board.rank(2) == (1, 5, 80.0)
+    assert board.rank(1) == (2, 5, 60.0)
+    assert board.rank(3) == (3, 5, 20.0)
+
+
+def test_update_to_another_cohort_and_remove(board):
+    board.update(1, 'RVCE', 'ECE', '3', 9.0)
+    assert board.rank(1) == (2, 2, 0.0)
+    assert board.rank(2) == (1, 4, 25.0)
+    board.remove(1)
+    assert board.rank(1) is None
+    assert board.rank(6) == (1, 1, 0.0)
+
+
+def test_incomplete_profiles_are_not_ranked(board):
+    board.update(8, 'RVCE', '', '3', 9.0)
+    board.update(2, *COHORT, None)
+    assert board.rank(8) is None
+    assert board.rank(2) is None
+    assert board.rank(3) == (2, 4, 25.0)
+
+
+def test_format_rank():
+    assert format_rank((2, 5, 20.0), 'RVCE ', 'CSE', '3') == \
+        'You are ranked 2 of 5 in RVCE / CSE / semester 3.\nYour SGPA is higher than 20% of your cohort.'
+    assert format_rank((1, 1, 0.0), 'RVCE', 'CSE', '3') == \
+        'You are the only student in RVCE / CSE / semester 3 with an SGPA so far.'
@@ -0,0 +1,68 @@
+import pytest
+
+import storage
+from storage import translate
+
+
+@pytest.fixture
+def db(tmp_path):
+    backend = storage.connect(f'sqlite:///{tmp_path}/campus.db', 2)
+    conn = backend.getconn()
+    cur = conn.cursor()
+    cur.execute('CREATE TABLE users (user_id SERIAL PRIMARY KEY, username TEXT UNIQUE, sgpa REAL)')
+    conn.commit()
+    yield conn, cur
+    backend.putconn(conn)
+    backend.closeall()
+
+
+def test_positional_placeholders():
+    assert translate('SELECT sgpa FROM users WHERE user_id = %s AND semester = %s', (7, '3')) == \
+        ('SELECT sgpa FROM users WHERE user_id = ? AND semester = ?', [7, '3'])
+
+
+def test_any_with_a_list_becomes_in():
+    sql, params = translate('SELECT update_id FROM processed_updates WHERE update_id = ANY(%s)', ([4, 5, 6],))
+    assert sql == 'SELECT update_id FROM processed_updates WHERE update_id IN (?, ?, ?)'
+    assert params == [4, 5, 6]
+
+
+def test_any_next_to_other_parameters():
+    sql, params = translate('DELETE FROM marks_cards WHERE user_id = %s AND card_id = ANY(%s) AND sgpa > %s',
+                            (1, (10, 11), 5.0))
+    assert sql == 'DELETE FROM marks_cards WHERE user_id = ? AND card_id IN (?, ?) AND sgpa > ?'
+    assert params == [1, 10, 11, 5.0]
+
+
+def test_returning_and_on_conflict_pass_through():
+    query = 'INSERT INTO bot_state (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value RETURNING key'
+    sql, params = translate(query, ('last_update_id', '9'))
+    assert sql == query.replace('%s', '?')
+    assert params == ['last_update_id', '9']
+
+
+def test_postgres_spellings_and_casts():
+    sql, params = translate('SELECT user_id FROM users WHERE user_id = ANY(%s::bigint[]) AND %s < CURRENT_TIMESTAMP', ([1], 'x'))
+    assert sql == "SELECT user_id FROM users WHERE user_id IN (?) AND ? < (datetime('now', 'localtime'))"
+    assert params == [1, 'x']
+
+
+def test_named_parameters_and_literal_percent():
+    assert translate("SELECT 1 WHERE name LIKE 'a%%' AND id = %(id)s", {'id': 3}) == \
+        ("SELECT 1 WHERE name LIKE 'a%' AND id = :id", {'id': 3})
+
+
+def test_query_without_parameters_is_not_scanned():
+    assert translate("SELECT '%s'", None) == ("SELECT '%s'", ())
+
+
+def test_returning_and_on_conflict_run_on_sqlite(db):
+    conn, cur = db
+    cur.execute('INSERT INTO users (username, sgpa) VALUES (%s, %s) RETURNING user_id', ('asha', 8.5))
+    user_id = cur.fetchone()[0]
+    cur.execute('INSERT INTO users (username, sgpa) VALUES (%s, %s) ON CONFLICT (username) DO NOTHING', ('asha', 9.0))
+    cur.execute('UPDATE users SET sgpa = %s WHERE user_id = ANY(%s) RETURNING sgpa', (9.1, [user_id, 999]))
+    assert cur.fetchall() == [(9.1,)]
+    conn.commit()
+    cur.execute('SELECT username, sgpa FROM users')
+    assert cur.fetchall() == [('asha', 9.1)]
@@ -0,0 +1,81 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import storage
+import updates
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = storage.connect(f'sqlite:///{tmp_path}/campus.db', 2)
+    conn = backend.getconn()
+    updates.create_tables(conn.cursor())
+    conn.commit()
+    backend.putconn(conn)
+    yield backend
+    backend.closeall()
+
+
+@pytest.fixture
+def store(backend):
+    return updates.UpdateStore(backend.getconn, backend.putconn)
+
+
+def age(backend, update_id, hours):
+    conn = backend.getconn()
+    conn.cursor().execute('UPDATE processed_updates SET received_on = %s WHERE update_id = %s',
+                          (datetime.now() - timedelta(hours=hours), update_id))
+    conn.commit()
+    backend.putconn(conn)
+
+
+def test_recorded_updates_are_seen(store):
+    store.record([101, 102])
+    assert store.seen([100, 101, 102, 103]) == {101, 102}
+    # Recording a redelivered update again is harmless
+    store.record([102, 103])
+    assert store.seen([101, 102, 103]) == {101, 102, 103}
+
+
+def test_offset_is_written_only_when_given(store):
+    assert store.last_update_id() == 0
+    store.record([101], 101)
+    store.record([105])
+    assert store.last_update_id() == 101
+    store.record([106], 106)
+    assert store.last_update_id() == 106
+
+
+def test_updates_are_remembered_across_the_dedup_window(backend, store):
+    store.record([1, 2, 3])
+    age(backend, 1, updates.DEDUP_WINDOW_HOURS + 1)
+    age(backend, 2, updates.DEDUP_WINDOW_HOURS - 1)
+    store._pruned = time.monotonic() - updates.PRUNE_EVERY_SECONDS - 1
+    store.record([4])
+    # Telegram no longer redelivers 1, so it is forgotten; 2 can still come back
+    assert store.seen([1, 2, 3, 4]) == {2, 3, 4}
+
+
+def test_pruning_waits_for_the_prune_interval(backend, store):
+    store.record([1])
+    age(backend, 1, updates.DEDUP_WINDOW_HOURS + 1)
+    store._pruned = time.monotonic()
+    store.record([2])
+    assert store.seen([1, 2]) == {1, 2}
+
+
+def test_idempotency_keys_expire_with_the_window(backend, store):
+    store.mark_done('broadcast:1')
+    store.mark_done('broadcast:1')
+    assert store.done('broadcast:1')
+    assert not store.done('broadcast:2')
+    conn = backend.getconn()
+    conn.cursor().execute('UPDATE idempotency_keys SET created_on = %s',
+                          (datetime.now() - timedelta(hours=updates.DEDUP_WINDOW_HOURS + 1),))
+    conn.commit()
+    backend.putconn(conn)
+    store._pruned = time.monotonic() - updates.PRUNE_EVERY_SECONDS - 1
+    store.record([1])
+    assert not store.done('broadcast:1')
@@ -0,0 +1,202 @@
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from uuid import uuid4
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+# JSON lines trace output; tracing is disabled when unset
+TRACE_FILE = os.getenv('TRACE_FILE')
+
+
+class Trace:
+    def __init__(self, name, attrs):
+        self.trace_id = uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.depth = 0
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.thread_id = threading.get_ident()
+        self.error = None
+
+    def to_dict(self, duration):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': round(duration * 1000, 3),
+            'attrs': self.attrs,
+            'error': self.error,
+            'spans': self.spans,
+        }
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def _write(record):
+    if not TRACE_FILE:
+        return
+    line = json.dumps(record, default=str)
+    with _write_lock:
+        try:
+            with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            print(f"Error writing trace: {e}")
+
+
+@contextmanager
+def start_trace(name, **attrs):
+    if current_trace() is not None:
+        # Handlers calling other handlers show up as spans of the outer trace
+        with span(name):
+            yield current_trace()
+        return
+    trace = Trace(name, attrs)
+    _local.trace = trace
+    if profiler is not None:
+        profiler.begin(trace)
+    try:
+        yield trace
+    except Exception as e:
+        trace.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        duration = time.perf_counter() - trace.start
+        _local.trace = None
+        stacks = profiler.end(trace) if profiler is not None else None
+        _write(trace.to_dict(duration))
+        if stacks and duration * 1000 >= profiler.threshold_ms:
+            profiler.dump(trace, duration, stacks)
+
+
+@contextmanager
+def span(name, **attrs):
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    record = {'name': name, 'depth': trace.depth, 'start_ms': round((time.perf_counter() - trace.start) * 1000, 3)}
+    if attrs:
+        record['attrs'] = attrs
+    trace.spans.append(record)
+    trace.depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        trace.depth -= 1
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+
+def _update_attrs(args):
+    obj = args[0] if args else None
+    message = getattr(obj, 'message', None) if hasattr(obj, 'data') else obj
+    attrs = {}
+    chat = getattr(message, 'chat', None)
+    if chat is not None:
+        attrs['chat_id'] = chat.id
+    if getattr(message, 'message_id', None) is not None:
+        attrs['message_id'] = message.message_id
+    if hasattr(obj, 'data'):
+        attrs['callback_data'] = obj.data
+    elif getattr(message, 'content_type', None) is not None:
+        attrs['content_type'] = message.content_type
+    return attrs
+
+
+def traced_handler(func, name=None):
+    name = name or func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with start_trace(name, **_update_attrs(args)):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def instrument_handlers(bot):
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            handler['function'] = traced_handler(handler['function'])
+
+
+def traced_request_sender(send):
+    def sender(method, url, **kwargs):
+        with span('telegram.' + url.rsplit('/', 1)[-1]):
+            return send(method, url, **kwargs)
+    return sender
+
+
+class SamplingProfiler:
+    # Samples the stacks of threads that are running a trace and keeps the
+    # folded stacks of any update slower than threshold_ms
+
+    def __init__(self, threshold_ms, interval_ms=5, output_dir='profiles'):
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='slow-update-profiler', daemon=True)
+        self._thread.start()
+
+    def begin(self, trace):
+        with self._lock:
+            self._active[trace.thread_id] = (trace, Counter())
+
+    def end(self, trace):
+        with self._lock:
+            entry = self._active.pop(trace.thread_id, None)
+        return entry[1] if entry else None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, (trace, stacks) in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    stack = [f'{f.f_code.co_name} ({os.path.basename(f.f_code.co_filename)}:{lineno})'
+                             for f, lineno in traceback.walk_stack(frame)]
+                    stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, trace, duration, stacks):
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f'{trace.name}-{trace.trace_id}.folded')
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(f'# trace_id={trace.trace_id} handler={trace.name} duration_ms={duration * 1000:.1f} '
+                        f'interval_ms={self.interval * 1000:g}\n')
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+        except OSError as e:
+            print(f"Error writing profile: {e}")
+
+
+profiler = None
+
+
+def enable_profiler(threshold_ms, interval_ms=5, output_dir='profiles'):
+    global profiler
+    if profiler is None:
+        profiler = SamplingProfiler(threshold_ms, interval_ms, output_dir)
+    return profiler
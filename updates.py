@@ -0,0 +1,296 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from functools import wraps
+
+import telebot
+
+import metrics
+from storage import execute_values
+
+# Telegram keeps unconfirmed updates for 24 hours, so remembering processed ids for a day is enough
+DEDUP_WINDOW_HOURS = int(os.getenv('DEDUP_WINDOW_HOURS', '24'))
+PRUNE_EVERY_SECONDS = 600
+# While the offset is held and Telegram only returns updates already taken,
+# polling waits this long for one to finish instead of asking again straight away
+IN_FLIGHT_POLL_WAIT = 0.25
+
+UPDATES_SKIPPED = metrics.Counter('campus_connect_duplicate_updates_total', 'Redelivered updates that were skipped.')
+IDEMPOTENT_SKIPS = metrics.Counter('campus_connect_idempotent_skips_total', 'Handler calls skipped by an idempotency key.', ['handler'])
+
+
+def create_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            received_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            created_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+class UpdateStore:
+    def __init__(self, get_connection, release_connection):
+        self._get_connection = get_connection
+        self._release_connection = release_connection
+        self._pruned = 0
+
+    def _run(self, work, default=None):
+        conn = self._get_connection()
+        if not conn:
+            return default
+        try:
+            cur = conn.cursor()
+            result = work(cur)
+            conn.commit()
+            cur.close()
+            return result
+        except Exception as e:
+            print(f"Error in update store: {e}")
+            conn.rollback()
+            return default
+        finally:
+            self._release_connection(conn)
+
+    def last_update_id(self):
+        def work(cur):
+            cur.execute("SELECT value FROM bot_state WHERE key = 'last_update_id'")
+            row = cur.fetchone()
+            return int(row[0]) if row else 0
+        return self._run(work, 0)
+
+    def seen(self, update_ids):
+        def work(cur):
+            cur.execute('SELECT update_id FROM processed_updates WHERE update_id = ANY(%s)', (list(update_ids),))
+            return {row[0] for row in cur.fetchall()}
+        return self._run(work, set())
+
+    def record(self, update_ids, last_update_id=None):
+        # Processed ids and the new offset are written together; without an
+        # offset only the ids are marked processed
+        def work(cur):
+            execute_values(cur, 'INSERT INTO processed_updates (update_id) VALUES %s ON CONFLICT DO NOTHING',
+                           [(update_id,) for update_id in update_ids])
+            if last_update_id is not None:
+                cur.execute('''
+                    INSERT INTO bot_state (key, value) VALUES ('last_update_id', %s)
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                ''', (str(last_update_id),))
+            if time.monotonic() - self._pruned > PRUNE_EVERY_SECONDS:
+                self._pruned = time.monotonic()
+                # The cutoff is computed here so the statements run unchanged on SQLite
+                cutoff = datetime.now() - timedelta(hours=DEDUP_WINDOW_HOURS)
+                cur.execute('DELETE FROM processed_updates WHERE received_on < %s', (cutoff,))
+                cur.execute('DELETE FROM idempotency_keys WHERE created_on < %s', (cutoff,))
+        return self._run(work, None)
+
+    def done(self, key):
+        def work(cur):
+            cur.execute('SELECT 1 FROM idempotency_keys WHERE key = %s', (key,))
+            return cur.fetchone() is not None
+        return self._run(work, False)
+
+    def mark_done(self, key):
+        def work(cur):
+            cur.execute('INSERT INTO idempotency_keys (key) VALUES (%s) ON CONFLICT DO NOTHING', (key,))
+        self._run(work)
+
+
+class IdempotentTeleBot(telebot.TeleBot):
+    # Skips updates that were already processed before a restart and keeps the
+    # polling offset in the database so a new process starts where the old one
+    # stopped. An update only counts as processed once its handler has
+    # finished: until then neither the offset sent to Telegram nor the one
+    # persisted moves past it, so after a crash Telegram delivers it again.
+
+    def __init__(self, token, update_store, **kwargs):
+        super().__init__(token, **kwargs)
+        self.update_store = update_store
+        self.last_update_id = update_store.last_update_id()
+        self._recent = set()
+        self._in_flight = set()
+        self._polled_stale = False
+        self._recent_lock = threading.Lock()
+        self._progress = threading.Condition(self._recent_lock)
+        self._batch_lock = threading.Lock()
+        self._accepting = True
+
+    def stop_updates(self):
+        # A batch is either dispatched in full or not at all; one that arrives
+        # after this, like any update still unfinished, is left unconfirmed,
+        # so Telegram delivers it again to the next process
+        with self._batch_lock:
+            self._accepting = False
+        self.stop_polling()
+
+    def get_updates(self, offset=None, *args, **kwargs):
+        # Telegram forgets every update below the offset it is polled with
+        with self._recent_lock:
+            if self._in_flight and offset is not None and offset > 0:
+                if self._polled_stale:
+                    self._progress.wait(IN_FLIGHT_POLL_WAIT)
+                offset = min([offset] + list(self._in_flight))
+        result = super().get_updates(offset, *args, **kwargs)
+        with self._recent_lock:
+            self._polled_stale = bool(result) and all(
+                update.update_id in self._in_flight or update.update_id in self._recent for update in result)
+        return result
+
+    def process_new_updates(self, updates):
+        if not updates:
+            return
+        with self._batch_lock:
+            if self._accepting:
+                self._process_batch(updates)
+
+    def _process_batch(self, updates):
+        ids = [update.update_id for update in updates]
+        with self._recent_lock:
+            # Updates still being handled come back while the offset waits for them
+            running = {update_id for update_id in ids if update_id in self._in_flight}
+            unknown = [update_id for update_id in ids if update_id not in self._recent and update_id not in running]
+        # The in-memory set covers the normal case; the table covers updates seen before a restart
+        seen = (set(ids) - set(unknown) - running) | (self.update_store.seen(unknown) if unknown else set())
+        fresh = [update for update in updates if update.update_id not in seen and update.update_id not in running]
+        if seen:
+            UPDATES_SKIPPED.inc(len(seen))
+        with self._recent_lock:
+            self._in_flight.update(update.update_id for update in fresh)
+            self.last_update_id = max(self.last_update_id, max(ids))
+
+        self._dispatch(fresh)
+
+    def _dispatch(self, updates):
+        # Runs the handlers for the updates; CampusBot queues them per chat instead
+        try:
+            with handling(updates[0].update_id if len(updates) == 1 else None):
+                super().process_new_updates(updates)
+        finally:
+            self._finished([update.update_id for update in updates])
+
+    def _finished(self, update_ids):
+        if not update_ids:
+            return
+        with self._recent_lock:
+            self._in_flight.difference_update(update_ids)
+            self._recent.update(update_ids)
+            if len(self._recent) > 10000:
+                # Only the newest ids can still be redelivered by the current process
+                self._recent = set(sorted(self._recent)[-1000:])
+            # Everything up to the oldest unfinished update is done
+            offset = min(self._in_flight) - 1 if self._in_flight else self.last_update_id
+            self._progress.notify_all()
+        self.update_store.record(update_ids, offset)
+
+
+@contextmanager
+def handling(update_id):
+    # current_update_id() returns update_id inside the block, on this thread or asyncio task
+    token = _current.set(update_id)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def current_update_id():
+    # The update whose handler is running, if any
+    return _current.get()
+
+
+class AsyncUpdateStore:
+    # UpdateStore for the asyncio runtime, on an asyncpg pool
+    def __init__(self, pool):
+        self.pool = pool
+        self._pruned = 0
+
+    async def last_update_id(self):
+        value = await self.pool.fetchval("SELECT value FROM bot_state WHERE key = 'last_update_id'")
+        return int(value) if value else 0
+
+    async def seen(self, update_ids):
+        rows = await self.pool.fetch('SELECT update_id FROM processed_updates WHERE update_id = ANY($1::bigint[])', list(update_ids))
+        return {row['update_id'] for row in rows}
+
+    async def record(self, update_ids, last_update_id=None):
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                await conn.executemany('INSERT INTO processed_updates (update_id) VALUES ($1) ON CONFLICT DO NOTHING',
+                                       [(update_id,) for update_id in update_ids])
+                if last_update_id is not None:
+                    await conn.execute('''
+                        INSERT INTO bot_state (key, value) VALUES ('last_update_id', $1)
+                        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                    ''', str(last_update_id))
+                if time.monotonic() - self._pruned > PRUNE_EVERY_SECONDS:
+                    self._pruned = time.monotonic()
+                    await conn.execute('DELETE FROM processed_updates WHERE received_on < CURRENT_TIMESTAMP - make_interval(hours => $1)',
+                                       DEDUP_WINDOW_HOURS)
+                    await conn.execute('DELETE FROM idempotency_keys WHERE created_on < CURRENT_TIMESTAMP - make_interval(hours => $1)',
+                                       DEDUP_WINDOW_HOURS)
+        except Exception as e:
+            print(f"Error in update store: {e}")
+
+    async def done(self, key):
+        return await self.pool.fetchval('SELECT 1 FROM idempotency_keys WHERE key = $1', key) is not None
+
+    async def mark_done(self, key):
+        await self.pool.execute('INSERT INTO idempotency_keys (key) VALUES ($1) ON CONFLICT DO NOTHING', key)
+
+
+def idempotent(func, kind=None):
+    # Runs the handler at most once per Telegram message; a redelivered
+    # message costs one key lookup instead of repeating the work
+    kind = kind or func.__name__
+
+    @wraps(func)
+    def wrapper(message, *args, **kwargs):
+        if store is None:
+            return func(message, *args, **kwargs)
+        key = f'{kind}:{message.chat.id}:{message.message_id}'
+        if store.done(key):
+            IDEMPOTENT_SKIPS.inc(handler=kind)
+            print(f"Skipping already processed message {key}")
+            return None
+        result = func(message, *args, **kwargs)
+        store.mark_done(key)
+        return result
+    return wrapper
+
+
+def idempotent_async(func, kind=None):
+    # idempotent() for coroutine handlers, backed by async_store
+    kind = kind or func.__name__
+
+    @wraps(func)
+    async def wrapper(message, *args, **kwargs):
+        if async_store is None:
+            return await func(message, *args, **kwargs)
+        key = f'{kind}:{message.chat.id}:{message.message_id}'
+        if await async_store.done(key):
+            IDEMPOTENT_SKIPS.inc(handler=kind)
+            print(f"Skipping already processed message {key}")
+            return None
+        result = await func(message, *args, **kwargs)
+        await async_store.mark_done(key)
+        return result
+    return wrapper
+
+
+store = None
+async_store = None
+_current = ContextVar('update_id', default=None)